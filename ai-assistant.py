@@ -1,10 +1,30 @@
+import time
+# 记录进程启动时间，用于统计到首个提示符的耗时
+PROCESS_START = time.perf_counter()
+
 import os
-from openai import OpenAI
-from mem0 import Memory
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import readline  # 添加readline支持
 import argparse
+import re
+import hmac
+import json
+import queue
+import threading
+import asyncio
+from concurrent.futures import wait as wait_futures
+import copy
+import sqlite3
+from collections import OrderedDict, deque
+from token_counter import count_tokens, count_message_tokens, tokenizer_name
+from embedders import HashingEmbedder, OllamaEmbedder
+from prompts import build_messages, record_usage, cache_stats, format_cache_stats
+import settings
+import metrics
+
+# openai、mem0、numpy 导入较慢，在后台初始化或首次使用时再导入
+np = None
 
 # 配置readline
 def setup_readline():
@@ -28,7 +48,8 @@ def setup_readline():
 # 前置操作
 '''
 1. 安装依赖
-pip install openai mem0
+pip install openai mem0 numpy
+（openai、mem0 在后台线程导入并初始化，启动后立即显示提示符）
 
 2. 安装ollama
 brew install ollama 
@@ -42,6 +63,11 @@ ollama pull nomic-embed-text:latest
 5. 启动qdrant
 docker run -d -p 6333:6333 -p 6334:6334 -v $(pwd)/qdrant_storage:/qdrant/storage  qdrant/qdrant
 
+6. 服务模式（一个进程服务多个用户，按用户缓存实例）
+python ai-assistant.py --serve --port 6002
+curl -N -X POST localhost:6002/api/chat -H 'Content-Type: application/json' -d '{"user_id": "alice", "message": "你好"}'
+默认只监听本机；监听其他地址时配置 assistant.api_key（或 ASSISTANT_API_KEY），请求加上 -H 'X-API-KEY: <密钥>'
+
 '''
 
 # ===================== 配置部分 =====================
@@ -60,19 +86,21 @@ SYSTEM_PROMPT = {
                "8. 你会记住用户的喜好和之前的对话内容，提供个性化的服务。"
 }
 
-# API配置
+# API配置：接口地址、密钥、模型和超时来自 config.yaml 的 llm、assistant 段（见 settings.py），服务模式下修改会热加载
 API_CONFIG = {
     "llm": "xai",
-    "llm_api_key": "xai-xxx",
-    "llm_base_url": "https://api.x.ai/v1",
-    "llm_model": "grok-2-latest",
+    "llm_api_key": settings.get().llm.api_key,
+    "llm_base_url": settings.get().llm.base_url,
+    "llm_model": settings.get().model_for("assistant"),
+    "llm_timeout": settings.get().llm.timeout,
     "temperature": 0.1,
     "max_tokens": 30000,
     "max_history_length": 102 # 系统消息+历史对话
 }
 
-# 设置环境变量
-os.environ["XAI_API_KEY"] = API_CONFIG["llm_api_key"]
+# 设置环境变量（mem0 的 xai 提供方从环境变量读取密钥），未配置时保留已有的环境变量
+if API_CONFIG["llm_api_key"]:
+    os.environ["XAI_API_KEY"] = API_CONFIG["llm_api_key"]
 
 # 用户配置
 USER_CONFIG = {
@@ -84,6 +112,11 @@ USER_CONFIG = {
 # 存储配置
 STORAGE_CONFIG = {
     "base_collection_name": "assistant_memory",  # 基础collection名称
+    # collection布局: per_user 每个用户一个collection（名称加 _<用户ID> 后缀）；
+    # shared 所有用户共用名为 base_collection_name 的collection，按 user_id 租户索引过滤检索
+    "collection_layout": "per_user",
+    "migrate_batch_size": 256,  # 迁移到共享collection时每批复制的条数
+    "data_dir": "./.assistant_data",  # 本地数据目录（记忆编号索引等）
     "vector_store": {
         "host": "localhost",
         "port": 6333,
@@ -100,11 +133,91 @@ STORAGE_CONFIG = {
 LIMIT_CONFIG = {
     "max_history_length": 102,  # 最大历史消息长度（包含系统消息）
     "max_memory_items": 100,    # 最大记忆条数
-    "max_search_results": 100,    # 搜索结果最大条数
+    "max_search_results": 20,    # 搜索结果最大条数
     "max_summary_length": 1000,  # 总结最大字数
     "preview_text_length": 100,  # 预览文本长度
+    "history_page_size": 20,     # /history 每页条数
+    "index_rebuild_limit": 100000,  # 重建记忆编号索引时拉取的最大条数
+}
+
+# 上下文预算配置（单位: token）
+CONTEXT_CONFIG = {
+    "max_context_tokens": 8000,   # 单次请求的提示总预算（系统提示+摘要+记忆+对话）
+    "memory_tokens": 1500,        # 注入的相关记忆预算
+    "history_tokens": 4000,       # 保留原文的最近对话预算，超出部分合并进摘要
+    "summarize_batch": 6,         # 每次至少合并进摘要的消息条数
+}
+
+# 检索配置
+RETRIEVAL_CONFIG = {
+    "embedding_cache_size": 512,  # 嵌入向量缓存条数（LRU，按归一化文本）
+    "search_cache_size": 128,     # 搜索结果缓存条数（LRU，记忆变更后失效）
+    "min_query_length": 4,        # 归一化后短于该长度的输入视为低信息量
+    "short_query_results": 3,     # 低信息量输入的检索条数（0 表示跳过检索）
+    "score_threshold": 0.5,       # 相似度阈值，低于该值的记忆不注入提示
+    "skip_phrases": [             # 无需检索的寒暄/确认类输入
+        "ok", "okay", "thanks", "thank you", "thx", "yes", "no", "好", "好的", "嗯", "嗯嗯",
+        "谢谢", "多谢", "收到", "明白", "知道了", "可以", "行", "是的", "不是", "对", "继续",
+    ],
+    "show_latency": False,        # 每轮回答后打印检索耗时和首个token延迟
+    "stats_window": 100,          # 延迟统计保留的轮数
+}
+
+# 会话日志配置（本地SQLite，重启后恢复对话上下文，无需访问向量库）
+SESSION_CONFIG = {
+    "db_file": "sessions.db",   # 位于 STORAGE_CONFIG["data_dir"] 下
+    "restore_messages": 20,     # 启动时恢复的最近消息条数
+    "older_page_size": 10,      # /older 每次加载的消息条数
+}
+
+# 本地向量索引配置（mem0初始化失败时的离线检索）
+LOCAL_INDEX_CONFIG = {
+    "enabled": True,              # 是否启用本地向量索引
+    "initial_capacity": 1024,     # 向量文件初始行数，写满后按倍数扩容
+    "hash_dims": 256,             # Ollama不可用时哈希n-gram向量的维度
+    "hash_score_threshold": 0.1,  # 哈希向量的相似度阈值（与语义嵌入的分数不可比）
+    "ollama_timeout": 5,          # 探测和调用Ollama嵌入服务的超时时间（秒）
+}
+
+# 记忆写入配置
+MEMORY_WRITE_CONFIG = {
+    "background": True,      # 是否在后台线程写入记忆（回答结束后立即返回提示符）
+    "coalesce_delay": 0.5,   # 收到一轮对话后等待合并后续对话的时间（秒）
+    "max_batch_turns": 5,    # 单次写入合并的最大轮数
+    "flush_timeout": 60,     # 退出时等待写入完成的最长时间（秒）
 }
 
+# 记忆整理配置（python ai-assistant.py --consolidate）
+CONSOLIDATE_CONFIG = {
+    "similarity_threshold": 0.92,  # 余弦相似度不低于该值的记忆视为近似重复，合并为一条
+    "merge_with_llm": True,        # 用模型把一组近似重复的记忆改写为一条完整的事实，否则保留代表记忆的原文
+    "max_merge_items": 10,         # 交给模型合并的最多条数
+    "max_age_days": 90,            # 超过该天数没有被检索命中且累计命中次数不足的记忆视为过期
+    "min_access_count": 1,         # 累计命中次数达到该值的记忆不会过期
+    "batch_size": 256,             # 读取和删除时每批的条数
+    "access_save_interval": 30,    # 命中统计写入本地文件的最短间隔（秒）
+}
+
+# 异步对话流水线配置
+ASYNC_CONFIG = {
+    "io_workers": 32,        # 检索、历史组装、记忆写回等阻塞操作使用的线程数（所有用户共享）
+}
+
+# 服务模式配置（python ai-assistant.py --serve）
+SERVER_CONFIG = {
+    "host": settings.get().assistant.host,
+    "port": settings.get().assistant.port,
+    "max_assistants": settings.get().assistant.max_assistants,   # 同时缓存的用户实例数，超出时淘汰最久未使用的空闲实例
+    "idle_timeout": settings.get().assistant.idle_timeout,       # 实例空闲多久后被淘汰（秒）
+    "sweep_interval": 60,    # 检查空闲实例的间隔（秒）
+}
+
+def memory_collection_name(user_id):
+    """用户记忆所在的collection名称"""
+    if STORAGE_CONFIG["collection_layout"] == "shared":
+        return STORAGE_CONFIG["base_collection_name"]
+    return f"{STORAGE_CONFIG['base_collection_name']}_{user_id}"
+
 def get_vector_store_config(user_id):
     """根据用户ID生成向量存储配置"""
     return {
@@ -119,7 +232,7 @@ def get_vector_store_config(user_id):
         "vector_store": {
             "provider": "qdrant",
             "config": {
-                "collection_name": f"{STORAGE_CONFIG['base_collection_name']}_{user_id}",
+                "collection_name": memory_collection_name(user_id),
                 "host": STORAGE_CONFIG["vector_store"]["host"],
                 "port": STORAGE_CONFIG["vector_store"]["port"],
                 "embedding_model_dims": STORAGE_CONFIG["vector_store"]["embedding_model_dims"],
@@ -145,8 +258,8 @@ COMMANDS = {
         "description": "查看记忆"
     },
     "history": {
-        "command": "/history",
-        "description": "查看带时间戳的记忆历史"
+        "command": "/history [页码]",
+        "description": "分页查看带时间戳的记忆历史（默认最后一页）"
     },
     "update": {
         "command": "/update <id> <内容>",
@@ -156,6 +269,10 @@ COMMANDS = {
         "command": "/delete <id>",
         "description": "删除指定ID的记忆"
     },
+    "older": {
+        "command": "/older",
+        "description": "查看更早的会话记录（可重复输入继续向前翻）"
+    },
     "reset": {
         "command": "/reset",
         "description": "重置所有记忆"
@@ -176,6 +293,200 @@ LOGGING_CONFIG = {
     "disabled_loggers": ['mem0', 'qdrant_client']
 }
 
+# ===================== 共享客户端 =====================
+
+# 进程内共享的客户端：服务模式下所有用户实例复用同一套连接池
+_shared_clients = {}
+_shared_clients_lock = threading.RLock()
+
+# 接口是否支持 stream_options（不支持时不再请求流末尾的token用量）
+_stream_usage_supported = True
+
+def get_llm_client():
+    """获取共享的OpenAI客户端"""
+    with _shared_clients_lock:
+        client = _shared_clients.get("llm_client")
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(
+                api_key=API_CONFIG["llm_api_key"],
+                base_url=API_CONFIG["llm_base_url"],
+                timeout=API_CONFIG["llm_timeout"],
+            )
+            _shared_clients["llm_client"] = client
+        return client
+
+def get_async_llm_client():
+    """获取共享的异步OpenAI客户端（只在共享事件循环中使用）"""
+    with _shared_clients_lock:
+        client = _shared_clients.get("async_llm_client")
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(
+                api_key=API_CONFIG["llm_api_key"],
+                base_url=API_CONFIG["llm_base_url"],
+                timeout=API_CONFIG["llm_timeout"],
+            )
+            _shared_clients["async_llm_client"] = client
+        return client
+
+def get_event_loop():
+    """获取运行对话流水线的共享事件循环（后台线程），阻塞操作交给共享线程池"""
+    with _shared_clients_lock:
+        loop = _shared_clients.get("event_loop")
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(get_io_executor())
+            threading.Thread(target=loop.run_forever, name="assistant-loop", daemon=True).start()
+            _shared_clients["event_loop"] = loop
+        return loop
+
+def get_io_executor():
+    """共享的阻塞操作线程池"""
+    with _shared_clients_lock:
+        executor = _shared_clients.get("io_executor")
+        if executor is None:
+            executor = metrics.TrackedExecutor(max_workers=ASYNC_CONFIG["io_workers"], thread_name_prefix="assistant-io")
+            _shared_clients["io_executor"] = executor
+            metrics.track_limit("assistant_io", executor)
+        return executor
+
+def get_qdrant_client():
+    """获取共享的Qdrant客户端"""
+    with _shared_clients_lock:
+        client = _shared_clients.get("qdrant")
+        if client is None:
+            from qdrant_client import QdrantClient
+            client = QdrantClient(host=STORAGE_CONFIG["vector_store"]["host"], port=STORAGE_CONFIG["vector_store"]["port"])
+            _shared_clients["qdrant"] = client
+        return client
+
+def ensure_shared_collection(client=None):
+    """创建多用户共享的collection：user_id 建租户索引，HNSW图按租户构建而不是全局构建
+
+    mem0 检索时带 user_id 过滤条件，有了租户索引后只在该用户的数据中查找。每个进程只执行一次。
+    """
+    if _shared_clients.get("shared_collection_ready"):
+        return
+    from qdrant_client import models
+
+    client = client or get_qdrant_client()
+    name = STORAGE_CONFIG["base_collection_name"]
+    if not client.collection_exists(name):
+        client.create_collection(
+            collection_name=name,
+            vectors_config=models.VectorParams(size=STORAGE_CONFIG["vector_store"]["embedding_model_dims"],
+                                               distance=models.Distance.COSINE),
+            # m=0 不建全局图，payload_m 为每个 user_id 单独建图
+            hnsw_config=models.HnswConfigDiff(m=0, payload_m=16),
+        )
+    try:
+        schema = models.KeywordIndexParams(type="keyword", is_tenant=True)
+    except AttributeError:  # 旧版 qdrant_client 没有租户索引参数
+        schema = models.PayloadSchemaType.KEYWORD
+    client.create_payload_index(collection_name=name, field_name="user_id", field_schema=schema)
+    _shared_clients["shared_collection_ready"] = True
+
+def _config_diff(diff_class, config):
+    """把 get_collection 返回的完整配置转换为 create_collection 接受的 *Diff 参数"""
+    if config is None:
+        return None
+    values = config.model_dump() if hasattr(config, "model_dump") else config.dict()
+    fields = getattr(diff_class, "model_fields", None) or diff_class.__fields__
+    return diff_class(**{key: value for key, value in values.items() if key in fields})
+
+def recreate_collection(client, name):
+    """删除并重建collection：保留向量、HNSW、优化器、WAL、量化配置和payload索引，数据清空"""
+    from qdrant_client import models
+
+    info = client.get_collection(name)
+    params = info.config.params
+    client.delete_collection(collection_name=name)
+    client.create_collection(
+        collection_name=name,
+        vectors_config=params.vectors,
+        sparse_vectors_config=getattr(params, "sparse_vectors", None),
+        shard_number=params.shard_number,
+        replication_factor=params.replication_factor,
+        write_consistency_factor=params.write_consistency_factor,
+        on_disk_payload=params.on_disk_payload,
+        hnsw_config=_config_diff(models.HnswConfigDiff, info.config.hnsw_config),
+        optimizers_config=_config_diff(models.OptimizersConfigDiff, info.config.optimizer_config),
+        wal_config=_config_diff(models.WalConfigDiff, info.config.wal_config),
+        quantization_config=info.config.quantization_config,
+    )
+    for field_name, index in (info.payload_schema or {}).items():
+        client.create_payload_index(collection_name=name, field_name=field_name,
+                                    field_schema=index.params or index.data_type)
+
+def migrate_to_shared_collection(drop_source=False, batch_size=None):
+    """把按用户划分的collection批量复制到共享collection，返回 {用户ID: 迁移条数}
+
+    记忆ID保持不变，本地记忆编号索引无需重建；重复执行只会覆盖已迁移的记忆。
+    drop_source 为 True 时，核对共享collection中该用户的条数后删除原collection。
+    """
+    from qdrant_client import models
+
+    client = get_qdrant_client()
+    ensure_shared_collection(client)
+    target = STORAGE_CONFIG["base_collection_name"]
+    prefix = f"{target}_"
+    batch_size = batch_size or STORAGE_CONFIG["migrate_batch_size"]
+    migrated = {}
+    sources = sorted(c.name for c in client.get_collections().collections if c.name.startswith(prefix))
+    for number, collection in enumerate(sources, 1):
+        user_id = collection[len(prefix):]
+        moved = 0
+        offset = None
+        while True:
+            points, offset = client.scroll(collection_name=collection, limit=batch_size, offset=offset,
+                                           with_payload=True, with_vectors=True)
+            if points:
+                client.upsert(collection_name=target, wait=True, points=[
+                    models.PointStruct(id=point.id, vector=point.vector,
+                                       payload={**(point.payload or {}), "user_id": (point.payload or {}).get("user_id") or user_id})
+                    for point in points
+                ])
+                moved += len(points)
+            if offset is None:
+                break
+        migrated[user_id] = moved
+        print(f"[{number}/{len(sources)}] {collection}: 已迁移 {moved} 条记忆")
+        if drop_source:
+            user_filter = models.Filter(must=[
+                models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id))
+            ])
+            copied = client.count(collection_name=target, count_filter=user_filter, exact=True).count
+            if copied >= moved:
+                client.delete_collection(collection_name=collection)
+            else:
+                print(f"  共享collection中只有 {copied} 条，保留原collection {collection}")
+    return migrated
+
+def create_memory(vector_config):
+    """创建用户的mem0实例，嵌入模型、LLM和Qdrant客户端与其他用户的实例共享（collection 名称仍按用户区分）
+
+    Qdrant客户端通过 vector_store 配置的 client 传入；第一个实例完整构建后作为模板，
+    之后的实例复制模板，只为自己的collection新建向量存储，不再重复创建嵌入模型、LLM和历史数据库连接。
+    """
+    from mem0 import Memory
+    from mem0.configs.base import MemoryConfig
+    from mem0.utils.factory import VectorStoreFactory
+
+    vector_config["vector_store"]["config"]["client"] = get_qdrant_client()
+    with _shared_clients_lock:
+        template = _shared_clients.get("memory_template")
+        if template is None:
+            template = Memory.from_config(vector_config)
+            _shared_clients["memory_template"] = template
+            return template
+    memory = copy.copy(template)
+    memory.config = MemoryConfig(**vector_config)
+    memory.vector_store = VectorStoreFactory.create(memory.config.vector_store.provider,
+                                                    memory.config.vector_store.config)
+    memory.collection_name = memory.config.vector_store.config.collection_name
+    return memory
+
 # ===================== 日志初始化 =====================
 
 # 设置日志级别
@@ -184,36 +495,657 @@ logging.getLogger().setLevel(LOGGING_CONFIG["default_level"])
 for logger in LOGGING_CONFIG["disabled_loggers"]:
     logging.getLogger(logger).setLevel(logging.ERROR)
 
+# ===================== 检索工具 =====================
+
+class LRUCache:
+    """简单的LRU缓存，记录命中率
+
+    --serve 模式下嵌入缓存由所有用户共享，请求线程、IO线程池和记忆写入线程会同时读写，所有操作都需要加锁。
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def hit_rate(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return self.hits / total if total else 0.0
+
+def normalize_query(text):
+    """归一化查询文本：小写、合并空白、去除首尾标点"""
+    text = re.sub(r"\s+", " ", str(text).strip().lower())
+    return text.strip(" .,!?;:~。，！？；：、…")
+
+# ===================== 记忆编号索引 =====================
+
+class MemoryIndex:
+    """用户记忆编号索引：显示编号 → 内部ID和时间戳，持久化到本地文件
+
+    通过 memory.add 返回的事件增量维护，/update、/delete、/history 不再需要 get_all。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.entries = []
+        self.loaded = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            self.loaded = True
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def rebuild(self, items):
+        """用 get_all 的结果重建索引"""
+        with self.lock:
+            self.entries = []
+            for mem in items:
+                if isinstance(mem, dict) and 'id' in mem:
+                    self.entries.append(self._entry(mem))
+            self.loaded = True
+            self.save()
+
+    def apply_events(self, result):
+        """根据 memory.add 返回的 ADD/UPDATE/DELETE 事件增量更新索引"""
+        events = result.get('results', []) if isinstance(result, dict) else result
+        if not isinstance(events, list):
+            return
+        with self.lock:
+            for event in events:
+                if not isinstance(event, dict) or 'id' not in event:
+                    continue
+                action = event.get('event', 'ADD')
+                position = self.find(event['id'])
+                if action == 'DELETE':
+                    if position is not None:
+                        del self.entries[position]
+                elif position is not None:
+                    self.entries[position]['memory'] = event.get('memory', self.entries[position]['memory'])
+                    self.entries[position]['updated_at'] = datetime.now().isoformat()
+                elif action in ('ADD', 'UPDATE'):
+                    self.entries.append(self._entry(event))
+            self.save()
+
+    def find(self, internal_id):
+        """按内部ID查找位置"""
+        for position, entry in enumerate(self.entries):
+            if entry['id'] == internal_id:
+                return position
+        return None
+
+    def get(self, number):
+        """按显示编号（从1开始）获取索引项"""
+        if 1 <= number <= len(self.entries):
+            return self.entries[number - 1]
+        return None
+
+    def update(self, number, content):
+        with self.lock:
+            entry = self.entries[number - 1]
+            entry['memory'] = content
+            entry['updated_at'] = datetime.now().isoformat()
+            self.save()
+
+    def remove(self, number):
+        with self.lock:
+            del self.entries[number - 1]
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+            self.save()
+
+    def page(self, page, size):
+        """返回第 page 页（从1开始）的 (编号, 索引项) 列表"""
+        start = (page - 1) * size
+        return [(start + i + 1, entry) for i, entry in enumerate(self.entries[start:start + size])]
+
+    def page_count(self, size):
+        return max(1, (len(self.entries) + size - 1) // size)
+
+    @staticmethod
+    def _entry(mem):
+        timestamp = None
+        if isinstance(mem.get('metadata'), dict):
+            timestamp = mem['metadata'].get('timestamp')
+        timestamp = timestamp or mem.get('created_at') or datetime.now().isoformat()
+        return {
+            "id": mem['id'],
+            "memory": mem.get('memory', mem.get('text', '')),
+            "created_at": timestamp,
+            "updated_at": mem.get('updated_at'),
+        }
+
+# ===================== 记忆命中统计 =====================
+
+class AccessStats:
+    """记忆被检索命中的次数和最近命中时间：内部ID → [次数, 时间戳]，定期持久化到本地文件
+
+    记忆整理任务据此判断哪些旧记忆已经没有价值。文件中同时记录开始统计的时间（since），
+    统计覆盖的时间不足保留期时不能据此判断记忆过期。服务进程和整理任务（--consolidate）
+    可能同时持有同一用户的统计，保存时先读取文件中的最新内容，再重放本进程的修改。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ops = []
+        self.last_save = time.time()
+        self.since, self.stats = self._load()
+        if self.since is None:
+            self.since = datetime.now().isoformat()
+            self.ops.append(("since", self.since))
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None, {}
+        if "hits" not in data:
+            # 旧格式只有命中统计，开始统计的时间未知，从现在算起
+            return None, data
+        return data.get("since"), data["hits"]
+
+    @staticmethod
+    def _apply(stats, op):
+        kind = op[0]
+        if kind == "hit":
+            _, ids, now = op
+            for internal_id in ids:
+                count = stats.get(internal_id, [0, None])[0]
+                stats[internal_id] = [count + 1, now]
+        elif kind == "merge":
+            _, target_id, source_ids = op
+            count, last_used = stats.get(target_id, [0, None])
+            for source_id in source_ids:
+                source_count, source_last = stats.pop(source_id, [0, None])
+                count += source_count
+                if source_last and (last_used is None or source_last > last_used):
+                    last_used = source_last
+            if count:
+                stats[target_id] = [count, last_used]
+        elif kind == "remove":
+            for internal_id in op[1]:
+                stats.pop(internal_id, None)
+
+    def _do(self, op):
+        self._apply(self.stats, op)
+        self.ops.append(op)
+
+    def record(self, ids):
+        with self.lock:
+            self._do(("hit", list(ids), datetime.now().isoformat()))
+            if time.time() - self.last_save >= CONSOLIDATE_CONFIG["access_save_interval"]:
+                self._save()
+
+    def count(self, internal_id):
+        return self.stats.get(internal_id, [0, None])[0]
+
+    def last_used(self, internal_id):
+        return self.stats.get(internal_id, [0, None])[1]
+
+    def merge(self, target_id, source_ids):
+        """合并后的记忆继承被合并记忆的命中次数"""
+        with self.lock:
+            self._do(("merge", target_id, list(source_ids)))
+
+    def remove(self, ids):
+        with self.lock:
+            self._do(("remove", list(ids)))
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.ops:
+            return
+        since, stats = self._load()
+        if since is None or self.since < since:
+            since = self.since
+        for op in self.ops:
+            self._apply(stats, op)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"since": since, "hits": stats}, f)
+        os.replace(tmp_path, self.path)
+        self.since, self.stats = since, stats
+        self.ops = []
+        self.last_save = time.time()
+
+def cluster_near_duplicates(vectors, threshold, order):
+    """按 order 顺序贪心聚类：每个尚未归类的向量作为代表，吸收与它余弦相似度不低于 threshold 的其余向量
+
+    返回 [(代表下标, [成员下标...]), ...]，成员不含代表本身。
+    """
+    import numpy
+
+    matrix = numpy.asarray(vectors, dtype=numpy.float32)
+    norms = numpy.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / numpy.maximum(norms, 1e-12)
+    remaining = numpy.ones(len(matrix), dtype=bool)
+    # 一次为一批代表计算与全部向量的相似度（矩阵乘法），分数矩阵不超过约 64MB；
+    # 批内仍按顺序处理，已被吸收的向量用 remaining 屏蔽，结果与逐个计算相同
+    block_size = max(1, min(256, (1 << 24) // max(len(matrix), 1)))
+    clusters = []
+    position = 0
+    while position < len(order):
+        block = []
+        while position < len(order) and len(block) < block_size:
+            if remaining[order[position]]:
+                block.append(order[position])
+            position += 1
+        if not block:
+            break
+        scores = matrix[block] @ matrix.T
+        for row, leader in enumerate(block):
+            if not remaining[leader]:
+                continue
+            remaining[leader] = False
+            similar = numpy.flatnonzero((scores[row] >= threshold) & remaining)
+            remaining[similar] = False
+            clusters.append((leader, similar.tolist()))
+    return clusters
+
+# ===================== 本地向量索引 =====================
+
+class LocalVectorIndex:
+    """进程内向量索引：归一化嵌入矩阵 + 余弦 top-k，按用户持久化
+
+    records.jsonl 是追加写入的操作日志（add/update/delete），启动时回放得到记录；
+    vectors_<kind>.f32 是内存映射的向量矩阵，第 row 行对应第 row 条记录，
+    已删除或尚未嵌入的行为全零。切换嵌入方式后缺失的向量在加载时补齐。
+    写入来自后台记忆写入线程和IO线程池，检索来自请求线程，所有读写记录和向量矩阵的操作都持有 self.lock；
+    生成嵌入（可能请求Ollama）在锁外进行。
+    """
+    def __init__(self, directory, embedder):
+        os.makedirs(directory, exist_ok=True)
+        self.embedder = embedder
+        self.lock = threading.RLock()
+        self.records_path = os.path.join(directory, "records.jsonl")
+        self.vectors_path = os.path.join(directory, f"vectors_{embedder.kind}.f32")
+        self.records = OrderedDict()  # row -> {"role", "content", "timestamp"}
+        self.next_row = 0
+        self.vectors = None
+        self._replay()
+        self._open(max(LOCAL_INDEX_CONFIG["initial_capacity"], self.next_row))
+        self._backfill()
+        self.log = open(self.records_path, "a", encoding="utf-8")
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+    def _replay(self):
+        try:
+            with open(self.records_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        continue  # 写入中断的最后一行
+                    if op["op"] == "add":
+                        self.records[op["row"]] = {"role": op["role"], "content": op["content"], "timestamp": op["timestamp"]}
+                        self.next_row = max(self.next_row, op["row"] + 1)
+                    elif op["op"] == "update" and op["row"] in self.records:
+                        self.records[op["row"]].update(content=op["content"], timestamp=op["timestamp"])
+                    elif op["op"] == "delete":
+                        self.records.pop(op["row"], None)
+        except FileNotFoundError:
+            pass
+
+    def _open(self, capacity):
+        """打开（必要时扩展）向量文件，新的内存映射建好后再替换 self.vectors"""
+        size = capacity * self.embedder.dims * 4
+        if self.vectors is not None:
+            self.vectors.flush()
+        with open(self.vectors_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        capacity = os.path.getsize(self.vectors_path) // (self.embedder.dims * 4)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.embedder.dims))
+
+    def _backfill(self):
+        """为缺少向量的记录补齐嵌入，并清零已删除记录的向量"""
+        if not self.next_row:
+            return
+        norms = np.linalg.norm(self.vectors[:self.next_row], axis=1)
+        live = np.zeros(self.next_row, dtype=bool)
+        live[list(self.records)] = True
+        self.vectors[:self.next_row][~live & (norms > 0)] = 0
+        missing = np.flatnonzero(live & (norms == 0))
+        if len(missing):
+            print(f"正在为 {len(missing)} 条本地记忆生成向量...")
+            for row in missing:
+                vector = self._embed(self.records[int(row)]["content"])
+                if vector is not None:
+                    self.vectors[int(row)] = vector
+        self.vectors.flush()
+
+    def _embed(self, content):
+        """归一化的嵌入向量，失败时返回None（保留零向量，下次加载时补齐）"""
+        try:
+            vector = self.embedder.embed(content)
+        except Exception:
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else 0
+
+    def _append(self, op):
+        self.log.write(json.dumps(op, ensure_ascii=False) + "\n")
+        self.log.flush()
+
+    def add(self, role, content, timestamp):
+        """添加一条记录，返回行号"""
+        vector = self._embed(content)
+        with self.lock:
+            row = self.next_row
+            if row >= self.vectors.shape[0]:
+                self._open(self.vectors.shape[0] * 2)
+            self.next_row += 1
+            self.records[row] = {"role": role, "content": content, "timestamp": timestamp}
+            self._append({"op": "add", "row": row, "role": role, "content": content, "timestamp": timestamp})
+            if vector is not None:
+                self.vectors[row] = vector
+        return row
+
+    def update(self, row, content, timestamp):
+        vector = self._embed(content)
+        with self.lock:
+            if row not in self.records:
+                return
+            self.records[row].update(content=content, timestamp=timestamp)
+            self._append({"op": "update", "row": row, "content": content, "timestamp": timestamp})
+            self.vectors[row] = vector if vector is not None else 0
+
+    def delete(self, row):
+        with self.lock:
+            if self.records.pop(row, None) is None:
+                return
+            self._append({"op": "delete", "row": row})
+            self.vectors[row] = 0
+
+    def reset(self):
+        with self.lock:
+            # 清空操作日志，而不是追加一条reset记录
+            self.log.close()
+            self.log = open(self.records_path, "w", encoding="utf-8")
+            self.records.clear()
+            self.vectors[:self.next_row] = 0
+            self.next_row = 0
+
+    def search(self, query_vector, limit):
+        """余弦相似度 top-k，返回 [(行号, 分数, 内容)]，只包含分数不低于阈值的记录"""
+        norm = np.linalg.norm(query_vector)
+        if not norm:
+            return []
+        with self.lock:
+            if not self.records:
+                return []
+            scores = self.vectors[:self.next_row] @ (query_vector / norm)
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            # 哈希向量的分数与语义嵌入不可比，阈值分开配置
+            if isinstance(self.embedder, HashingEmbedder):
+                threshold = LOCAL_INDEX_CONFIG["hash_score_threshold"]
+            else:
+                threshold = RETRIEVAL_CONFIG["score_threshold"]
+            return [(int(row), float(scores[row]), self.records[int(row)]["content"]) for row in top
+                    if scores[row] >= threshold and int(row) in self.records]
+
+    def close(self):
+        with self.lock:
+            self.vectors.flush()
+            self.log.close()
+
+# ===================== 会话日志 =====================
+
+class SessionLog:
+    """追加写入的会话日志，按 (user_id, id) 索引，启动时只读取最近的若干条"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_session_messages_user ON session_messages (user_id, id)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def append(self, user_id, messages):
+        """追加一组消息"""
+        timestamp = datetime.now().isoformat()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO session_messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                [(user_id, msg["role"], msg["content"], timestamp) for msg in messages]
+            )
+
+    def tail(self, user_id, limit, after_id=0):
+        """读取 id 大于 after_id 的最近 limit 条消息，按时间顺序返回 (id, role, content, timestamp)"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM session_messages WHERE user_id=? AND id>? ORDER BY id DESC LIMIT ?",
+                (user_id, after_id, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def before(self, user_id, before_id, limit):
+        """读取 id 小于 before_id 的最近 limit 条消息，用于按需向前翻页"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM session_messages WHERE user_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (user_id, before_id, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def id_from_end(self, user_id, offset):
+        """倒数第 offset+1 条消息的 id"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM session_messages WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (user_id, offset)
+            ).fetchone()
+        return row[0] if row else 0
+
+# ===================== 后台记忆写入 =====================
+
+class MemoryWriter:
+    """后台记忆写入线程：将一轮对话的问答合并为一次 memory.add，并合并短时间内的连续多轮"""
+    def __init__(self, assistant):
+        self.assistant = assistant
+        self.queue = queue.Queue()
+        self.in_flight = 0
+        self.thread = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, user_id, question, answer):
+        """提交一轮对话，立即返回"""
+        self.queue.put((user_id, question, answer))
+
+    def pending(self):
+        """等待写入的对话轮数"""
+        return self.queue.qsize() + self.in_flight
+
+    def flush(self, timeout=None):
+        """等待已提交的对话全部写入"""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """写完已提交的对话后停止写入线程"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            flush_events = []
+            deadline = time.time() + MEMORY_WRITE_CONFIG["coalesce_delay"]
+            # 合并短时间内的后续对话，flush 请求或停止信号到达时立即写入
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    flush_events.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= MEMORY_WRITE_CONFIG["max_batch_turns"]:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+            self.in_flight = len(batch)
+            self._write(batch)
+            self.in_flight = 0
+            for event in flush_events:
+                event.set()
+
+    def _write(self, batch):
+        # 按用户分组，每个用户一次写入
+        by_user = OrderedDict()
+        for user_id, question, answer in batch:
+            by_user.setdefault(user_id, []).extend([
+                {"role": "user", "content": question},
+                {"role": "assistant", "content": answer},
+            ])
+        for user_id, messages in by_user.items():
+            try:
+                self.assistant.add_conversation(messages, user_id)
+            except Exception as e:
+                print(f"\n后台记忆写入失败: {str(e)}")
+
 class PersonalTravelAssistant:
-    def __init__(self, user_id):
-        """初始化个人助手"""
+    def __init__(self, user_id, background=True):
+        """初始化个人助手，background 为 True 时在后台线程初始化模型客户端和记忆后端"""
         # 先初始化所有基本属性，确保即使出错也能使用
         self.memory_store = {}
         self.use_memory = False
         self.user_id = user_id
         # 初始化消息历史
         self.messages = [SYSTEM_PROMPT]
-        
+        # 检索缓存和每轮延迟统计
+        self.embedding_cache = LRUCache(RETRIEVAL_CONFIG["embedding_cache_size"])
+        self.search_cache = LRUCache(RETRIEVAL_CONFIG["search_cache_size"])
+        self.turn_stats = deque(maxlen=RETRIEVAL_CONFIG["stats_window"])
+        self.memory_writer = None
+        self.memory_indexes = {}
+        self.access_stats = {}
+        self.local_indexes = {}
+        self.local_embedder = None
+        # 滚动摘要：新的对话增量合并进已有摘要，按用户持久化，启动时恢复
+        self.history_summary, self.summary_covered_id = self._load_summary(user_id)
+        # self.messages[1:] 中最早的 summary_covered 条消息已合并进摘要
+        self.summary_covered = 0
+        # 从本地会话日志恢复摘要之后的最近对话
+        self.session_log = None
+        self.oldest_loaded_id = None
+        self._restore_session(user_id)
+        self.history_lock = threading.Lock()
+        self.summary_lock = threading.Lock()
+        self.compacting = False
+        self.compaction_thread = None
+        # 未启用后台写入线程时，各轮记忆写回的任务
+        self.pending_writes = []
+        # 模型客户端和记忆后端在后台线程初始化，只有需要它们的操作才等待
+        self.client = None
+        self.memory = None
+        self.backend_ready = threading.Event()
+        self.startup_ms = None
+        if background:
+            threading.Thread(target=self._init_backend, args=(user_id,), name="backend-init", daemon=True).start()
+        else:
+            self._init_backend(user_id)
+
+    def _init_backend(self, user_id):
+        """导入并初始化OpenAI客户端和mem0记忆系统，失败时启用本地存储"""
         try:
-            # 创建OpenAI客户端
-            self.client = OpenAI(
-                api_key=API_CONFIG["llm_api_key"],
-                base_url=API_CONFIG["llm_base_url"],
-            )
+            # 使用进程内共享的OpenAI客户端
+            self.client = get_llm_client()
             
-            # 获取用户特定的向量存储配置
+            # 获取用户特定的向量存储配置，共享布局下先确保租户索引存在
             vector_config = get_vector_store_config(user_id)
+            if STORAGE_CONFIG["collection_layout"] == "shared":
+                ensure_shared_collection()
             
-            # 初始化mem0记忆系统
-            self.memory = Memory.from_config(vector_config)
+            # 初始化mem0记忆系统，嵌入模型、LLM和Qdrant连接与其他用户的实例共享
+            self.memory = create_memory(vector_config)
             self.use_memory = True
-            print(f"成功初始化mem0记忆系统 (使用向量数据库)")
+            self._install_embedding_cache()
+            if MEMORY_WRITE_CONFIG["background"]:
+                self.memory_writer = MemoryWriter(self)
+            print(f"\n成功初始化mem0记忆系统 (使用向量数据库)")
             print(f"记忆存储位置: {vector_config['vector_store']['config']['collection_name']}")
             
         except Exception as e:
             error_msg = str(e)
-            print(f"初始化mem0失败: {error_msg}")
+            print(f"\n初始化mem0失败: {error_msg}")
             self._handle_initialization_error(error_msg)
+            self._init_local_index(user_id)
+            if self.local_embedder is None and self.session_log is not None:
+                # 没有本地向量索引时，用会话日志恢复简单内存存储
+                rows = self.session_log.tail(user_id, LIMIT_CONFIG["max_memory_items"])
+                self.memory_store[user_id] = [{"role": role, "content": content, "timestamp": timestamp}
+                                              for _, role, content, timestamp in rows]
+        finally:
+            self.backend_ready.set()
+
+    def wait_backend(self):
+        """等待后台初始化完成"""
+        if not self.backend_ready.wait(0.2):
+            print("等待记忆系统初始化...", flush=True)
+            self.backend_ready.wait()
     
     def _handle_initialization_error(self, error_msg):
         """处理初始化错误"""
@@ -229,56 +1161,465 @@ class PersonalTravelAssistant:
         
         self.use_memory = False
         # 继续使用简单内存存储和基本会话历史
+
+    def _init_local_index(self, user_id):
+        """mem0不可用时启用本地向量索引，并从本地文件恢复记忆"""
+        global np
+        if not LOCAL_INDEX_CONFIG["enabled"]:
+            return
+        if np is None:
+            try:
+                import numpy
+            except ImportError:  # 没有numpy时离线模式按时间返回最近记忆
+                return
+            np = numpy
+        try:
+            try:
+                self.local_embedder = OllamaEmbedder(STORAGE_CONFIG["embedder"]["ollama_base_url"], STORAGE_CONFIG["embedder"]["model"],
+                                                     LOCAL_INDEX_CONFIG["ollama_timeout"], kind="ollama")
+            except Exception:
+                self.local_embedder = HashingEmbedder(LOCAL_INDEX_CONFIG["hash_dims"], normalize_query, kind="hash")
+            index = self._local_index(user_id)
+            print(f"使用本地向量索引 (嵌入: {self.local_embedder.kind}, 已有 {len(index)} 条记忆)")
+        except Exception as e:
+            print(f"本地向量索引初始化失败: {str(e)}")
+            self.local_embedder = None
+
+    def _local_index(self, user_id):
+        """获取用户的本地向量索引，未启用时返回None"""
+        if self.local_embedder is None:
+            return None
+        index = self.local_indexes.get(user_id)
+        if index is None:
+            directory = os.path.join(os.path.expanduser(STORAGE_CONFIG["data_dir"]), f"local_index_{user_id}")
+            index = LocalVectorIndex(directory, self.local_embedder)
+            self.local_indexes[user_id] = index
+            # 本地索引就是离线模式下的记忆存储
+            with index.lock:
+                self.memory_store[user_id] = [dict(record, row=row) for row, record in index.records.items()]
+        return index
+
+    def _store_locally(self, user_id, role, content, timestamp):
+        """写入简单内存存储；启用本地向量索引时同时写入索引且不限制条数"""
+        store = self.memory_store.setdefault(user_id, [])
+        entry = {"role": role, "content": content, "timestamp": timestamp}
+        index = self._local_index(user_id)
+        if index is not None:
+            entry["row"] = index.add(role, content, timestamp)
+        store.append(entry)
+        # 控制记忆数量
+        if index is None and len(store) > LIMIT_CONFIG["max_memory_items"]:
+            self.memory_store[user_id] = store[-LIMIT_CONFIG["max_memory_items"]:]
+
+    def _restore_session(self, user_id):
+        """从本地会话日志恢复最近的对话（已合并进摘要的部分不再恢复）"""
+        try:
+            path = os.path.join(os.path.expanduser(STORAGE_CONFIG["data_dir"]), SESSION_CONFIG["db_file"])
+            self.session_log = SessionLog(path)
+            rows = self.session_log.tail(user_id, SESSION_CONFIG["restore_messages"], after_id=self.summary_covered_id)
+        except Exception as e:
+            print(f"会话日志不可用: {str(e)}")
+            self.session_log = None
+            return
+        self.messages.extend({"role": role, "content": content} for _, role, content, _ in rows)
+        # 首条恢复的消息之前的记录可通过 /older 按需加载
+        self.oldest_loaded_id = rows[0][0] if rows else None
+        if rows:
+            print(f"已恢复最近 {len(rows)} 条会话记录")
+
+    def load_older_messages(self, user_id, limit=None):
+        """按需从会话日志加载更早的消息（只用于查看，不加入请求上下文）"""
+        if self.session_log is None:
+            return []
+        limit = limit or SESSION_CONFIG["older_page_size"]
+        before_id = self.oldest_loaded_id if self.oldest_loaded_id is not None else 2 ** 63 - 1
+        rows = self.session_log.before(user_id, before_id, limit)
+        if rows:
+            self.oldest_loaded_id = rows[0][0]
+        return [(timestamp, role, content) for _, role, content, timestamp in rows]
+
+    def _install_embedding_cache(self):
+        """为mem0的嵌入模型加上LRU缓存，相同的查询不再重复请求Ollama"""
+        embedder = getattr(self.memory, "embedding_model", None)
+        if embedder is None:
+            return
+        # 共享的嵌入模型只包装一次，各实例共用同一个缓存
+        shared_cache = getattr(embedder, "embedding_cache", None)
+        if shared_cache is not None:
+            self.embedding_cache = shared_cache
+            return
+        embedder.embedding_cache = self.embedding_cache
+        embed = embedder.embed
+        cache = self.embedding_cache
+
+        def cached_embed(text, *args, **kwargs):
+            key = (normalize_query(text), args, tuple(sorted(kwargs.items())))
+            vector = cache.get(key)
+            if vector is None:
+                vector = embed(text, *args, **kwargs)
+                cache.put(key, vector)
+            return vector
+
+        embedder.embed = cached_embed
+
+    def _retrieval_limit(self, question):
+        """根据输入的信息量决定检索条数，寒暄和过短的输入减少或跳过检索"""
+        normalized = normalize_query(question)
+        if not normalized or normalized in RETRIEVAL_CONFIG["skip_phrases"]:
+            return 0
+        if len(normalized) < RETRIEVAL_CONFIG["min_query_length"]:
+            return RETRIEVAL_CONFIG["short_query_results"]
+        return LIMIT_CONFIG["max_search_results"]
     
 
     def ask_question(self, question, user_id):
         """处理用户问题并返回回答"""
         try:
-            # 获取相关记忆
-            related_memories = self.search_memories(question, user_id=user_id)
-            
-            # 构建带有记忆上下文的提示
-            if related_memories:
-                memory_context = "\n".join([f"- {mem}" for mem in related_memories])
-                prompt = f"用户问题: {question}\n\n以下是与该问题相关的历史信息:\n{memory_context}"
-            else:
-                prompt = question
-                
-            # 添加用户消息
-            self.messages.append({"role": "user", "content": prompt})
-            
-            # 生成回答
-            response = self.client.chat.completions.create(
-                model=API_CONFIG["llm_model"],
-                messages=self.messages,
-                stream=True  # 启用流式输出
-            )
-            
             answer = ""
-            for chunk in response:
-                if chunk.choices[0].delta.content is not None:
+            for content in self.stream_answer(question, user_id):
+                print(content, end="", flush=True)  # 直接打印内容
+                answer += content
+            return answer
+            
+        except Exception as e:
+            return f"抱歉，处理您的问题时出现错误: {str(e)}"
+
+    def stream_answer(self, question, user_id):
+        """流式生成回答，逐段返回内容；在共享事件循环中运行 astream_answer，中途放弃时取消生成"""
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for content in self.astream_answer(question, user_id):
+                    chunks.put(content)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(None)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    async def astream_answer(self, question, user_id):
+        """异步对话流水线：检索相关记忆与组装最近历史并行，提示就绪后立即开始流式生成
+
+        上一轮的记忆写回在后台进行，与本轮的检索和生成重叠；完整读完后才写入历史和记忆。
+        """
+        loop = asyncio.get_running_loop()
+        if not self.backend_ready.is_set():
+            await loop.run_in_executor(None, self.wait_backend)
+        started = time.perf_counter()
+        # 获取相关记忆（低信息量的输入减少或跳过检索），同时组装摘要和最近对话
+        limit = self._retrieval_limit(question)
+        retrieval = loop.run_in_executor(None, self.search_memories, question, user_id, limit) if limit else None
+        history = loop.run_in_executor(None, self._locked_history_candidates)
+        related_memories = await retrieval if retrieval is not None else []
+        system_messages, candidates = await history
+        retrieval_time = time.perf_counter() - started
+        
+        # 按token预算组装请求消息（记忆只注入本轮请求，不写入历史）
+        request_messages, prompt_tokens, memory_count = self._compose_context(question, related_memories, system_messages, candidates)
+        
+        # 生成回答（模型请求的首个内容耗时和总耗时计入 metrics.py 的指标）
+        model = API_CONFIG["llm_model"]
+        llm_started = time.perf_counter()
+        try:
+            response = await self._create_stream(request_messages)
+        except asyncio.CancelledError:
+            metrics.observe_llm("assistant", model, llm_started, status="cancelled")
+            raise
+        except Exception:
+            metrics.observe_llm("assistant", model, llm_started, status="error")
+            raise
+        
+        answer = ""
+        first_token_time = None
+        usage = None
+        llm_status = "error"
+        try:
+            async for chunk in response:
+                # usage 只出现在最后一个chunk（其 choices 为空）
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter() - started
                     content = chunk.choices[0].delta.content
-                    print(content, end="", flush=True)  # 直接打印内容
                     answer += content
-            
-            # 添加助手回答到历史
-            self.messages.append({"role": "assistant", "content": answer})
-            
-            # 控制消息历史长度，保留系统消息和最近的消息
-            if len(self.messages) > LIMIT_CONFIG["max_history_length"]:
-                self.messages = [self.messages[0]] + self.messages[-(LIMIT_CONFIG["max_history_length"]-1):]
-            
-            # 存储到记忆系统
+                    yield content
+            llm_status = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            # 客户端断开时共享事件循环中的任务收到 CancelledError，直接关闭生成器时为 GeneratorExit
+            llm_status = "cancelled"
+            raise
+        finally:
+            metrics.observe_llm("assistant", model, llm_started,
+                                started + first_token_time if first_token_time is not None else None, llm_status)
+            # 中途取消时关闭连接
+            close = getattr(response, "close", None)
+            if close is not None:
+                await close()
+        
+        cached = record_usage("assistant", request_messages, usage) if usage is not None else None
+        self._record_turn_stats(retrieval_time, first_token_time, time.perf_counter() - started, memory_count, prompt_tokens, cached)
+        
+        # 添加本轮问答到历史并写入会话日志，超出预算时在后台把早期对话合并进摘要
+        turn = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        await loop.run_in_executor(None, self._append_turn, user_id, turn)
+        self._schedule_compaction()
+        
+        # 存储到记忆系统，与下一轮的检索和生成并行写入
+        if self.memory_writer is not None:
+            self.memory_writer.submit(user_id, question, answer)
+        else:
+            self.pending_writes = [f for f in self.pending_writes if not f.done()]
+            self.pending_writes.append(get_io_executor().submit(self._write_turn, user_id, question, answer))
+
+    async def _create_stream(self, request_messages):
+        """发起流式请求，接口支持时在流末尾返回token用量（含命中前缀缓存的token数）"""
+        global _stream_usage_supported
+        request = dict(model=API_CONFIG["llm_model"], messages=request_messages, stream=True)
+        if _stream_usage_supported:
+            try:
+                return await get_async_llm_client().chat.completions.create(
+                    stream_options={"include_usage": True}, **request)
+            except Exception as e:
+                if "stream_options" not in str(e):
+                    raise
+                _stream_usage_supported = False
+        return await get_async_llm_client().chat.completions.create(**request)
+
+    def _append_turn(self, user_id, turn):
+        with self.history_lock:
+            self.messages.extend(turn)
+            self._log_messages(user_id, turn)
+
+    def _write_turn(self, user_id, question, answer):
+        try:
             self.add_memory(question, user_id)
             self.add_memory(answer, user_id, is_assistant=True)
-            
-            return answer
-            
         except Exception as e:
-            return f"抱歉，处理您的问题时出现错误: {str(e)}"
+            print(f"\n记忆写入失败: {str(e)}")
+
+    def close(self):
+        """释放实例：等待后台摘要合并和记忆写入完成并停止写入线程（服务模式淘汰实例时调用）"""
+        self.backend_ready.wait()
+        thread = self.compaction_thread
+        if thread is not None:
+            thread.join()
+        if self.memory_writer is not None:
+            self.memory_writer.close(MEMORY_WRITE_CONFIG["flush_timeout"])
+        else:
+            self.flush_memories(MEMORY_WRITE_CONFIG["flush_timeout"])
+        self.save_access_stats()
+
+    def _log_messages(self, user_id, messages):
+        """写入会话日志，失败时不影响对话"""
+        if self.session_log is None:
+            return
+        try:
+            self.session_log.append(user_id, messages)
+        except Exception as e:
+            print(f"\n写入会话日志失败: {str(e)}")
+
+    def build_context(self, question, related_memories):
+        """按token预算组装请求消息：系统提示 + 历史摘要 + 最近对话 + 带相关记忆的当前问题
+
+        返回 (消息列表, 提示token数, 注入的记忆条数)
+        """
+        return self._compose_context(question, related_memories, *self._history_candidates())
+
+    def _locked_history_candidates(self):
+        with self.history_lock:
+            return self._history_candidates()
+
+    def _history_candidates(self):
+        """系统提示（含摘要）和从最新开始倒序的候选历史消息及其token数，与记忆检索无关，可提前组装"""
+        system_messages = [SYSTEM_PROMPT]
+        if self.history_summary:
+            system_messages.append({"role": "system", "content": f"之前对话的摘要:\n{self.history_summary}"})
+        budget = CONTEXT_CONFIG["max_context_tokens"] - count_message_tokens(system_messages)
+        candidates = []
+        # 已合并进摘要的消息（/summary 合并全部历史后仍留在 self.messages 中）不再原样发送
+        for message in reversed(self.messages[1 + self.summary_covered:]):
+            cost = count_tokens(message["content"]) + 4
+            if cost > budget:
+                break
+            candidates.append((message, cost))
+            budget -= cost
+        return system_messages, candidates
+
+    def _compose_context(self, question, related_memories, system_messages, candidates):
+        """用检索到的记忆和预先组装的候选历史拼出最终请求消息"""
+        # 按相关性顺序注入记忆，直到用完记忆预算
+        memory_lines = []
+        memory_budget = CONTEXT_CONFIG["memory_tokens"]
+        for mem in related_memories:
+            line = f"- {mem}"
+            cost = count_tokens(line) + 1
+            if cost > memory_budget:
+                break
+            memory_lines.append(line)
+            memory_budget -= cost
+
+        if memory_lines:
+            memory_context = "\n".join(memory_lines)
+            prompt = f"用户问题: {question}\n\n以下是与该问题相关的历史信息:\n{memory_context}"
+        else:
+            prompt = question
+        current = {"role": "user", "content": prompt}
+
+        # 从最新的对话开始倒序保留，直到用完剩余预算
+        used = count_message_tokens(system_messages + [current])
+        recent = []
+        for message, cost in candidates:
+            if used + cost > CONTEXT_CONFIG["max_context_tokens"]:
+                break
+            recent.append((message, cost))
+            used += cost
+        recent.reverse()
+        # 不以助手消息开头，避免截断后的上下文缺少对应的问题
+        while recent and recent[0][0]["role"] == "assistant":
+            used -= recent.pop(0)[1]
+        recent = [message for message, _ in recent]
+
+        # 系统提示和摘要在前、历史按顺序在中间，带记忆的本轮问题在最后，前面部分可命中前缀缓存
+        return build_messages(system_messages, prompt, recent), used, len(memory_lines)
+
+    def _schedule_compaction(self):
+        """历史对话超出预算时在后台线程合并进摘要，不阻塞提示符"""
+        with self.history_lock:
+            if self.compacting:
+                return
+            history = self.messages[1:]
+            if (count_message_tokens(history) <= CONTEXT_CONFIG["history_tokens"]
+                    and len(self.messages) <= LIMIT_CONFIG["max_history_length"]):
+                return
+            self.compacting = True
+        self.compaction_thread = threading.Thread(target=self._compact_history, name="history-compaction", daemon=True)
+        self.compaction_thread.start()
+
+    def _compact_history(self):
+        """把最早的一批对话移出历史；尚未合并进摘要的部分先增量合并，而不是直接丢弃"""
+        try:
+            with self.history_lock:
+                history = self.messages[1:]
+                cut = CONTEXT_CONFIG["summarize_batch"]
+                while cut < len(history) and (count_message_tokens(history[cut:]) > CONTEXT_CONFIG["history_tokens"]
+                                              or len(history) - cut >= LIMIT_CONFIG["max_history_length"]):
+                    cut += 2
+                # 至少保留最近一轮对话
+                cut = min(cut, len(history) - 2)
+            if cut > 0:
+                self._fold_history(self.user_id, cut)
+        finally:
+            self.compacting = False
+
+    def _fold_history(self, user_id, cut=None):
+        """把尚未合并的对话增量合并进滚动摘要并持久化
+
+        cut 为 None 时合并全部历史；否则只合并到第 cut 条，并随后把这 cut 条移出历史。
+        返回是否成功合并。
+        """
+        with self.summary_lock:
+            with self.history_lock:
+                history = self.messages[1:]
+                end = len(history) if cut is None else cut
+                delta = history[self.summary_covered:end]
+                previous_summary = self.history_summary
+
+            # 生成摘要期间不持有历史锁，新一轮对话仍可使用完整历史
+            summary = self._fold_into_summary(previous_summary, delta) if delta else previous_summary
+
+            with self.history_lock:
+                if summary is not None:
+                    self.history_summary = summary
+                    self.summary_covered = max(self.summary_covered, end)
+                    # 历史与会话日志末尾一一对应，记录摘要覆盖到的日志位置，重启时从其后恢复
+                    if delta and self.session_log is not None:
+                        try:
+                            self.summary_covered_id = self.session_log.id_from_end(user_id, len(self.messages) - 1 - end)
+                        except Exception:
+                            pass
+                if cut is not None:
+                    # 期间只会在末尾追加消息，最早的 cut 条仍是本次处理的消息
+                    self.messages = [self.messages[0]] + self.messages[1 + cut:]
+                    self.summary_covered = max(0, self.summary_covered - cut)
+            if summary is not None and delta:
+                self._save_summary(user_id)
+            return summary is not None
+
+    def _summary_path(self, user_id):
+        return os.path.join(os.path.expanduser(STORAGE_CONFIG["data_dir"]), f"summary_{user_id}.json")
+
+    def _load_summary(self, user_id):
+        """读取持久化的滚动摘要，返回 (摘要, 覆盖到的会话日志id)"""
+        try:
+            with open(self._summary_path(user_id), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state.get("summary", ""), state.get("covered_id", 0)
+        except (FileNotFoundError, ValueError):
+            return "", 0
+
+    def _save_summary(self, user_id):
+        path = self._summary_path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "summary": self.history_summary,
+                "covered_id": self.summary_covered_id,
+                "updated_at": datetime.now().isoformat(),
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _fold_into_summary(self, previous_summary, messages):
+        """把新的一批对话合并进已有摘要，失败时返回None"""
+        conversation = "\n".join(f"[{msg['role']}]: {msg['content']}" for msg in messages)
+        instruction = (f"请把用户给出的新对话合并进已有摘要，保留用户的偏好、关键事实和未完成的事项，"
+                       f"输出更新后的摘要（{LIMIT_CONFIG['max_summary_length']}字以内）。")
+        prompt = f"已有摘要:\n{previous_summary or '（无）'}\n\n新对话:\n{conversation}"
+        try:
+            response = self.client.chat.completions.create(
+                model=API_CONFIG["llm_model"],
+                messages=build_messages(instruction, prompt),
+                temperature=0.3,
+                max_tokens=1000
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"\n合并历史摘要失败: {str(e)}")
+            return None
+
+    def _record_turn_stats(self, retrieval_time, first_token_time, total_time, memory_count, prompt_tokens=None, cached_tokens=None):
+        """记录每轮的检索耗时、首个token延迟、请求大小和命中前缀缓存的token数"""
+        stats = {
+            "retrieval_ms": retrieval_time * 1000,
+            "first_token_ms": first_token_time * 1000 if first_token_time is not None else None,
+            "total_ms": total_time * 1000,
+            "memories": memory_count,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+        }
+        self.turn_stats.append(stats)
+        if RETRIEVAL_CONFIG["show_latency"]:
+            first_token = f"{stats['first_token_ms']:.0f}ms" if stats["first_token_ms"] is not None else "N/A"
+            cached = f" (缓存命中 {cached_tokens})" if cached_tokens is not None else ""
+            print(f"\n[检索 {stats['retrieval_ms']:.0f}ms | 首个token {first_token} | 注入记忆 {memory_count} 条 | 提示 {prompt_tokens} tokens{cached}]")
     
-    def add_memory(self, content, user_id, is_assistant=False):
-        """将内容添加到记忆系统"""
+    def add_memory(self, content, user_id, is_assistant=False, kind=None):
+        """将内容添加到记忆系统，kind 标记特殊记忆（如 "summary"），整理时只保留最新的一条"""
+        self.wait_backend()
+        # 记忆变更后搜索结果缓存失效
+        self.search_cache.clear()
         try:
             current_time = datetime.now().isoformat()
             if self.use_memory:
@@ -290,7 +1631,11 @@ class PersonalTravelAssistant:
                 try:
                     # 添加错误处理以捕获XAI API不兼容问题
                     try:
-                        result = self.memory.add(message, user_id=user_id, metadata={"role": role, "timestamp": current_time})
+                        metadata = {"role": role, "timestamp": current_time}
+                        if kind:
+                            metadata["kind"] = kind
+                        result = self.memory.add(message, user_id=user_id, metadata=metadata)
+                        self._apply_index_events(user_id, result)
                         # 调试信息
                         # print(f"记忆添加成功: [角色: {role}] - {content[:LIMIT_CONFIG['preview_text_length']]}..." if len(content) > LIMIT_CONFIG['preview_text_length'] else f"记忆添加成功: [角色: {role}] - {content}")
                     except TypeError as api_error:
@@ -311,19 +1656,8 @@ class PersonalTravelAssistant:
                         "timestamp": current_time
                     })
             else:
-                # 使用简单的内存存储
-                if user_id not in self.memory_store:
-                    self.memory_store[user_id] = []
-                
-                self.memory_store[user_id].append({
-                    "role": "assistant" if is_assistant else "user",
-                    "content": content,
-                    "timestamp": current_time
-                })
-                
-                # 控制记忆数量
-                if len(self.memory_store[user_id]) > LIMIT_CONFIG["max_memory_items"]:
-                    self.memory_store[user_id] = self.memory_store[user_id][-LIMIT_CONFIG["max_memory_items"]:]
+                # 使用简单的内存存储（启用时同时写入本地向量索引）
+                self._store_locally(user_id, "assistant" if is_assistant else "user", content, current_time)
                 
         except Exception as e:
             print(f"添加记忆时出错: {str(e)}")
@@ -337,36 +1671,73 @@ class PersonalTravelAssistant:
                 "timestamp": current_time
             })
     
+    def add_conversation(self, messages, user_id):
+        """将多条对话消息一次性添加到记忆系统"""
+        self.search_cache.clear()
+        current_time = datetime.now().isoformat()
+        if self.use_memory:
+            try:
+                result = self.memory.add(messages, user_id=user_id, metadata={"role": "conversation", "timestamp": current_time})
+                self._apply_index_events(user_id, result)
+                # 写入期间可能有新的检索结果被缓存
+                self.search_cache.clear()
+                return
+            except Exception as mem_error:
+                print(f"记忆添加失败: {str(mem_error)}")
+        # 回退到简单存储
+        for message in messages:
+            self._store_locally(user_id, message["role"], message["content"], current_time)
+
+    def flush_memories(self, timeout=None):
+        """等待后台记忆写入完成"""
+        if self.memory_writer is None:
+            return not wait_futures(self.pending_writes, timeout).not_done
+        return self.memory_writer.flush(timeout)
+
+    def get_memory_index(self, user_id, refresh=False):
+        """获取用户的记忆编号索引，本地没有索引（或要求刷新）时从向量库重建"""
+        index = self.memory_indexes.get(user_id)
+        if index is None:
+            index = MemoryIndex(self._memory_index_path(user_id))
+            self.memory_indexes[user_id] = index
+        if refresh or not index.loaded:
+            memories = self.memory.get_all(user_id=user_id, limit=LIMIT_CONFIG["index_rebuild_limit"])
+            if isinstance(memories, dict):
+                memories = memories.get('results', [])
+            index.rebuild(memories)
+        return index
+
+    def get_access_stats(self, user_id):
+        """获取用户记忆的命中统计"""
+        stats = self.access_stats.get(user_id)
+        if stats is None:
+            path = os.path.join(os.path.expanduser(STORAGE_CONFIG["data_dir"]), f"memory_access_{user_id}.json")
+            stats = self.access_stats.setdefault(user_id, AccessStats(path))
+        return stats
+
+    def save_access_stats(self):
+        for stats in list(self.access_stats.values()):
+            try:
+                stats.save()
+            except Exception as e:
+                print(f"保存记忆命中统计失败: {str(e)}")
+
+    def _memory_index_path(self, user_id):
+        return os.path.join(os.path.expanduser(STORAGE_CONFIG["data_dir"]), f"memory_index_{user_id}.json")
+
+    def _apply_index_events(self, user_id, result):
+        """将 memory.add 的结果同步到已加载的索引，未建立索引时留待首次使用时重建"""
+        index = self.memory_indexes.get(user_id)
+        if index is not None and index.loaded:
+            index.apply_events(result)
+
     def get_all_memories(self, user_id):
         """获取指定用户的所有记忆"""
+        self.wait_backend()
         try:
             if self.use_memory:
-                memories = self.memory.get_all(user_id=user_id)
-                # 处理返回结果的结构，适应mem0的API变化
-                result_list = []
-                if isinstance(memories, dict) and 'results' in memories:
-                    for mem in memories['results']:
-                        if isinstance(mem, dict) and 'text' in mem:
-                            result_list.append(mem['text'])
-                        elif isinstance(mem, dict) and 'memory' in mem:
-                            result_list.append(mem['memory'])
-                        else:
-                            # 尝试将整个对象转换为字符串
-                            result_list.append(str(mem))
-                elif isinstance(memories, list):
-                    for mem in memories:
-                        if isinstance(mem, dict):
-                            if 'text' in mem:
-                                result_list.append(mem['text'])
-                            elif 'memory' in mem:
-                                result_list.append(mem['memory'])
-                            else:
-                                # 将字典内容格式化为字符串
-                                result_list.append(str(mem))
-                        else:
-                            result_list.append(str(mem))
-                
-                return result_list
+                # 从本地编号索引读取，编号与 /update、/delete 一致
+                return [entry['memory'] for entry in self.get_memory_index(user_id).entries]
             else:
                 if user_id not in self.memory_store:
                     return []
@@ -379,14 +1750,29 @@ class PersonalTravelAssistant:
     
     def search_memories(self, query, user_id, limit=None):
         """搜索与查询相关的记忆"""
+        self.wait_backend()
         limit = limit or LIMIT_CONFIG["max_search_results"]
         try:
             if self.use_memory:
+                cache_key = (user_id, normalize_query(query), limit)
+                cached = self.search_cache.get(cache_key)
+                if cached is not None:
+                    texts, ids = cached
+                    self.get_access_stats(user_id).record(ids)
+                    return list(texts)
+
                 memories = self.memory.search(query=query, user_id=user_id, limit=limit)
+                threshold = RETRIEVAL_CONFIG["score_threshold"]
                 # 处理返回结果的结构，适应mem0的API变化
                 result_list = []
+                hit_ids = []
                 if isinstance(memories, dict) and 'results' in memories:
                     for mem in memories['results']:
+                        # 过滤相似度低于阈值的记忆
+                        if isinstance(mem, dict) and mem.get('score') is not None and mem['score'] < threshold:
+                            continue
+                        if isinstance(mem, dict) and 'id' in mem:
+                            hit_ids.append(mem['id'])
                         if isinstance(mem, dict) and 'text' in mem:
                             result_list.append(mem['text'])
                         elif isinstance(mem, dict) and 'memory' in mem:
@@ -397,6 +1783,10 @@ class PersonalTravelAssistant:
                 elif isinstance(memories, list):
                     for mem in memories:
                         if isinstance(mem, dict):
+                            if mem.get('score') is not None and mem['score'] < threshold:
+                                continue
+                            if 'id' in mem:
+                                hit_ids.append(mem['id'])
                             if 'text' in mem:
                                 result_list.append(mem['text']) 
                             elif 'memory' in mem:
@@ -407,8 +1797,20 @@ class PersonalTravelAssistant:
                         else:
                             result_list.append(str(mem))
                 
+                self.search_cache.put(cache_key, (tuple(result_list), tuple(hit_ids)))
+                self.get_access_stats(user_id).record(hit_ids)
                 return result_list
             else:
+                # 本地向量索引的语义检索
+                index = self._local_index(user_id)
+                if index is not None:
+                    normalized = normalize_query(query)
+                    query_vector = self.embedding_cache.get(("local", normalized))
+                    if query_vector is None:
+                        query_vector = self.local_embedder.embed(query)
+                        self.embedding_cache.put(("local", normalized), query_vector)
+                    return [content for _, _, content in index.search(query_vector, limit)]
+
                 # 简单的相似度查询实现
                 if user_id not in self.memory_store or not self.memory_store[user_id]:
                     return []
@@ -422,81 +1824,60 @@ class PersonalTravelAssistant:
             return []
     
     def generate_summary(self, user_id):
-        """为用户的对话生成总结"""
-        # 获取所有记忆
-        memories = self.get_all_memories(user_id)
-        
-        # 优先使用内存存储中的记忆，如果内存存储也没有记忆，就使用会话历史
-        if len(memories) < 2 and hasattr(self, 'memory_store') and user_id in self.memory_store:
-            memories = [f"[{mem['role']}]: {mem['content']}" for mem in self.memory_store[user_id]]
-        
-        # 如果记忆仍然不足，使用会话历史
-        if len(memories) < 2 and len(self.messages) > 1:
-            # 从会话历史中提取对话内容，跳过系统消息
-            memories = []
-            for i in range(1, len(self.messages)):
-                msg = self.messages[i]
-                memories.append(f"[{msg['role']}]: {msg['content']}")
-        
-        # 检查是否有足够的内容生成总结
-        if len(memories) < 2:  # 修改为至少需要2条记忆
-            return "对话太短，无需总结。"
-        
-        try:
-            # 构建总结提示
-            summary_prompt = f"请总结以下对话的主要内容（{LIMIT_CONFIG['max_summary_length']}字以内）：\n\n{memories}"
-            
-            # 请求模型生成总结
-            response = self.client.chat.completions.create(
-                model=API_CONFIG["llm_model"],
-                messages=[{"role": "user", "content": summary_prompt}],
-                temperature=0.5,
-                max_tokens=300
-            )
-            
-            summary = response.choices[0].message.content
-            
-            # 将总结添加到记忆
-            self.add_memory(f"对话总结: {summary}", user_id, is_assistant=True)
-            
-            return summary
-            
-        except Exception as e:
-            error_msg = str(e)
-            print(f"生成总结时出错: {error_msg}")
-            
-            # 尝试使用简单总结方法
-            try:
-                # 提取关键词和主题
+        """为用户的对话生成总结：只把上次总结之后的新对话合并进滚动摘要"""
+        self.wait_backend()
+        with self.history_lock:
+            pending = len(self.messages) - 1 - self.summary_covered
+            has_summary = bool(self.history_summary)
+
+        # 还没有摘要且本次会话太短时，用已有记忆初始化一次摘要
+        if not has_summary and pending < 2:
+            memories = self.get_all_memories(user_id)
+            if len(memories) < 2:  # 修改为至少需要2条记忆
+                return "对话太短，无需总结。"
+            seed = [{"role": "memory", "content": mem} for mem in memories[-LIMIT_CONFIG["max_memory_items"]:]]
+            summary = self._fold_into_summary("", seed)
+            if summary is None:
                 all_content = " ".join(memories)
-                simple_summary = f"讨论了关于{all_content[:LIMIT_CONFIG['max_summary_length']]}...等话题。"
-                return simple_summary
-            except:
-                return f"生成总结时出错: {error_msg}"
+                return f"讨论了关于{all_content[:LIMIT_CONFIG['max_summary_length']]}...等话题。"
+            with self.history_lock:
+                self.history_summary = summary
+            self._save_summary(user_id)
+        elif pending == 0:
+            # 上次总结后没有新对话
+            return self.history_summary
+        elif not self._fold_history(user_id):
+            # 合并失败时使用简单总结方法
+            with self.history_lock:
+                delta = self.messages[1 + self.summary_covered:]
+            all_content = " ".join(msg["content"] for msg in delta)
+            if self.history_summary:
+                return self.history_summary
+            return f"讨论了关于{all_content[:LIMIT_CONFIG['max_summary_length']]}...等话题。"
+
+        summary = self.history_summary
+        # 将总结添加到记忆
+        self.add_memory(f"对话总结: {summary}", user_id, is_assistant=True, kind="summary")
+        return summary
 
     def update_memory(self, memory_id, new_content, user_id):
         """更新指定ID的记忆内容"""
+        self.wait_backend()
+        self.search_cache.clear()
         try:
             if self.use_memory:
-                # 获取所有记忆
-                memories = self.memory.get_all(user_id=user_id)
-                
-                # 检查记忆ID是否有效
-                if not isinstance(memories, dict) or 'results' not in memories or len(memories['results']) <= memory_id - 1:
+                # 从编号索引获取记忆的内部ID
+                index = self.get_memory_index(user_id)
+                memory_item = index.get(memory_id)
+                if memory_item is None:
                     return f"无效的记忆ID: {memory_id}"
                 
-                # 获取记忆的唯一标识符（内部ID）
-                memory_item = memories['results'][memory_id - 1]
-                if 'id' not in memory_item:
-                    return "无法更新记忆，缺少内部ID"
-                
-                internal_id = memory_item['id']
-                
                 # 更新记忆
                 self.memory.update(
-                    memory_id=internal_id,
+                    memory_id=memory_item['id'],
                     memory=[{"role": "user", "content": new_content}]
                 )
+                index.update(memory_id, new_content)
                 
                 return f"已更新记忆 #{memory_id}"
             else:
@@ -505,8 +1886,12 @@ class PersonalTravelAssistant:
                     return f"无效的记忆ID: {memory_id}"
                 
                 # 更新记忆
-                self.memory_store[user_id][memory_id - 1]["content"] = new_content
-                self.memory_store[user_id][memory_id - 1]["timestamp"] = datetime.now().isoformat()
+                entry = self.memory_store[user_id][memory_id - 1]
+                entry["content"] = new_content
+                entry["timestamp"] = datetime.now().isoformat()
+                index = self._local_index(user_id)
+                if index is not None and "row" in entry:
+                    index.update(entry["row"], new_content, entry["timestamp"])
                 
                 return f"已更新记忆 #{memory_id}"
                 
@@ -515,24 +1900,19 @@ class PersonalTravelAssistant:
     
     def delete_memory(self, memory_id, user_id):
         """删除指定ID的记忆"""
+        self.wait_backend()
+        self.search_cache.clear()
         try:
             if self.use_memory:
-                # 获取所有记忆
-                memories = self.memory.get_all(user_id=user_id)
-                
-                # 检查记忆ID是否有效
-                if not isinstance(memories, dict) or 'results' not in memories or len(memories['results']) <= memory_id - 1:
+                # 从编号索引获取记忆的内部ID
+                index = self.get_memory_index(user_id)
+                memory_item = index.get(memory_id)
+                if memory_item is None:
                     return f"无效的记忆ID: {memory_id}"
                 
-                # 获取记忆的唯一标识符（内部ID）
-                memory_item = memories['results'][memory_id - 1]
-                if 'id' not in memory_item:
-                    return "无法删除记忆，缺少内部ID"
-                
-                internal_id = memory_item['id']
-                
                 # 删除记忆
-                self.memory.delete(memory_id=internal_id)
+                self.memory.delete(memory_id=memory_item['id'])
+                index.remove(memory_id)
                 
                 return f"已删除记忆 #{memory_id}"
             else:
@@ -541,75 +1921,65 @@ class PersonalTravelAssistant:
                     return f"无效的记忆ID: {memory_id}"
                 
                 # 删除记忆
-                del self.memory_store[user_id][memory_id - 1]
+                entry = self.memory_store[user_id].pop(memory_id - 1)
+                index = self._local_index(user_id)
+                if index is not None and "row" in entry:
+                    index.delete(entry["row"])
                 
                 return f"已删除记忆 #{memory_id}"
                 
         except Exception as e:
             return f"删除记忆时出错: {str(e)}"
     
-    def get_memory_history(self, user_id, limit=None):
-        """获取用户的记忆历史，带有时间戳和ID"""
-        limit = limit or LIMIT_CONFIG["max_memory_items"]
+    def get_memory_history(self, user_id, page=None):
+        """分页获取用户的记忆历史，返回 (记录列表, 页码, 总页数)，记录带有编号和时间戳"""
+        size = LIMIT_CONFIG["history_page_size"]
+        # 初始化完成前，已有本地编号索引时直接从索引读取，无需等待
+        if not self.backend_ready.is_set():
+            index = self.memory_indexes.setdefault(user_id, MemoryIndex(self._memory_index_path(user_id)))
+            if not index.loaded:
+                self.wait_backend()
         try:
-            if self.use_memory:
-                memories = self.memory.get_all(user_id=user_id)
-                
-                result_list = []
-                if isinstance(memories, dict) and 'results' in memories:
-                    for i, mem in enumerate(memories['results'], 1):
-                        if isinstance(mem, dict):
-                            # 从metadata中获取时间戳
-                            timestamp = None
-                            if isinstance(mem.get('metadata'), dict):
-                                timestamp = mem['metadata'].get('timestamp')
-                            if not timestamp:
-                                timestamp = mem.get('timestamp', 'N/A')
-                            
-                            if 'text' in mem:
-                                result_list.append((i, timestamp, mem['text']))
-                            elif 'memory' in mem:
-                                result_list.append((i, timestamp, mem['memory']))
-                            else:
-                                result_list.append((i, timestamp, str(mem)))
-                
-                # 最多返回limit条记录
-                return result_list[-limit:]
+            if self.use_memory or not self.backend_ready.is_set():
+                index = self.get_memory_index(user_id)
+                page_count = index.page_count(size)
+                page = min(page or page_count, page_count)
+                records = [(i, entry['created_at'], entry['memory']) for i, entry in index.page(page, size)]
+                return records, page, page_count
             else:
-                if user_id not in self.memory_store:
-                    return []
-                
-                result_list = []
-                for i, mem in enumerate(self.memory_store[user_id], 1):
-                    timestamp = mem.get('timestamp', 'N/A')
-                    result_list.append((i, timestamp, mem['content']))
-                
-                # 最多返回limit条记录
-                return result_list[-limit:]
+                memories = self.memory_store.get(user_id, [])
+                page_count = max(1, (len(memories) + size - 1) // size)
+                page = min(page or page_count, page_count)
+                start = (page - 1) * size
+                records = [(start + i + 1, mem.get('timestamp', 'N/A'), mem['content'])
+                           for i, mem in enumerate(memories[start:start + size])]
+                return records, page, page_count
                 
         except Exception as e:
-            return [(0, 'ERROR', f"获取记忆历史时出错: {str(e)}")]
+            return [(0, 'ERROR', f"获取记忆历史时出错: {str(e)}")], 1, 1
     
     def reset_memories(self, user_id):
         """重置用户的所有记忆"""
+        self.wait_backend()
+        self.search_cache.clear()
         try:
             if self.use_memory:
-                # 获取所有记忆
-                memories = self.memory.get_all(user_id=user_id)
+                started = time.time()
+                # 优先一次性批量删除，向量库不支持时逐条删除
+                deleted_count = self._bulk_reset(user_id)
+                if deleted_count is None:
+                    deleted_count = self._reset_one_by_one(user_id)
+                self.get_memory_index(user_id).clear()
                 
-                deleted_count = 0
-                if isinstance(memories, dict) and 'results' in memories:
-                    for mem in memories['results']:
-                        if isinstance(mem, dict) and 'id' in mem:
-                            self.memory.delete(memory_id=mem['id'])
-                            deleted_count += 1
-                
-                return f"已重置 {deleted_count} 条记忆"
+                return f"已重置 {deleted_count} 条记忆，耗时 {time.time() - started:.1f} 秒"
             else:
                 # 简单内存存储的实现
                 if user_id in self.memory_store:
                     deleted_count = len(self.memory_store[user_id])
                     self.memory_store[user_id] = []
+                    index = self._local_index(user_id)
+                    if index is not None:
+                        index.reset()
                     return f"已重置 {deleted_count} 条记忆"
                 else:
                     return "没有记忆需要重置"
@@ -617,6 +1987,163 @@ class PersonalTravelAssistant:
         except Exception as e:
             return f"重置记忆时出错: {str(e)}"
 
+    def _bulk_reset(self, user_id):
+        """通过一次Qdrant操作删除用户的全部记忆，返回删除条数；向量库不支持时返回None"""
+        vector_store = getattr(self.memory, "vector_store", None)
+        client = getattr(vector_store, "client", None)
+        collection = getattr(vector_store, "collection_name", None)
+        if client is None or not collection or not hasattr(client, "delete_collection"):
+            return None
+        from qdrant_client import models
+
+        if collection != STORAGE_CONFIG["base_collection_name"]:
+            # 用户独占的collection：删除后按原配置和payload索引重建
+            count = client.count(collection_name=collection, exact=True).count
+            print(f"正在清空 collection {collection} ({count} 条记忆)...")
+            recreate_collection(client, collection)
+        else:
+            # 与其他用户共享的collection：按 user_id 过滤删除
+            user_filter = models.Filter(must=[
+                models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id))
+            ])
+            count = client.count(collection_name=collection, count_filter=user_filter, exact=True).count
+            print(f"正在删除 {count} 条记忆...")
+            client.delete(
+                collection_name=collection,
+                points_selector=models.FilterSelector(filter=user_filter),
+                wait=True,
+            )
+        return count
+
+    def _reset_one_by_one(self, user_id):
+        """逐条删除用户的记忆并显示进度"""
+        memories = self.memory.get_all(user_id=user_id, limit=LIMIT_CONFIG["index_rebuild_limit"])
+        if isinstance(memories, dict):
+            memories = memories.get('results', [])
+        memory_ids = [mem['id'] for mem in memories if isinstance(mem, dict) and 'id' in mem]
+        total = len(memory_ids)
+        for deleted_count, memory_id in enumerate(memory_ids, 1):
+            self.memory.delete(memory_id=memory_id)
+            if deleted_count % 100 == 0 or deleted_count == total:
+                print(f"\r已删除 {deleted_count}/{total} 条记忆", end="", flush=True)
+        if total:
+            print()
+        return total
+
+    def consolidate_memories(self, user_id, dry_run=False):
+        """离线整理用户记忆：合并近似重复的记忆、删除过期的低价值记忆和旧的对话总结
+
+        返回整理报告（字典）；dry_run 为 True 时只统计不修改。
+        """
+        self.wait_backend()
+        vector_store = getattr(self.memory, "vector_store", None)
+        client = getattr(vector_store, "client", None)
+        collection = getattr(vector_store, "collection_name", None)
+        if not self.use_memory or client is None or not hasattr(client, "scroll"):
+            return {"user_id": user_id, "error": "记忆整理需要Qdrant向量库"}
+        from qdrant_client import models
+
+        started = time.time()
+        user_filter = models.Filter(must=[
+            models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id))
+        ])
+        points = []
+        offset = None
+        while True:
+            batch, offset = client.scroll(collection_name=collection, scroll_filter=user_filter, limit=CONSOLIDATE_CONFIG["batch_size"],
+                                          offset=offset, with_payload=True, with_vectors=True)
+            points.extend(point for point in batch if point.vector is not None)
+            if offset is None:
+                break
+        report = {"user_id": user_id, "before": len(points), "clusters": 0, "merged": 0, "rewritten": 0,
+                  "expired": 0, "old_summaries": 0}
+        if not points:
+            report.update(after=0, seconds=round(time.time() - started, 1))
+            return report
+
+        stats = self.get_access_stats(user_id)
+        ids = [str(point.id) for point in points]
+        payloads = [point.payload or {} for point in points]
+        created = [payload.get("created_at") or payload.get("timestamp") or "" for payload in payloads]
+        counts = [stats.count(internal_id) for internal_id in ids]
+        last_used = [stats.last_used(internal_id) or "" for internal_id in ids]
+        deleted = set()
+        updates = {}
+
+        # 对话总结只保留最新的一条
+        summaries = sorted((i for i, payload in enumerate(payloads) if payload.get("kind") == "summary"),
+                           key=lambda i: created[i], reverse=True)
+        deleted.update(summaries[1:])
+        report["old_summaries"] = len(summaries) - 1 if summaries else 0
+
+        # 近似重复聚类：命中次数多、较新的记忆优先作为代表
+        candidates = [i for i in range(len(points)) if i not in deleted and payloads[i].get("kind") != "summary"]
+        order = sorted(range(len(candidates)), key=lambda k: (counts[candidates[k]], created[candidates[k]]), reverse=True)
+        clusters = cluster_near_duplicates([points[i].vector for i in candidates], CONSOLIDATE_CONFIG["similarity_threshold"], order)
+        survivors = []
+        for leader, members in clusters:
+            leader = candidates[leader]
+            members = [candidates[k] for k in members]
+            survivors.append(leader)
+            if not members:
+                continue
+            report["clusters"] += 1
+            report["merged"] += len(members)
+            deleted.update(members)
+            counts[leader] += sum(counts[i] for i in members)
+            last_used[leader] = max(last_used[i] for i in [leader] + members)
+            texts = list(dict.fromkeys(payloads[i].get("data", "") for i in [leader] + members))
+            if len(texts) > 1 and CONSOLIDATE_CONFIG["merge_with_llm"] and not dry_run:
+                merged = self._merge_memory_texts(texts[:CONSOLIDATE_CONFIG["max_merge_items"]])
+                if merged and merged != texts[0]:
+                    updates[leader] = merged
+            if not dry_run:
+                stats.merge(ids[leader], [ids[i] for i in members])
+
+        # 保留期内没有被检索命中、且累计命中次数不足的记忆视为过期。最近命中时间未知时以创建时间为准，
+        # 开始统计之前创建的记忆从开始统计时算起，统计覆盖的时间不足保留期时不会过期
+        cutoff = (datetime.now() - timedelta(days=CONSOLIDATE_CONFIG["max_age_days"])).isoformat()[:19]
+        report["tracking_since"] = stats.since[:19]
+        for i in survivors:
+            last_active = last_used[i] or max(created[i][:19], stats.since[:19])
+            if last_active[:19] < cutoff and counts[i] < CONSOLIDATE_CONFIG["min_access_count"]:
+                deleted.add(i)
+                updates.pop(i, None)
+                report["expired"] += 1
+
+        if not dry_run:
+            for i, text in updates.items():
+                self.memory.update(memory_id=ids[i], data=text)
+            doomed = [ids[i] for i in sorted(deleted)]
+            for start in range(0, len(doomed), CONSOLIDATE_CONFIG["batch_size"]):
+                client.delete(collection_name=collection, points_selector=models.PointIdsList(
+                    points=doomed[start:start + CONSOLIDATE_CONFIG["batch_size"]]))
+            stats.remove(doomed)
+            stats.save()
+            self.search_cache.clear()
+            self.get_memory_index(user_id, refresh=True)
+        report["rewritten"] = len(updates)
+        report["after"] = len(points) - len(deleted)
+        report["seconds"] = round(time.time() - started, 1)
+        return report
+
+    def _merge_memory_texts(self, texts):
+        """用模型把一组近似重复的记忆合并为一条，失败时返回None"""
+        listing = "\n".join(f"- {text}" for text in texts)
+        instruction = ("用户会给出关于同一用户的几条内容相近的记忆，请合并为一条简洁、完整的事实陈述，"
+                       "保留所有不重复的细节，只输出合并后的内容。")
+        try:
+            response = self.client.chat.completions.create(
+                model=API_CONFIG["llm_model"],
+                messages=build_messages(instruction, listing),
+                temperature=0.1,
+                max_tokens=300
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"合并记忆失败: {str(e)}")
+            return None
+
 def handle_command(command, assistant, user_id, conversation_history):
     """处理命令输入"""
     if command.lower() in ["exit", "q", "/exit", "/quit"]:
@@ -625,7 +2152,8 @@ def handle_command(command, assistant, user_id, conversation_history):
     command_handlers = {
         COMMANDS["summary"]["command"]: lambda: handle_summary_command(assistant, user_id),
         COMMANDS["memories"]["command"]: lambda: handle_memories_command(assistant, user_id),
-        COMMANDS["history"]["command"]: lambda: handle_history_command(assistant, user_id),
+        COMMANDS["history"]["command"].split()[0]: lambda: handle_history_command(command, assistant, user_id),
+        COMMANDS["older"]["command"]: lambda: handle_older_command(assistant, user_id),
         COMMANDS["reset"]["command"]: lambda: handle_reset_command(assistant, user_id),
         COMMANDS["debug"]["command"]: lambda: handle_debug_command(assistant, user_id)
     }
@@ -642,6 +2170,9 @@ def handle_command(command, assistant, user_id, conversation_history):
     elif command.lower().startswith(COMMANDS["update"]["command"].split()[0]):
         handle_update_command(command, assistant, user_id)
         return False, True
+    elif command.lower().startswith(COMMANDS["history"]["command"].split()[0] + " "):
+        handle_history_command(command, assistant, user_id)
+        return False, True
         
     return False, False  # 不是命令
 
@@ -660,16 +2191,39 @@ def handle_memories_command(assistant, user_id):
         print(f"{i}. {memory}")
     print("\n" + "-"*50)
 
-def handle_history_command(assistant, user_id):
-    """处理历史记录命令"""
-    print("\n记忆历史:")
-    history = assistant.get_memory_history(user_id)
+def handle_history_command(command, assistant, user_id):
+    """处理历史记录命令，支持 /history <页码> 和 /history refresh"""
+    parts = command.split()
+    page = None
+    if len(parts) > 1:
+        if parts[1].lower() == "refresh":
+            assistant.wait_backend()
+            if assistant.use_memory:
+                assistant.get_memory_index(user_id, refresh=True)
+        elif parts[1].isdigit() and int(parts[1]) > 0:
+            page = int(parts[1])
+        else:
+            print("格式错误，请使用", COMMANDS["history"]["command"])
+            return
+    history, page, page_count = assistant.get_memory_history(user_id, page)
+    print(f"\n记忆历史 (第 {page}/{page_count} 页):")
     for mem_id, timestamp, content in history:
         print(f"ID: {mem_id} | 时间: {timestamp}")
         print(f"内容: {content}")
         print("-"*30)
     print("\n" + "-"*50)
 
+def handle_older_command(assistant, user_id):
+    """处理查看更早会话记录命令"""
+    messages = assistant.load_older_messages(user_id)
+    if not messages:
+        print("\n没有更早的会话记录")
+    else:
+        print("\n更早的会话记录:")
+        for timestamp, role, content in messages:
+            print(f"[{timestamp}] {role}: {content}")
+    print("\n" + "-"*50)
+
 def handle_reset_command(assistant, user_id):
     """处理重置命令"""
     print("\n重置记忆...")
@@ -680,10 +2234,27 @@ def handle_reset_command(assistant, user_id):
 def handle_debug_command(assistant, user_id):
     """处理调试命令"""
     print("\n调试信息:")
-    print(f"记忆系统工作状态: {assistant.use_memory}")
-    print(f"当前会话历史长度: {len(assistant.messages)}")
+    print(f"记忆系统工作状态: {assistant.use_memory if assistant.backend_ready.is_set() else '初始化中'}")
+    if assistant.startup_ms is not None:
+        print(f"启动到首个提示符: {assistant.startup_ms:.0f}ms")
+    print(f"当前会话历史长度: {len(assistant.messages)} ({count_message_tokens(assistant.messages)} tokens, 计数方式: {tokenizer_name()})")
+    print(f"历史摘要长度: {len(assistant.history_summary)} 字")
+    if assistant.memory_writer is not None:
+        print(f"待写入记忆轮数: {assistant.memory_writer.pending()}")
     if hasattr(assistant, 'memory_store') and user_id in assistant.memory_store:
         print(f"内存记忆存储条数: {len(assistant.memory_store[user_id])}")
+    print(f"嵌入缓存: {len(assistant.embedding_cache.data)} 条, 命中率 {assistant.embedding_cache.hit_rate():.0%}")
+    print(f"搜索缓存: {len(assistant.search_cache.data)} 条, 命中率 {assistant.search_cache.hit_rate():.0%}")
+    if assistant.turn_stats:
+        last = assistant.turn_stats[-1]
+        first_tokens = sorted(t["first_token_ms"] for t in assistant.turn_stats if t["first_token_ms"] is not None)
+        last_first_token = f"{last['first_token_ms']:.0f}ms" if last["first_token_ms"] is not None else "N/A"
+        print(f"最近一轮: 检索 {last['retrieval_ms']:.0f}ms, 首个token {last_first_token}, 总耗时 {last['total_ms']:.0f}ms, 注入记忆 {last['memories']} 条, 提示 {last['prompt_tokens']} tokens")
+        if first_tokens:
+            p50 = first_tokens[len(first_tokens) // 2]
+            p95 = first_tokens[min(len(first_tokens) - 1, int(len(first_tokens) * 0.95))]
+            print(f"首个token延迟 ({len(first_tokens)} 轮): p50 {p50:.0f}ms, p95 {p95:.0f}ms")
+        print(f"前缀缓存: {format_cache_stats()}")
     print("\n" + "-"*50)
 
 def handle_delete_command(command, assistant, user_id):
@@ -723,6 +2294,12 @@ def handle_update_command(command, assistant, user_id):
 
 def handle_exit(assistant, user_id, conversation_history):
     """处理退出逻辑"""
+    # 先写完后台队列中的记忆，总结才能包含最近的对话
+    if assistant.memory_writer is not None and assistant.memory_writer.pending():
+        print("\n正在保存记忆...")
+    if not assistant.flush_memories(MEMORY_WRITE_CONFIG["flush_timeout"]):
+        print("等待记忆写入超时，部分记忆可能未保存")
+    assistant.save_access_stats()
     if len(conversation_history) >= 6:
         try:
             print("\n生成对话总结中...")
@@ -736,6 +2313,278 @@ def handle_exit(assistant, user_id, conversation_history):
     print("="*50)
     print("感谢使用智能助手！再见！")
 
+# ===================== 服务模式 =====================
+
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_\-]{1,64}")
+
+class UserSlot:
+    """缓存中的一个用户：助手实例、串行化该用户请求的锁和使用计数"""
+    def __init__(self):
+        self.assistant = None
+        self.lock = threading.Lock()
+        self.active = 0  # 正在使用的请求数，大于0时不会被淘汰
+        self.last_used = time.time()
+
+class AssistantPool:
+    """按用户缓存助手实例：超出容量时淘汰最久未使用的空闲实例，空闲超时的实例定期淘汰
+
+    同一用户的请求通过该用户的锁串行处理，不同用户之间互不阻塞。
+    """
+    def __init__(self, capacity=None, idle_timeout=None):
+        self.capacity = capacity or SERVER_CONFIG["max_assistants"]
+        self.idle_timeout = idle_timeout or SERVER_CONFIG["idle_timeout"]
+        self.slots = OrderedDict()
+        self.lock = threading.Lock()
+        # 正在关闭的实例，同一用户再次访问时先等关闭完成，避免新旧实例同时写本地文件
+        self.closing = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def session(self, user_id):
+        """返回该用户的助手实例并持有该用户的锁，用法: with pool.session(user_id) as assistant"""
+        return _PoolSession(self, user_id)
+
+    def _acquire(self, user_id):
+        with self.lock:
+            slot = self.slots.get(user_id)
+            if slot is None:
+                slot = UserSlot()
+                self.slots[user_id] = slot
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.slots.move_to_end(user_id)
+            slot.active += 1
+            # 超出容量时从最久未使用的一端淘汰空闲实例，全部在用时暂时超出容量
+            for old_id in list(self.slots):
+                if len(self.slots) <= self.capacity:
+                    break
+                if self.slots[old_id].active == 0:
+                    self._evict(old_id)
+        return slot
+
+    def _release(self, slot):
+        with self.lock:
+            slot.active -= 1
+            slot.last_used = time.time()
+
+    def _evict(self, user_id):
+        """从缓存移除并在后台关闭实例，调用时需持有 self.lock"""
+        slot = self.slots.pop(user_id)
+        self.evictions += 1
+        if slot.assistant is None:
+            return
+        thread = threading.Thread(target=self._close, args=(user_id, slot.assistant), name="assistant-close", daemon=True)
+        self.closing[user_id] = thread
+        thread.start()
+
+    def _close(self, user_id, assistant):
+        try:
+            assistant.close()
+        except Exception as e:
+            print(f"关闭用户 {user_id} 的实例时出错: {str(e)}")
+        finally:
+            with self.lock:
+                if self.closing.get(user_id) is threading.current_thread():
+                    del self.closing[user_id]
+
+    def wait_closed(self, user_id):
+        with self.lock:
+            thread = self.closing.get(user_id)
+        if thread is not None:
+            thread.join()
+
+    def configure(self, capacity, idle_timeout):
+        """调整容量和空闲超时，超出新容量的空闲实例在下次访问时淘汰"""
+        with self.lock:
+            self.capacity = capacity
+            self.idle_timeout = idle_timeout
+
+    def sweep(self):
+        """淘汰空闲超时的实例，返回淘汰数量"""
+        now = time.time()
+        with self.lock:
+            idle = [user_id for user_id, slot in self.slots.items()
+                    if slot.active == 0 and now - slot.last_used > self.idle_timeout]
+            for user_id in idle:
+                self._evict(user_id)
+        return len(idle)
+
+    def start_sweeper(self, interval=None):
+        interval = interval or SERVER_CONFIG["sweep_interval"]
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+
+        threading.Thread(target=run, name="assistant-sweeper", daemon=True).start()
+
+    def close_all(self):
+        """关闭所有实例（服务退出时调用）"""
+        with self.lock:
+            for user_id in list(self.slots):
+                self._evict(user_id)
+            threads = list(self.closing.values())
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "cached": len(self.slots),
+                "active": sum(1 for slot in self.slots.values() if slot.active),
+                "closing": len(self.closing),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+class _PoolSession:
+    def __init__(self, pool, user_id):
+        self.pool = pool
+        self.user_id = user_id
+        self.slot = None
+
+    def __enter__(self):
+        self.slot = self.pool._acquire(self.user_id)
+        try:
+            self.slot.lock.acquire()
+            if self.slot.assistant is None:
+                self.pool.wait_closed(self.user_id)
+                self.slot.assistant = PersonalTravelAssistant(self.user_id, background=False)
+        except BaseException:
+            if self.slot.lock.locked():
+                self.slot.lock.release()
+            self.pool._release(self.slot)
+            raise
+        return self.slot.assistant
+
+    def __exit__(self, *exc):
+        self.slot.lock.release()
+        self.pool._release(self.slot)
+        return False
+
+def create_app(pool):
+    """创建服务模式的Flask应用"""
+    from flask import Flask, Response, request, jsonify
+
+    app = Flask(__name__)
+    # GET /metrics 导出 Prometheus 指标（见 metrics.py）
+    metrics.instrument_app(app, "assistant")
+
+    @app.before_request
+    def check_api_key():
+        # user_id 由调用方提供，接口本身必须鉴权；/metrics 不含用户数据，不需要密钥
+        if request.endpoint == "metrics":
+            return None
+        api_key = settings.get().assistant.api_key
+        if not api_key:
+            # 未配置密钥时只接受本机请求
+            if request.remote_addr in ("127.0.0.1", "::1"):
+                return None
+            return jsonify({"message": "Unauthorized"}), 401
+        request_api_key = request.headers.get("X-API-KEY") or ""
+        if not hmac.compare_digest(request_api_key.encode(), api_key.encode()):
+            return jsonify({"message": "Unauthorized"}), 401
+        return None
+
+    def get_user():
+        data = request.get_json(silent=True) or {}
+        user_id = data.get("user_id") or request.args.get("user_id", "")
+        if not USER_ID_PATTERN.fullmatch(user_id):
+            return None, data
+        return user_id, data
+
+    @app.route("/api/chat", methods=["POST"])
+    def chat():
+        user_id, data = get_user()
+        if user_id is None:
+            return jsonify({"message": "Invalid user_id"}), 400
+        question = (data.get("message") or "").strip()
+        if not question:
+            return jsonify({"message": "Empty message"}), 400
+
+        if not data.get("stream", True):
+            with pool.session(user_id) as assistant:
+                try:
+                    answer = "".join(assistant.stream_answer(question, user_id))
+                except Exception as e:
+                    return jsonify({"message": f"处理问题时出错: {str(e)}"}), 500
+            return jsonify({"answer": answer})
+
+        def generate():
+            # 持有该用户的锁直到回答结束，同一用户的并发请求按顺序处理
+            with pool.session(user_id) as assistant:
+                try:
+                    for content in assistant.stream_answer(question, user_id):
+                        yield f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
+                    yield "data: [DONE]\n\n"
+                except Exception as e:
+                    yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+
+        return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @app.route("/api/memories", methods=["GET"])
+    def memories():
+        user_id, _ = get_user()
+        if user_id is None:
+            return jsonify({"message": "Invalid user_id"}), 400
+        with pool.session(user_id) as assistant:
+            return jsonify({"memories": assistant.get_all_memories(user_id)})
+
+    @app.route("/api/summary", methods=["POST"])
+    def summary():
+        user_id, _ = get_user()
+        if user_id is None:
+            return jsonify({"message": "Invalid user_id"}), 400
+        with pool.session(user_id) as assistant:
+            assistant.flush_memories(MEMORY_WRITE_CONFIG["flush_timeout"])
+            return jsonify({"summary": assistant.generate_summary(user_id)})
+
+    @app.route("/api/status", methods=["GET"])
+    def status():
+        return jsonify(dict(pool.stats(), prompt_cache=cache_stats()))
+
+    return app
+
+def apply_settings(old, new, pool=None):
+    """配置热加载：更新模型接口配置和实例池参数，接口地址、密钥或超时变化时重建共享客户端
+
+    已创建的用户实例中 mem0 使用的模型不变，实例被淘汰重建后生效。
+    """
+    API_CONFIG.update(llm_api_key=new.llm.api_key, llm_base_url=new.llm.base_url,
+                      llm_model=new.model_for("assistant"), llm_timeout=new.llm.timeout)
+    if new.llm.api_key:
+        os.environ["XAI_API_KEY"] = new.llm.api_key
+    if (old.llm.api_key, old.llm.base_url, old.llm.timeout) != (new.llm.api_key, new.llm.base_url, new.llm.timeout):
+        # 正在进行的请求继续使用旧客户端，新请求使用新客户端
+        with _shared_clients_lock:
+            _shared_clients.pop("llm_client", None)
+            _shared_clients.pop("async_llm_client", None)
+    SERVER_CONFIG.update(max_assistants=new.assistant.max_assistants, idle_timeout=new.assistant.idle_timeout)
+    if pool is not None:
+        pool.configure(new.assistant.max_assistants, new.assistant.idle_timeout)
+
+def run_server(host=None, port=None):
+    """以HTTP服务模式运行，一个进程同时服务多个用户"""
+    pool = AssistantPool()
+    pool.start_sweeper()
+    settings.on_reload(lambda old, new: apply_settings(old, new, pool))
+    settings.watch()
+    app = create_app(pool)
+    if not settings.get().assistant.api_key:
+        print("未配置 assistant.api_key（或环境变量 ASSISTANT_API_KEY），只接受本机请求")
+    try:
+        app.run(host=host or SERVER_CONFIG["host"], port=port or SERVER_CONFIG["port"], threaded=True)
+    finally:
+        print("正在关闭用户实例...")
+        pool.close_all()
+
 def load_user_config():
     """加载用户配置"""
     config_file = os.path.expanduser(USER_CONFIG["user_config_file"])
@@ -760,13 +2609,50 @@ def save_user_config(user_id):
     except Exception as e:
         print(f"保存用户配置失败: {str(e)}")
 
-def get_user_id():
-    """获取用户ID"""
-    # 解析命令行参数
+def list_memory_users():
+    """列出向量库中有记忆的用户"""
+    client = get_qdrant_client()
+    base = STORAGE_CONFIG["base_collection_name"]
+    if STORAGE_CONFIG["collection_layout"] == "shared":
+        facet = client.facet(collection_name=base, key="user_id", limit=1000000)
+        return sorted(hit.value for hit in facet.hits)
+    prefix = f"{base}_"
+    return sorted(c.name[len(prefix):] for c in client.get_collections().collections if c.name.startswith(prefix))
+
+def run_consolidation(user_ids=None, dry_run=False):
+    """对指定用户（默认全部用户）执行记忆整理并输出整理前后的条数"""
+    user_ids = user_ids or list_memory_users()
+    totals = {"before": 0, "after": 0}
+    for number, user_id in enumerate(user_ids, 1):
+        assistant = PersonalTravelAssistant(user_id, background=False)
+        report = assistant.consolidate_memories(user_id, dry_run=dry_run)
+        assistant.close()
+        if "error" in report:
+            print(f"[{number}/{len(user_ids)}] {user_id}: {report['error']}")
+            continue
+        totals["before"] += report["before"]
+        totals["after"] += report["after"]
+        print(f"[{number}/{len(user_ids)}] {user_id}: {report['before']} -> {report['after']} 条 "
+              f"(合并 {report['merged']} 条/{report['clusters']} 组, 改写 {report['rewritten']} 条, "
+              f"过期 {report['expired']} 条, 旧总结 {report['old_summaries']} 条, 耗时 {report['seconds']}s, "
+              f"命中统计始于 {report.get('tracking_since', '-')})")
+    print(f"{'预计' if dry_run else '整理'}完成: {len(user_ids)} 个用户, 记忆 {totals['before']} -> {totals['after']} 条")
+    return totals
+
+def parse_args():
+    """解析命令行参数"""
     parser = argparse.ArgumentParser(description='智能助手')
     parser.add_argument('-u', '--user', help='用户ID')
-    args = parser.parse_args()
-    
+    parser.add_argument('--serve', action='store_true', help='以HTTP服务模式运行，同时服务多个用户')
+    parser.add_argument('--port', type=int, default=SERVER_CONFIG["port"], help='服务模式监听端口')
+    parser.add_argument('--migrate-collections', action='store_true', help='把按用户划分的collection迁移到共享collection')
+    parser.add_argument('--drop-source', action='store_true', help='迁移核对后删除原collection')
+    parser.add_argument('--consolidate', action='store_true', help='整理记忆：合并近似重复、删除过期记忆（-u 指定用户，默认全部用户）')
+    parser.add_argument('--dry-run', action='store_true', help='整理记忆时只统计不修改')
+    return parser.parse_args()
+
+def get_user_id(args):
+    """获取用户ID"""
     # 优先使用命令行参数
     if args.user:
         return args.user
@@ -789,21 +2675,23 @@ def get_user_id():
         
         print("用户ID不能为空，请重新输入")
 
-def main():
+def main(args):
     """主函数：处理用户输入并展示响应"""
     try:
         # 设置readline
         setup_readline()
         
-        # 获取用户ID
-        user_id = get_user_id()
+        # 获取用户ID（交互输入的等待时间不计入启动耗时）
+        waited = time.perf_counter()
+        user_id = get_user_id(args)
+        waited = time.perf_counter() - waited
         
         # 创建助手实例，传入用户ID
         assistant = PersonalTravelAssistant(user_id)
         
         print("\n欢迎使用智能助手！(输入 'exit' 或 'q' 退出)")
         print(f"用户ID: {user_id}")
-        print(f"记忆系统: {'向量数据库' if assistant.use_memory else '简单内存存储'}")
+        print("记忆系统: 后台初始化中...")
         print("="*50)
         print("可用命令:")
         for cmd in COMMANDS.values():
@@ -820,6 +2708,7 @@ def main():
         # 记录对话历史以备失败时使用
         conversation_history = []
         last_input = ""  # 记录上一次的输入
+        assistant.startup_ms = (time.perf_counter() - PROCESS_START - waited) * 1000
         
         while True:
             try:
@@ -860,4 +2749,14 @@ def main():
         return
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    args = parse_args()
+    if args.migrate_collections:
+        migrated = migrate_to_shared_collection(drop_source=args.drop_source)
+        print(f"迁移完成: {len(migrated)} 个用户, {sum(migrated.values())} 条记忆")
+        print('之后请把 STORAGE_CONFIG["collection_layout"] 改为 "shared"')
+    elif args.consolidate:
+        run_consolidation([args.user] if args.user else None, dry_run=args.dry_run)
+    elif args.serve:
+        run_server(port=args.port)
+    else:
+        main(args)
@@ -1,5 +1,4 @@
 import os
-from openai import OpenAI
 import json
 import requests
 import time
@@ -11,10 +10,14 @@ import smtplib
 import sqlite3
 from email.mime.text import MIMEText
 from flask import Flask, request, jsonify
+from prompts import build_messages, record_usage, format_cache_stats
+from response_cache import get_response_cache, format_cache_stats as format_response_cache_stats
+import settings
+import metrics
 
 
-# 从环境变量获取数据库路径
-DB_PATH = os.environ.get("ALERTS_DB_PATH", "alerts.db")
+# 数据库路径（config.yaml 的 alerts.db_path 或环境变量 ALERTS_DB_PATH），修改后需要重启
+DB_PATH = settings.get().alerts.db_path
 
 def init_db():
     """ 初始化 SQLite 数据库 """
@@ -40,13 +43,19 @@ init_db()
 
 
 app = Flask(__name__)
+# GET /metrics 导出 Prometheus 指标（见 metrics.py）
+metrics.instrument_app(app, "alerts")
 
 
-# OpenAI客户端配置
-client = OpenAI(
-    api_key="xai-xxx",
-    base_url="https://api.x.ai/v1",
-)
+# 模型接口、模型、webhook密钥和并发上限在 config.yaml 的 llm、alerts 段配置（见 settings.py），运行中修改会热加载
+# 同时进行的告警分析请求数，超出的请求排队等待
+analysis_limit = settings.ConcurrencyLimit(settings.get().alerts.max_concurrency)
+settings.on_reload(lambda old, new: analysis_limit.resize(new.alerts.max_concurrency))
+metrics.track_limit("alerts_analysis", analysis_limit)
+
+# 告警分析的系统提示，作为每次请求的固定前缀，告警内容只放在用户消息中
+ALERT_SYSTEM_PROMPT = ("你是一个专业的 SRE 工程师，帮助分析告警, 请以markdown格式输出。尽量简洁\n\n"
+                       "用户会给出 Prometheus 的告警信息，请分析告警影响并提供处理建议。")
 
 def send_notifications(message):
     """ 发送通知 """
@@ -54,33 +63,53 @@ def send_notifications(message):
 
 def process_alert_with_ai(alerts):
     """ 调用 OpenAI API 处理告警信息 """
-    prompt = "以下是 Prometheus 的告警信息，请分析告警影响并提供处理建议：\n\n"
+    prompt = "告警信息：\n\n"
     
     for alert in alerts:
         summary = alert.get("annotations", {}).get("summary", "No summary")
         description = alert.get("annotations", {}).get("description", "No description")
         severity = alert.get("labels", {}).get("severity", "unknown")
         prompt += f"- **告警级别**: {severity}\n- **事件**: {summary}\n- **详情**: {description}\n\n"
-        print(prompt)
-    response = client.chat.completions.create(
-        model="grok-2-latest",
-        messages=[{"role": "system", "content": "你是一个专业的 SRE 工程师，帮助分析告警, 请以markdown格式输出。尽量简洁"},
-                  {"role": "user", "content": prompt}]
-    )
-    print(response)
-    return response.choices[0].message.content
+    messages = build_messages(ALERT_SYSTEM_PROMPT, prompt)
+    config = settings.get()
+    model = config.model_for("alerts")
+    # 开启响应缓存时，内容完全相同的告警（如反复触发）直接复用上次的分析
+    cache = get_response_cache("alerts")
+    lookup = cache.lookup(model, messages) if cache is not None else None
+    if lookup is not None and lookup.response is not None:
+        print(f"响应缓存命中: {format_response_cache_stats(cache)}")
+        return lookup.response
+    with analysis_limit, metrics.span("llm.request", caller="alerts", model=model):
+        started = time.perf_counter()
+        try:
+            response = settings.get_openai_client(config.llm).chat.completions.create(
+                model=model,
+                messages=messages
+            )
+        except Exception:
+            metrics.observe_llm("alerts", model, started, status="error")
+            raise
+        metrics.observe_llm("alerts", model, started)
+    record_usage("alerts", messages, response.usage)
+    print(f"告警分析完成: 耗时 {time.perf_counter() - started:.2f} 秒, "
+          f"token {getattr(response.usage, 'total_tokens', None)}, 前缀缓存: {format_cache_stats()}")
+    analysis = response.choices[0].message.content
+    if lookup is not None:
+        cache.store(lookup, analysis)
+    return analysis
 
 def save_alert_to_db(alert_name, severity, summary, description, ai_analysis):
     """ 存入 SQLite """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO alerts (alert_name, severity, summary, description, ai_analysis) VALUES (?, ?, ?, ?, ?)",
-        (alert_name, severity, summary, description, ai_analysis)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with metrics.DB_WRITE_SECONDS.time(db="alerts", op="insert"):
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO alerts (alert_name, severity, summary, description, ai_analysis) VALUES (?, ?, ?, ?, ?)",
+            (alert_name, severity, summary, description, ai_analysis)
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
 
 @app.route("/api/alerts", methods=["POST"])
 def receive_alert():
@@ -89,8 +118,10 @@ def receive_alert():
     # 如果Header中没有API key，则从URL参数获取
     if not request_api_key:
         request_api_key = request.args.get("api_key")
-        
-    if request_api_key != "1234567890":
+
+    # 未配置密钥时拒绝所有请求
+    webhook_key = settings.get().alerts.webhook_key
+    if not webhook_key or not request_api_key or not hmac.compare_digest(request_api_key.encode(), webhook_key.encode()):
         return jsonify({"message": "Unauthorized"}), 401
 
     data = request.json
@@ -103,9 +134,11 @@ def receive_alert():
         severity = alert["labels"].get("severity", "unknown")
         summary = alert["annotations"].get("summary", "No summary")
         description = alert["annotations"].get("description", "")
+        metrics.ALERTS_RECEIVED.inc(severity=severity)
 
         # AI 处理
-        ai_analysis = process_alert_with_ai([alert])
+        with metrics.span("alerts.process", alert_name=alert_name, severity=severity):
+            ai_analysis = process_alert_with_ai([alert])
 
         # 存入数据库
         save_alert_to_db(alert_name, severity, summary, description, ai_analysis)
@@ -124,4 +157,7 @@ def receive_alert():
     },"ai_analysis": ai_analysis})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=6000, debug=True)
\ No newline at end of file
+    if not settings.get().alerts.webhook_key:
+        print("未配置 alerts.webhook_key（或环境变量 ALERTS_API_KEY），所有告警请求都会被拒绝")
+    settings.watch()
+    app.run(host=settings.get().alerts.host, port=settings.get().alerts.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""记忆collection布局基准测试：每个用户一个collection vs 所有用户共用一个collection（按 user_id 过滤）
+
+默认使用 qdrant_client 的本地内存模式代替Qdrant服务，每种布局在单独的子进程中构建，
+统计构建耗时、进程内存增量和检索延迟（p50/p99）。也可以用 --url 指向真实的Qdrant服务，
+此时内存占用需在Qdrant一侧观察，脚本只统计耗时，结束后删除创建的 bench_ collection。
+
+注意：本地内存模式是暴力检索，不建HNSW图，共享布局的过滤检索延迟比真实服务（租户索引）偏高，
+每个collection的固定开销也比真实服务小，结果只用于比较同一环境下的两种布局。
+
+用法:
+pip install qdrant-client numpy
+python bench_collections.py --users 10000 --per-user 5
+python bench_collections.py --users 1000 --url http://localhost:6333
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PREFIX = "bench_memory"
+
+def rss_mb():
+    """当前进程常驻内存（MB），仅Linux"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_layout(args):
+    """在当前进程中构建一种布局并测量，结果以JSON打印到标准输出"""
+    import numpy as np
+    from qdrant_client import QdrantClient, models
+
+    rng = np.random.default_rng(42)
+    client = QdrantClient(url=args.url) if args.url else QdrantClient(":memory:")
+    vectors_config = models.VectorParams(size=args.dims, distance=models.Distance.COSINE)
+    base_rss = rss_mb()
+    started = time.perf_counter()
+
+    def user_points(user):
+        vectors = rng.standard_normal((args.per_user, args.dims), dtype=np.float32)
+        return [models.PointStruct(id=user * args.per_user + i, vector=vectors[i].tolist(),
+                                   payload={"user_id": f"user{user}", "data": f"memory {i}"})
+                for i in range(args.per_user)]
+
+    if args.layout == "per_user":
+        for user in range(args.users):
+            name = f"{PREFIX}_user{user}"
+            client.create_collection(name, vectors_config=vectors_config)
+            client.upsert(name, points=user_points(user), wait=True)
+    else:
+        name = PREFIX
+        client.create_collection(name, vectors_config=vectors_config,
+                                 hnsw_config=models.HnswConfigDiff(m=0, payload_m=16))
+        client.create_payload_index(name, "user_id", field_schema=models.KeywordIndexParams(type="keyword", is_tenant=True))
+        batch = []
+        for user in range(args.users):
+            batch.extend(user_points(user))
+            if len(batch) >= args.batch_size:
+                client.upsert(name, points=batch, wait=True)
+                batch = []
+        if batch:
+            client.upsert(name, points=batch, wait=True)
+    build_seconds = time.perf_counter() - started
+    build_rss = rss_mb()
+
+    latencies = []
+    for _ in range(args.queries):
+        user = int(rng.integers(args.users))
+        query = rng.standard_normal(args.dims, dtype=np.float32).tolist()
+        started = time.perf_counter()
+        if args.layout == "per_user":
+            client.query_points(f"{PREFIX}_user{user}", query=query, limit=args.limit)
+        else:
+            client.query_points(PREFIX, query=query, limit=args.limit, query_filter=models.Filter(must=[
+                models.FieldCondition(key="user_id", match=models.MatchValue(value=f"user{user}"))
+            ]))
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    if args.url:
+        for collection in client.get_collections().collections:
+            if collection.name.startswith(PREFIX):
+                client.delete_collection(collection.name)
+
+    print(json.dumps({
+        "layout": args.layout,
+        "users": args.users,
+        "points": args.users * args.per_user,
+        "collections": args.users if args.layout == "per_user" else 1,
+        "build_seconds": round(build_seconds, 2),
+        "memory_mb": round(build_rss - base_rss, 1) if base_rss is not None and not args.url else None,
+        "search_p50_ms": round(percentile(latencies, 0.5), 3),
+        "search_p99_ms": round(percentile(latencies, 0.99), 3),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆collection布局基准测试")
+    parser.add_argument("--users", type=int, default=10000, help="用户数")
+    parser.add_argument("--per-user", type=int, default=5, help="每个用户的记忆条数")
+    parser.add_argument("--dims", type=int, default=768, help="向量维度（与 nomic-embed-text 一致）")
+    parser.add_argument("--queries", type=int, default=500, help="检索次数")
+    parser.add_argument("--limit", type=int, default=20, help="每次检索返回条数")
+    parser.add_argument("--batch-size", type=int, default=256, help="共享布局每批写入条数")
+    parser.add_argument("--url", help="Qdrant服务地址，不指定时使用本地内存模式")
+    parser.add_argument("--layout", choices=["per_user", "shared"], help="只测一种布局（内部使用）")
+    args = parser.parse_args()
+
+    if args.layout:
+        run_layout(args)
+        return
+
+    results = []
+    for layout in ("per_user", "shared"):
+        print(f"测试布局 {layout} ...", file=sys.stderr)
+        output = subprocess.run([sys.executable, __file__, "--layout", layout] + sys.argv[1:],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    for result in results:
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
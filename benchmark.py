@@ -0,0 +1,437 @@
+"""性能基准：用本地替身代替模型接口、SSH和向量库，测量各服务的吞吐量和延迟
+
+替身（不访问任何外部服务）：
+- 模型接口：loadtest_chat.py 中模拟的 OpenAI 兼容流式接口，可配置首个token延迟和每秒token数；
+  同一个服务还提供 Ollama 的嵌入接口（确定性的哈希向量）
+- SSH：FakeSSHClient 代替 report.py 使用的 paramiko.SSHClient，连接和每条命令按配置的延迟返回
+- 向量库：安装了 mem0 时使用内存模式的 Qdrant（QdrantClient(":memory:")）和上面的嵌入接口，
+  否则个人助手按原有逻辑使用本地向量索引
+- Ollama：用 FakeOllamaClient 代替 ollama 包（report.py 在导入时就需要它），嵌入请求发到上面的模拟接口，
+  本地模型生成直接失败，因此巡检始终使用远程引擎的结果
+
+场景：
+- alerts: 启动 alerts.py，多个客户端并发发送 webhook（告警风暴）
+- chat: 启动 chat.py --serve，多个会话并发对话
+- report: 在本进程中对 --hosts 台模拟主机执行一轮 report.py 巡检和分析
+- assistant: 在本进程中创建 ai-assistant.py 的助手实例，预置长对话历史和记忆后多用户并发对话
+
+结果以 JSON 输出（每个场景：请求数、错误数、耗时、吞吐量、p50/p99 延迟），--output 指定时同时写入文件。
+所有服务使用临时目录下生成的配置文件（CONFIG_FILE），不会读写仓库中的数据库。
+
+用法:
+python benchmark.py --scenarios alerts,chat,report,assistant --output results.json
+python benchmark.py --scenarios report --hosts 100 --ssh-command-delay 0.05
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+import yaml
+
+from loadtest_chat import start_stub_llm, free_port, wait_for_port, percentile, run_session
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["alerts", "chat", "report", "assistant"]
+# 模拟主机上每条命令的输出行数
+FAKE_OUTPUT_LINES = 20
+
+def summarize(scenario, latencies, errors, elapsed, **extra):
+    """场景结果：latencies 为成功请求的耗时（秒）"""
+    latencies_ms = [value * 1000 for value in latencies]
+    result = {
+        "scenario": scenario,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies_ms, 0.5), 1) if latencies_ms else None,
+        "latency_p99_ms": round(percentile(latencies_ms, 0.99), 1) if latencies_ms else None,
+    }
+    for key, value in extra.items():
+        if isinstance(value, list):
+            values = [v * 1000 for v in value if v is not None]
+            result[f"{key}_p50_ms"] = round(percentile(values, 0.5), 1) if values else None
+            result[f"{key}_p99_ms"] = round(percentile(values, 0.99), 1) if values else None
+        else:
+            result[key] = value
+    return result
+
+def write_config(path, work_dir, llm_url, args):
+    """生成基准使用的配置文件：所有服务指向模拟接口，数据写入临时目录"""
+    with open(os.path.join(REPO_DIR, "config.yaml"), "r", encoding="utf-8") as f:
+        base = yaml.safe_load(f)
+    hosts = [{"ip": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256 + 1}"} for i in range(args.hosts)]
+    config = {
+        "llm": {"api_key": "stub", "base_url": llm_url, "model": "stub-model", "timeout": 60, "max_retries": 0},
+        "alerts": {"db_path": os.path.join(work_dir, "alerts.db"), "webhook_key": "benchmark"},
+        "chat": {"db_path": os.path.join(work_dir, "chat.db"), "archive_dir": os.path.join(work_dir, "chat_archive")},
+        "cache": {"enabled": False, "dir": os.path.join(work_dir, "llm_cache")},
+        "output": {"dir": os.path.join(work_dir, "inspection")},
+        "ssh": {"port": 22, "user": "bench", "password": "bench"},
+        "ai": {"volc_key": "stub", "base_url": llm_url, "model": "stub-model", "hedge_delay": 0},
+        "inspection": dict(base.get("inspection") or {}, tier=args.tier, deep_interval=0,
+                           **({"max_workers": args.report_workers} if args.report_workers else {})),
+        "servers": hosts,
+        "commands": base.get("commands") or [],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+
+def start_service(command, port, env):
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except Exception:
+        process.terminate()
+        raise
+    return process
+
+def stop_service(process):
+    process.terminate()
+    process.wait()
+
+# ---------- alerts: webhook 风暴 ----------
+
+def alert_payload(client, index, per_request):
+    return {"alerts": [{
+        "labels": {"alertname": "HighCPU", "severity": ["warning", "critical"][j % 2],
+                   "instance": f"node-{client}-{index}-{j}"},
+        "annotations": {"summary": f"node-{client}-{index}-{j} CPU 使用率 9{j}%",
+                        "description": "CPU 使用率持续 5 分钟高于 90%"},
+    } for j in range(per_request)]}
+
+def run_alerts(args, env):
+    port = free_port()
+    # 不使用 alerts.py 的 debug 模式（自动重载），与生产部署方式一致
+    command = [sys.executable, "-c",
+               f"import alerts; alerts.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    process = start_service(command, port, env)
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    url = f"http://127.0.0.1:{port}/api/alerts"
+
+    def sender(client):
+        nonlocal errors
+        session = requests.Session()
+        for index in range(args.alert_requests):
+            started = time.perf_counter()
+            try:
+                response = session.post(url, json=alert_payload(client, index, args.alerts_per_request),
+                                        headers={"X-API-KEY": "benchmark"}, timeout=120)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+    try:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=sender, args=(i,)) for i in range(args.alert_clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_service(process)
+    return summarize("alerts", latencies, errors, elapsed, clients=args.alert_clients,
+                     alerts_per_second=round(len(latencies) * args.alerts_per_request / elapsed, 2))
+
+# ---------- chat: 并发会话 ----------
+
+def run_chat(args, env):
+    port = free_port()
+    process = start_service([sys.executable, "chat.py", "--serve"], port, dict(env, CHAT_PORT=str(port)))
+    results = []
+    lock = threading.Lock()
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_session, args=(base_url, args.chat_messages, results, lock))
+                   for _ in range(args.chat_sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_service(process)
+    done = [r for r in results if "total" in r]
+    ok = [r for r in done if r["error"] is None]
+    histories = [r for r in results if "history_length" in r]
+    return summarize("chat", [r["total"] for r in ok], len(done) - len(ok), elapsed,
+                     sessions=args.chat_sessions,
+                     first_token=[r["first_token"] for r in ok],
+                     incomplete_histories=sum(1 for r in histories if r["history_length"] != r["expected"]))
+
+# ---------- ollama 替身 ----------
+
+class FakeOllamaClient:
+    """代替 ollama.Client：嵌入请求发到模拟接口的 /api/embeddings，不提供本地模型生成"""
+    def __init__(self, host=None, timeout=None, **kwargs):
+        self.host = (host or "").rstrip("/")
+        self.timeout = timeout
+
+    def embeddings(self, model, prompt):
+        response = requests.post(f"{self.host}/api/embeddings", json={"model": model, "prompt": prompt}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def list(self):
+        return {"models": []}
+
+    def generate(self, *args, **kwargs):
+        raise RuntimeError("基准测试中没有本地模型")
+
+def install_fake_ollama():
+    """替换 ollama 包，必须在导入 report.py 和 ai-assistant.py 之前调用"""
+    module = types.ModuleType("ollama")
+    module.Client = FakeOllamaClient
+    sys.modules["ollama"] = module
+
+# ---------- report: 模拟主机巡检 ----------
+
+class FakeStream:
+    def __init__(self, data, exit_code=0):
+        self.data = data.encode("utf-8")
+        self.channel = self
+        self.exit_code = exit_code
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+class FakeSSHClient:
+    """代替 paramiko.SSHClient：连接和命令按配置的延迟返回固定输出，依赖探测报告所有命令都存在"""
+    connect_delay = 0.05
+    command_delay = 0.02
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, **kwargs):
+        time.sleep(self.connect_delay)
+
+    def exec_command(self, cmd, timeout=None):
+        time.sleep(self.command_delay)
+        probe = re.match(r"for b in (.*?); do", cmd)
+        if probe:
+            output = "\n".join(probe.group(1).split())
+        else:
+            output = "\n".join(f"{cmd} 的模拟输出 第{i}行" for i in range(FAKE_OUTPUT_LINES))
+        return None, FakeStream(output), FakeStream("")
+
+    def close(self):
+        pass
+
+def run_report(args, env):
+    report = __import__("report")
+    FakeSSHClient.connect_delay = args.ssh_connect_delay
+    FakeSSHClient.command_delay = args.ssh_command_delay
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    process_server = report.process_server
+
+    def timed_process_server(ip, *rest):
+        nonlocal errors
+        started = time.perf_counter()
+        before = set(os.listdir(report.dir_url))
+        process_server(ip, *rest)
+        # 成功时生成分析报告（html）
+        produced = any(name.startswith(f"{ip}_") and name.endswith(".html")
+                       for name in set(os.listdir(report.dir_url)) - before)
+        with lock:
+            if produced:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    import settings
+    config = settings.get()
+    # 巡检和分析过程的输出很多，基准运行期间丢弃
+    with mock.patch.object(report.paramiko, "SSHClient", FakeSSHClient), \
+            mock.patch.object(report, "process_server", timed_process_server), \
+            contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        report.run_inspection(config)
+        elapsed = time.perf_counter() - started
+    commands = len(report.select_commands(args.tier))
+    return summarize("report", latencies, errors, elapsed, hosts=len(config.servers), tier=args.tier,
+                     commands_per_host=commands, workers=min(len(config.servers), config.inspection.max_workers),
+                     hosts_per_second=round(len(latencies) / elapsed, 3))
+
+# ---------- assistant: 长历史对话 ----------
+
+def load_assistant_module():
+    spec = importlib.util.spec_from_file_location("ai_assistant", os.path.join(REPO_DIR, "ai-assistant.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def use_in_memory_qdrant(module):
+    """记忆存到内存模式的 Qdrant：create_memory 会把共享客户端传给 mem0，不连接 Qdrant 服务"""
+    try:
+        from qdrant_client import QdrantClient
+    except ImportError:
+        return
+    module._shared_clients["qdrant"] = QdrantClient(":memory:")
+
+def run_assistant(args, env, work_dir, llm_url):
+    with contextlib.redirect_stdout(io.StringIO()):
+        module = load_assistant_module()
+    module.STORAGE_CONFIG["data_dir"] = os.path.join(work_dir, "assistant_data")
+    module.STORAGE_CONFIG["embedder"]["ollama_base_url"] = llm_url.rsplit("/v1", 1)[0]
+    module.RETRIEVAL_CONFIG["show_latency"] = False
+    use_in_memory_qdrant(module)
+
+    history = []
+    for i in range(args.history_turns):
+        history.append({"role": "user", "content": f"第{i}个问题：帮我规划一次去城市{i % 37}的旅行，预算{1000 + i}元，住宿有什么建议？"})
+        history.append({"role": "assistant", "content": f"关于城市{i % 37}的建议：" + "交通、住宿和餐饮的安排。" * 8})
+
+    def prepare(user):
+        user_id = f"bench_{user}"
+        assistant = module.PersonalTravelAssistant(user_id, background=False)
+        for i in range(args.memories):
+            assistant.add_memory(f"用户{user}喜欢第{i}类旅行：海边、美食、博物馆之一，预算约{500 + i * 10}元", user_id)
+        assistant.flush_memories()
+        assistant.messages.extend(history)
+        return user_id, assistant
+
+    latencies, errors = [], 0
+    first_tokens, retrievals, prompt_tokens = [], [], []
+    lock = threading.Lock()
+
+    def converse(user_id, assistant):
+        nonlocal errors
+        for turn in range(args.assistant_turns):
+            started = time.perf_counter()
+            try:
+                for _ in assistant.stream_answer(f"结合我之前的偏好，第{turn}次旅行推荐去哪里？", user_id):
+                    pass
+                stats = assistant.turn_stats[-1]
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    first_tokens.append(stats["first_token_ms"] / 1000 if stats["first_token_ms"] is not None else None)
+                    retrievals.append(stats["retrieval_ms"] / 1000)
+                    prompt_tokens.append(stats["prompt_tokens"])
+            except Exception:
+                with lock:
+                    errors += 1
+
+    with mock.patch.dict(os.environ, {"CONFIG_FILE": env["CONFIG_FILE"]}), contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=args.assistant_users) as executor:
+            sessions = list(executor.map(prepare, range(args.assistant_users)))
+        backend = "mem0" if sessions[0][1].use_memory else f"local:{getattr(sessions[0][1].local_embedder, 'kind', None)}"
+        started = time.perf_counter()
+        threads = [threading.Thread(target=converse, args=session) for session in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        for _, assistant in sessions:
+            assistant.close()
+    tokens = [value for value in prompt_tokens if value is not None]
+    return summarize("assistant", latencies, errors, elapsed, users=args.assistant_users, backend=backend,
+                     history_messages=len(history), memories=args.memories,
+                     first_token=first_tokens, retrieval=retrievals,
+                     prompt_tokens_avg=round(sum(tokens) / len(tokens)) if tokens else None)
+
+def main():
+    parser = argparse.ArgumentParser(description="性能基准（本地替身代替模型接口、SSH和向量库）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"逗号分隔的场景: {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", help="结果写入的JSON文件")
+    group = parser.add_argument_group("模拟模型接口")
+    group.add_argument("--llm-latency", type=float, default=0.2, help="首个token延迟（秒）")
+    group.add_argument("--llm-tps", type=float, default=100, help="每秒输出的token数")
+    group.add_argument("--llm-tokens", type=int, default=40, help="每个回答的token数")
+    group = parser.add_argument_group("alerts")
+    group.add_argument("--alert-clients", type=int, default=20, help="并发发送 webhook 的客户端数")
+    group.add_argument("--alert-requests", type=int, default=5, help="每个客户端发送的请求数")
+    group.add_argument("--alerts-per-request", type=int, default=2, help="每个请求包含的告警数")
+    group = parser.add_argument_group("chat")
+    group.add_argument("--chat-sessions", type=int, default=50, help="并发会话数")
+    group.add_argument("--chat-messages", type=int, default=3, help="每个会话发送的消息数")
+    group = parser.add_argument_group("report")
+    group.add_argument("--hosts", type=int, default=100, help="模拟主机数")
+    group.add_argument("--tier", choices=["quick", "standard", "deep"], default="standard", help="巡检级别")
+    group.add_argument("--report-workers", type=int, help="同时巡检的主机数（默认使用 config.yaml 的 inspection.max_workers）")
+    group.add_argument("--ssh-connect-delay", type=float, default=0.05, help="SSH连接耗时（秒）")
+    group.add_argument("--ssh-command-delay", type=float, default=0.02, help="每条远程命令耗时（秒）")
+    group = parser.add_argument_group("assistant")
+    group.add_argument("--assistant-users", type=int, default=4, help="并发用户数")
+    group.add_argument("--assistant-turns", type=int, default=5, help="每个用户的对话轮数")
+    group.add_argument("--history-turns", type=int, default=200, help="预置的历史对话轮数")
+    group.add_argument("--memories", type=int, default=200, help="每个用户预置的记忆条数")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(sorted(unknown))}")
+
+    install_fake_ollama()
+    stub = start_stub_llm(args.llm_tokens, 1 / args.llm_tps, args.llm_latency)
+    llm_url = f"http://127.0.0.1:{stub.server_address[1]}/v1"
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_file = os.path.join(work_dir, "config.yaml")
+        write_config(config_file, work_dir, llm_url, args)
+        # 本进程和子进程都只读取生成的配置文件，去掉可能覆盖它的环境变量
+        os.environ["CONFIG_FILE"] = config_file
+        env = dict(os.environ)
+        for name in ("LLM_API_KEY", "LLM_BASE_URL", "LLM_MODEL", "DB_PATH", "ALERTS_DB_PATH", "ALERTS_API_KEY",
+                     "CHAT_PORT", "LLM_CACHE", "REPORT_API_KEY"):
+            env.pop(name, None)
+            os.environ.pop(name, None)
+        runners = {
+            "alerts": lambda: run_alerts(args, env),
+            "chat": lambda: run_chat(args, env),
+            "report": lambda: run_report(args, env),
+            "assistant": lambda: run_assistant(args, env, work_dir, llm_url),
+        }
+        for name in scenarios:
+            print(f"运行场景: {name}", file=sys.stderr)
+            try:
+                results.append(runners[name]())
+            except ImportError as e:
+                results.append({"scenario": name, "skipped": f"缺少依赖: {str(e)}"})
+            except Exception as e:
+                results.append({"scenario": name, "failed": str(e)})
+    stub.shutdown()
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "stub_llm": {"first_token_latency_s": args.llm_latency, "tokens_per_second": args.llm_tps,
+                     "tokens": args.llm_tokens},
+        "results": results,
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,85 @@
 # import psycopg2
 
-from openai import OpenAI
 import uuid
 from datetime import datetime
 import sqlite3
 import os
+import time
+import gzip
+import re
+import hmac
+import json
+import queue
+import argparse
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify
+from token_counter import count_tokens, count_message_tokens
+from prompts import build_messages, record_usage
+from response_cache import get_response_cache
+import settings
+import metrics
 
-# OpenAI客户端配置
-client = OpenAI(
-    api_key="xai-xxx",
-    base_url="https://api.x.ai/v1",
-)
+# 模型接口、模型和并发上限在 config.yaml 的 llm、chat 段配置（见 settings.py），服务运行中修改会热加载
 
-# 从环境变量获取数据库路径
-DB_PATH = os.environ.get("DB_PATH", "chat.db")
+# 系统提示，作为每次请求的固定前缀，不要在其中加入时间等会变化的内容
+SYSTEM_PROMPT = "你是一个专业、友好和富有同理心的AI助手。你会：\n1. 提供准确和有见地的回答\n2. 保持对话的连贯性和上下文\n3. 在必要时承认知识的局限性\n4. 以礼貌和专业的方式交流"
+
+# HTTP服务配置（python chat.py --serve），端口修改后需要重启
+SERVER_PORT = settings.get().chat.port
+# 模型请求线程数上限。请求先在HTTP线程中按 chat.max_streams 排队，拿到名额后才提交到线程池，
+# 线程按需创建，实际线程数等于同时进行的请求数；max_streams 热加载调大到超过此值时，多出的请求在线程池队列中等待
+MAX_STREAM_THREADS = 256
+SESSION_ID_PATTERN = re.compile(r"[\w\-]{1,64}")
+
+# 数据库路径，修改后需要重启
+DB_PATH = settings.get().chat.db_path
+
+# 每轮请求携带的最近历史消息条数
+HISTORY_LIMIT = 100
+# 进程内缓存最近历史的会话数，写入消息后同步更新，不必每轮重新读库
+HISTORY_CACHE_SIZE = 1000
+
+# 建表后新增的字段：按消息记录的token统计，以及助手消息的状态
+# （streaming 生成中 / complete 完成 / error 出错，旧数据为空视为完成）
+ADDED_COLUMNS = {
+    "content_tokens": "INTEGER",
+    "prompt_tokens": "INTEGER",
+    "completion_tokens": "INTEGER",
+    "usage_source": "TEXT",
+    "status": "TEXT",
+    "cached_tokens": "INTEGER",
+}
+
+# 生成过程中把已收到的回答写入数据库的间隔（秒），进程中断时最多丢失这段时间的内容
+CHECKPOINT_INTERVAL = 2.0
+# 等待其他连接释放写锁的最长时间（秒）
+DB_BUSY_TIMEOUT = 30
+
+# 会话归档（python chat.py --archive）：最后一条消息早于 ARCHIVE_AFTER_DAYS 天的会话
+# 移出在线表，按最后活跃日期写入 ARCHIVE_DIR 下的压缩文件，索引记录在 chat_archive_index 表
+ARCHIVE_DIR = settings.get().chat.archive_dir
+ARCHIVE_AFTER_DAYS = settings.get().chat.archive_after_days
+# 每批归档的会话数，每批删除是一个短事务
+ARCHIVE_BATCH_SESSIONS = 200
+# 每批删除后回收的空闲页数
+ARCHIVE_VACUUM_PAGES = 2000
+# 安装了 zstandard 时使用的压缩级别，未安装时用 gzip
+ARCHIVE_ZSTD_LEVEL = 10
+# 归档文件中每条消息保存的字段
+ARCHIVE_COLUMNS = ["id", "session_id", "role", "content", "model", "token_usage", "timestamp", *ADDED_COLUMNS]
+
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
 
 def init_database():
     """初始化数据库，创建必要的表"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        # 新建的数据库开启增量回收，归档删除后可以分批释放空间（已有数据库见 ensure_incremental_vacuum）
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS chat_sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,97 +91,302 @@ def init_database():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # WAL模式下读写互不阻塞，写事务只需等待其他写事务
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # 按会话读取最近历史时走索引，不随表增大而全表扫描
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_session ON chat_sessions (session_id, id)")
+        # token统计字段：消息本身的token数；助手消息另记本轮请求的提示/生成token数及来源（usage 或 estimate）
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(chat_sessions)")}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE chat_sessions ADD COLUMN {column} {column_type}")
+        # 归档索引：每次归档写入的压缩块一行，同一会话可能有多块（按 first_id 顺序拼接）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_archive_index (
+                session_id TEXT NOT NULL,
+                archive_file TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                last_timestamp DATETIME,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_archive_session ON chat_archive_index (session_id, first_id)")
         conn.commit()
 
 def get_db_connection():
     """创建SQLite数据库连接"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
-def get_conversation_history(cursor, session_id, limit=100):
-    """获取历史对话记录"""
+def get_conversation_history(cursor, session_id, limit=HISTORY_LIMIT):
+    """获取最近的 limit 条历史对话记录（按时间顺序），优先从进程内缓存读取"""
+    with _history_cache_lock:
+        cached = _history_cache.get(session_id)
+        if cached is not None and (len(cached[1]) >= limit or cached[0]):
+            _history_cache.move_to_end(session_id)
+            return [dict(message) for message in cached[1][-limit:]]
+
+    # 沿 (session_id, id) 索引倒序取最近的消息再翻转
     cursor.execute(
-        "SELECT role, content FROM chat_sessions WHERE session_id=? AND role != 'system' ORDER BY timestamp ASC LIMIT ?",
+        "SELECT role, content FROM chat_sessions WHERE session_id=? AND role != 'system' "
+        "AND (status IS NULL OR status='complete') ORDER BY id DESC LIMIT ?",
         (session_id, limit)
     )
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    return messages
+    messages = [{"role": row[0], "content": row[1]} for row in reversed(cursor.fetchall())]
+    # 在线表不足 limit 条时，更早的消息可能已归档
+    if len(messages) < limit:
+        archived = [
+            {"role": m["role"], "content": m["content"]}
+            for m in load_archived_messages(cursor, session_id)
+            if m["role"] != "system" and m.get("status") in (None, "complete")
+        ]
+        messages = archived[-(limit - len(messages)):] + messages if archived else messages
+    # 读到的条数少于 limit 说明已是该会话的全部历史
+    _cache_history(session_id, messages, complete=len(messages) < limit)
+    return [dict(message) for message in messages]
 
-def save_message(cursor, session_id, role, content, model=None, token_usage=None):
-    """保存对话消息到数据库"""
+def _cache_history(session_id, messages, complete=False):
+    with _history_cache_lock:
+        _history_cache[session_id] = (complete, [dict(message) for message in messages][-HISTORY_LIMIT:])
+        _history_cache.move_to_end(session_id)
+        while len(_history_cache) > HISTORY_CACHE_SIZE:
+            _history_cache.popitem(last=False)
+
+def append_cached_history(session_id, messages):
+    """消息提交到数据库后追加到缓存；缓存中没有该会话时不处理，下次读取时从数据库加载"""
+    with _history_cache_lock:
+        cached = _history_cache.get(session_id)
+        if cached is None:
+            return
+        complete, history = cached
+        history.extend(dict(message) for message in messages if message["role"] != "system")
+        # 超出缓存上限后截断，已不再是完整历史
+        if len(history) > HISTORY_LIMIT:
+            del history[:-HISTORY_LIMIT]
+            complete = False
+        _history_cache[session_id] = (complete, history)
+        _history_cache.move_to_end(session_id)
+
+def get_session_messages(cursor, session_id, limit=50, before_id=None):
+    """分页读取会话的完整消息记录（含ID、模型、token和时间），before_id 之前的最近 limit 条"""
     cursor.execute(
-        "INSERT INTO chat_sessions (session_id, role, content, model, token_usage) VALUES (?, ?, ?, ?, ?)",
-        (session_id, role, content, model, token_usage)
+        "SELECT id, role, content, model, token_usage, status, timestamp FROM chat_sessions "
+        "WHERE session_id=? AND id<? ORDER BY id DESC LIMIT ?",
+        (session_id, before_id if before_id is not None else 2 ** 63 - 1, limit)
     )
+    columns = ["id", "role", "content", "model", "token_usage", "status", "timestamp"]
+    messages = [dict(zip(columns, row)) for row in reversed(cursor.fetchall())]
+    if len(messages) < limit:
+        oldest_id = messages[0]["id"] if messages else before_id
+        archived = [
+            {column: m.get(column) for column in columns}
+            for m in load_archived_messages(cursor, session_id)
+            if oldest_id is None or m["id"] < oldest_id
+        ]
+        messages = archived[-(limit - len(messages)):] + messages if archived else messages
+    return messages
 
-def get_ai_response(conversation):
-    """获取AI的流式响应"""
-    # 添加系统提示
-    system_message = {
-        "role": "system",
-        "content": "你是一个专业、友好和富有同理心的AI助手。你会：\n1. 提供准确和有见地的回答\n2. 保持对话的连贯性和上下文\n3. 在必要时承认知识的局限性\n4. 以礼貌和专业的方式交流"
-    }
-    
-    # 确保系统提示始终在对话开始
-    if not conversation or conversation[0].get("role") != "system":
-        full_conversation = [system_message] + conversation
-    else:
-        full_conversation = conversation
+def save_message(cursor, session_id, role, content, model=None, token_usage=None, usage=None, status=None):
+    """保存对话消息到数据库，返回消息ID；usage 为助手消息的token统计（见 get_ai_response）"""
+    usage = usage or {}
+    content_tokens = usage.get("completion_tokens") if role == "assistant" and usage else count_tokens(content)
+    cursor.execute(
+        "INSERT INTO chat_sessions (session_id, role, content, model, token_usage, content_tokens, prompt_tokens, completion_tokens, usage_source, status, cached_tokens) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (session_id, role, content, model, token_usage, content_tokens,
+         usage.get("prompt_tokens"), usage.get("completion_tokens"), usage.get("source"), status, usage.get("cached_tokens"))
+    )
+    return cursor.lastrowid
 
-    stream = client.chat.completions.create(
-        model="grok-2-latest",
-        messages=full_conversation,
-        stream=True
+def update_message(cursor, message_id, content, status, model=None, token_usage=None, usage=None):
+    """更新生成中的助手消息：保存已收到的内容，完成时写入模型和token统计"""
+    usage = usage or {}
+    cursor.execute(
+        "UPDATE chat_sessions SET content=?, status=?, model=COALESCE(?, model), token_usage=?, content_tokens=?, "
+        "prompt_tokens=?, completion_tokens=?, usage_source=?, cached_tokens=? WHERE id=?",
+        (content, status, model, token_usage, usage.get("completion_tokens"),
+         usage.get("prompt_tokens"), usage.get("completion_tokens"), usage.get("source"),
+         usage.get("cached_tokens"), message_id)
     )
-    
-    assistant_response = ""
-    last_chunk = None
-    
-    for chunk in stream:
-        if chunk.choices[0].delta.content:
-            content = chunk.choices[0].delta.content
-            print(content, end="", flush=True)  # 逐步输出
-            assistant_response += content
-        last_chunk = chunk
-    
-    # 使用最后一个chunk来获取模型信息
-    assistant_model = last_chunk.model
-    
-    # 在流式响应中，usage信息可能只在最后一个chunk中可用
-    assistant_usage = getattr(last_chunk, 'usage', None)
-    if assistant_usage:
-        assistant_usage = assistant_usage.total_tokens
+
+def set_message_status(cursor, message_id, status):
+    """只更新消息状态（用户消息随助手回答一起完成或失败）"""
+    cursor.execute("UPDATE chat_sessions SET status=? WHERE id=?", (status, message_id))
+
+def print_token(content):
+    print(content, end="", flush=True)  # 逐步输出
+
+# 接口是否支持 stream_options（不支持时回退为本地计数，之后不再尝试）
+_stream_usage_supported = True
+
+def get_ai_response(conversation, on_token=print_token):
+    """获取AI的流式响应，每收到一段内容调用一次 on_token
+
+    返回 (回答, 模型, token统计)。token统计优先使用接口在流末尾返回的 usage，
+    接口不支持时用本地分词器计数：{"prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens", "source"}，
+    cached_tokens 为命中前缀缓存的提示token数，接口未返回时为None；命中响应缓存时 source 为 "cache"，token数为0
+    """
+    global _stream_usage_supported
+    # 每次请求读取当前配置，热加载后的模型和接口地址从下一次请求开始生效
+    config = settings.get()
+    client = settings.get_openai_client(config.llm)
+    model = config.model_for("chat")
+    # 固定的系统提示在前，历史按顺序在后，本轮问题最后
+    full_conversation = build_messages(SYSTEM_PROMPT, conversation[-1]["content"], conversation[:-1])
+
+    # 开启响应缓存时，相同或相近的问题（历史相同）直接返回缓存的回答，不计token
+    cache = get_response_cache("chat")
+    lookup = cache.lookup(model, full_conversation) if cache is not None else None
+    if lookup is not None and lookup.response is not None:
+        on_token(lookup.response)
+        return lookup.response, model, {
+            "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": None, "source": "cache",
+        }
+
+    # 记录首个内容片段耗时和总耗时（见 metrics.py）
+    started = time.perf_counter()
+    first_token_at = None
+    with metrics.span("llm.request", caller="chat", model=model):
+        try:
+            stream = None
+            if _stream_usage_supported:
+                try:
+                    # 请求接口在流的最后一个chunk中返回本次的token用量
+                    stream = client.chat.completions.create(
+                        model=model,
+                        messages=full_conversation,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                except Exception as e:
+                    if "stream_options" not in str(e):
+                        raise
+                    _stream_usage_supported = False
+            if stream is None:
+                stream = client.chat.completions.create(
+                    model=model,
+                    messages=full_conversation,
+                    stream=True
+                )
+
+            assistant_response = ""
+            assistant_model = model
+            usage = None
+
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    on_token(content)
+                    assistant_response += content
+                assistant_model = getattr(chunk, 'model', None) or assistant_model
+                # usage 只出现在最后一个chunk（其 choices 为空）
+                usage = getattr(chunk, 'usage', None) or usage
+        except Exception:
+            metrics.observe_llm("chat", model, started, first_token_at, status="error")
+            raise
+    metrics.observe_llm("chat", model, started, first_token_at)
+
+    if usage is not None:
+        usage = {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+            "cached_tokens": record_usage("chat", full_conversation, usage),
+            "source": "usage",
+        }
     else:
-        # 如果在流式响应中无法获取usage，可以估算或使用默认值
-        assistant_usage = len(assistant_response.split()) * 2  # 粗略估计
+        # 接口没有返回usage时用本地分词器计数
+        prompt_tokens = count_message_tokens(full_conversation)
+        completion_tokens = count_tokens(assistant_response)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cached_tokens": None,
+            "source": "estimate",
+        }
+        record_usage("chat", full_conversation, usage)
+
+    if lookup is not None:
+        cache.store(lookup, assistant_response)
     
-    return assistant_response, assistant_model, assistant_usage
+    return assistant_response, assistant_model, usage
 
-def chat_with_openapi(session_id, user_input):
-    """处理用户输入并返回AI响应"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+# 每个会话一把锁，同一会话的并发消息按顺序处理，避免历史交错
+_session_locks = weakref.WeakValueDictionary()
+_session_locks_guard = threading.Lock()
+
+def get_session_lock(session_id):
+    with _session_locks_guard:
+        lock = _session_locks.get(session_id)
+        if lock is None:
+            lock = threading.Lock()
+            _session_locks[session_id] = lock
+        return lock
+
+def chat_with_openapi(session_id, user_input, on_token=print_token):
+    """处理用户输入并返回AI响应
+
+    每次写入都是单独的短事务，生成回答期间不持有写锁：先提交用户消息和一条生成中的助手消息，
+    生成过程中每隔 CHECKPOINT_INTERVAL 秒保存一次已收到的内容，结束时写入完整回答和token统计。
+    用户消息在回答完成时才和助手消息一起标记为 complete（并加入历史缓存）；出错时两条都标记为 error，
+    进程中断时停留在 streaming，这些消息都不会作为后续对话的上下文。
+    """
+    with get_session_lock(session_id):
+        conn = get_db_connection()
         try:
             # 获取对话历史
-            conversation = get_conversation_history(cursor, session_id)
+            conversation = get_conversation_history(conn.cursor(), session_id)
             conversation.append({"role": "user", "content": user_input})
             
-            # 保存用户消息
-            save_message(cursor, session_id, "user", user_input)
+            # 保存用户消息，并占位一条生成中的助手消息
+            with metrics.DB_WRITE_SECONDS.time(db="chat", op="start"), conn:
+                user_message_id = save_message(conn.cursor(), session_id, "user", user_input, status="streaming")
+                message_id = save_message(conn.cursor(), session_id, "assistant", "", settings.get().model_for("chat"), status="streaming")
             
+            received = []
+            last_checkpoint = time.time()
+
+            def on_chunk(content):
+                nonlocal last_checkpoint
+                received.append(content)
+                on_token(content)
+                if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    with metrics.DB_WRITE_SECONDS.time(db="chat", op="checkpoint"), conn:
+                        update_message(conn.cursor(), message_id, "".join(received), "streaming")
+                    last_checkpoint = time.time()
+
             # 获取AI响应
-            assistant_response, assistant_model, assistant_usage = get_ai_response(conversation)
+            try:
+                assistant_response, assistant_model, usage = get_ai_response(conversation, on_chunk)
+            except Exception:
+                with metrics.DB_WRITE_SECONDS.time(db="chat", op="error"), conn:
+                    set_message_status(conn.cursor(), user_message_id, "error")
+                    update_message(conn.cursor(), message_id, "".join(received), "error")
+                raise
+            assistant_usage = usage["total_tokens"]
             
             # 保存AI响应（包含模型信息和token使用量）
-            save_message(cursor, session_id, "assistant", assistant_response, assistant_model, assistant_usage)
-            
-            conn.commit()
+            with metrics.DB_WRITE_SECONDS.time(db="chat", op="complete"), conn:
+                set_message_status(conn.cursor(), user_message_id, "complete")
+                update_message(conn.cursor(), message_id, assistant_response, "complete",
+                               assistant_model, assistant_usage, usage)
+            append_cached_history(session_id, [{"role": "user", "content": user_input},
+                                               {"role": "assistant", "content": assistant_response}])
             return assistant_response, assistant_model, assistant_usage
 
         except Exception as e:
-            conn.rollback()
             print(f"错误: {str(e)}")
             raise e
+        finally:
+            conn.close()
 
 def generate_session_id():
     """生成唯一的会话ID"""
@@ -130,6 +396,333 @@ def generate_session_id():
     short_uuid = str(uuid.uuid4())[:8]
     return f"{timestamp}_{short_uuid}"
 
+# token用量报表的分组方式
+USAGE_GROUPS = {
+    "session": "session_id",
+    "day": "date(timestamp)",
+    "model": "model",
+}
+
+def get_usage_report(cursor, group_by="day", days=None, limit=50):
+    """按会话/日期/模型汇总助手消息的token用量，按总量降序
+
+    平均提示token和最大提示token能看出历史越来越长、每轮成本不断上涨的会话。
+    缓存命中为接口返回的命中前缀缓存的提示token数（接口不返回时为空）。
+    """
+    group = USAGE_GROUPS[group_by]
+    where = "role='assistant'"
+    params = []
+    if days:
+        where += " AND timestamp >= datetime('now', ?)"
+        params.append(f"-{int(days)} days")
+    cursor.execute(f"""
+        SELECT {group} AS grp, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), SUM(token_usage),
+               CAST(ROUND(AVG(prompt_tokens)) AS INTEGER), MAX(prompt_tokens), SUM(usage_source='estimate')
+        FROM chat_sessions WHERE {where}
+        GROUP BY grp ORDER BY SUM(token_usage) DESC LIMIT ?
+    """, params + [limit])
+    columns = [group_by, "turns", "prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens",
+               "avg_prompt_tokens", "max_prompt_tokens", "estimated_turns"]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def print_usage_report(group_by="day", days=None, limit=50):
+    """打印token用量报表"""
+    init_database()
+    with get_db_connection() as conn:
+        rows = get_usage_report(conn.cursor(), group_by, days, limit)
+    headers = [group_by, "轮数", "提示", "缓存命中", "生成", "总计", "平均提示", "最大提示", "估算轮数"]
+    print(" | ".join(headers))
+    print("-" * 80)
+    for row in rows:
+        print(" | ".join(str(value if value is not None else "-") for value in row.values()))
+
+def _archive_codec():
+    """归档文件的扩展名和压缩函数：安装了 zstandard 时用 zstd，否则用 gzip"""
+    try:
+        import zstandard
+    except ImportError:
+        return ".jsonl.gz", gzip.compress
+    return ".jsonl.zst", zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress
+
+def _decompress_archive(archive_file, data):
+    """按文件扩展名解压一个归档块"""
+    if archive_file.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+def load_archived_messages(cursor, session_id):
+    """从归档文件读取会话的全部消息（按ID升序），未归档的会话返回空列表"""
+    cursor.execute(
+        "SELECT archive_file, offset, length FROM chat_archive_index WHERE session_id=? ORDER BY first_id",
+        (session_id,)
+    )
+    messages = []
+    # 先按字符串过滤，只解析该会话的行
+    marker = json.dumps({"session_id": session_id}, ensure_ascii=False)[1:-1]
+    for archive_file, offset, length in cursor.fetchall():
+        try:
+            with open(os.path.join(ARCHIVE_DIR, archive_file), "rb") as f:
+                f.seek(offset)
+                data = _decompress_archive(archive_file, f.read(length))
+        except Exception as e:
+            print(f"读取归档 {archive_file} 失败: {str(e)}")
+            continue
+        # 一个压缩块包含同一天归档的一批会话
+        for line in data.decode("utf-8").splitlines():
+            if marker not in line:
+                continue
+            record = json.loads(line)
+            if record["session_id"] == session_id:
+                messages.append(record)
+    return messages
+
+def ensure_incremental_vacuum(conn):
+    """已有数据库未开启增量回收时切换过去，需要执行一次完整 VACUUM（期间锁库）"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    print("数据库未开启增量回收，执行一次完整 VACUUM 切换（只需一次，期间聊天写入会等待）...")
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+def database_stats(conn, samples=200):
+    """数据库大小、行数，随机抽样会话读取最近历史的延迟（不经过缓存）和用量报表耗时"""
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = sum(os.path.getsize(DB_PATH + suffix) for suffix in ("", "-wal") if os.path.exists(DB_PATH + suffix))
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    session_ids = [row[0] for row in conn.execute(
+        "SELECT session_id FROM (SELECT DISTINCT session_id FROM chat_sessions) ORDER BY RANDOM() LIMIT ?", (samples,))]
+    latencies = []
+    for session_id in session_ids:
+        started = time.perf_counter()
+        conn.execute(
+            "SELECT role, content FROM chat_sessions WHERE session_id=? AND role != 'system' "
+            "AND (status IS NULL OR status='complete') ORDER BY id DESC LIMIT ?",
+            (session_id, HISTORY_LIMIT)
+        ).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    # 用量报表需要扫描整表，耗时随在线表大小增长
+    started = time.perf_counter()
+    get_usage_report(conn.cursor(), "day")
+    report_ms = (time.perf_counter() - started) * 1000
+    return {
+        "db_mb": round(size / 1024 / 1024, 2),
+        "free_mb": round(conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size / 1024 / 1024, 2),
+        "messages": conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0],
+        "sessions": conn.execute("SELECT COUNT(DISTINCT session_id) FROM chat_sessions").fetchone()[0],
+        "history_p50_ms": round(latencies[len(latencies) // 2], 3) if latencies else None,
+        "history_p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3) if latencies else None,
+        "usage_report_ms": round(report_ms, 1),
+    }
+
+def _archive_batch(conn, day, session_ids, extension, compress):
+    """把一批同一天的会话写成一个压缩块追加到当天的归档文件，再在一个短事务中登记索引并删除在线数据"""
+    placeholders = ",".join("?" * len(session_ids))
+    cursor = conn.execute(
+        f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM chat_sessions WHERE session_id IN ({placeholders}) ORDER BY session_id, id",
+        session_ids
+    )
+    lines = []
+    entries = {}
+    for row in cursor:
+        record = dict(zip(ARCHIVE_COLUMNS, row))
+        lines.append(json.dumps(record, ensure_ascii=False))
+        entry = entries.setdefault(record["session_id"], {"first_id": record["id"], "messages": 0})
+        entry["last_id"] = record["id"]
+        entry["last_timestamp"] = record["timestamp"]
+        entry["messages"] += 1
+    if not lines:
+        return 0, 0
+    data = compress("\n".join(lines).encode("utf-8"))
+
+    # 先落盘归档再删除；中途失败最多在归档文件里留下未登记的块，不会丢消息
+    archive_file = day + extension
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, archive_file), "ab") as f:
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO chat_archive_index (session_id, archive_file, offset, length, first_id, last_id, messages, last_timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(session_id, archive_file, offset, len(data), entry["first_id"], entry["last_id"],
+              entry["messages"], entry["last_timestamp"]) for session_id, entry in entries.items()]
+        )
+        # 只删除已写入归档的消息，归档期间新写入的消息保留在在线表
+        for session_id, entry in entries.items():
+            conn.execute("DELETE FROM chat_sessions WHERE session_id=? AND id<=?", (session_id, entry["last_id"]))
+    return len(lines), len(data)
+
+def archive_sessions(older_than_days=ARCHIVE_AFTER_DAYS, dry_run=False):
+    """归档最后一条消息早于 older_than_days 天的会话，返回归档前后的数据库统计"""
+    init_database()
+    conn = get_db_connection()
+    try:
+        before = database_stats(conn)
+        rows = conn.execute(
+            "SELECT session_id, date(MAX(timestamp)) FROM chat_sessions GROUP BY session_id "
+            "HAVING MAX(timestamp) < datetime('now', ?) ORDER BY 2",
+            (f"-{int(older_than_days)} days",)
+        ).fetchall()
+        by_day = {}
+        for session_id, day in rows:
+            by_day.setdefault(day, []).append(session_id)
+        result = {"older_than_days": older_than_days, "sessions": len(rows), "days": len(by_day), "before": before}
+        if dry_run or not rows:
+            return result
+
+        ensure_incremental_vacuum(conn)
+        extension, compress = _archive_codec()
+        archived_messages = archived_bytes = 0
+        started = time.perf_counter()
+        for day, session_ids in by_day.items():
+            for start in range(0, len(session_ids), ARCHIVE_BATCH_SESSIONS):
+                count, size = _archive_batch(conn, day, session_ids[start:start + ARCHIVE_BATCH_SESSIONS], extension, compress)
+                archived_messages += count
+                archived_bytes += size
+                # 每批只回收一部分空闲页，避免长时间占用写锁
+                conn.execute(f"PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})").fetchall()
+                conn.commit()
+        while conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            conn.execute(f"PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})").fetchall()
+            conn.commit()
+
+        result.update({
+            "messages": archived_messages,
+            "archive_mb": round(archived_bytes / 1024 / 1024, 2),
+            "archive_format": extension,
+            "seconds": round(time.perf_counter() - started, 2),
+            "after": database_stats(conn),
+        })
+        return result
+    finally:
+        conn.close()
+
+# 模型请求线程池；同时进行的流式请求数由 stream_limit 限制，上限可热加载调整
+stream_executor = ThreadPoolExecutor(max_workers=MAX_STREAM_THREADS, thread_name_prefix="chat-stream")
+stream_limit = settings.ConcurrencyLimit(settings.get().chat.max_streams)
+settings.on_reload(lambda old, new: stream_limit.resize(new.chat.max_streams))
+metrics.track_limit("chat_streams", stream_limit)
+
+def submit_chat(session_id, user_input, on_token):
+    """超过 chat.max_streams 时在调用线程中排队，拿到名额后提交到线程池，结束时释放名额
+
+    排队的请求不占用线程池的线程，突发请求不会创建大量阻塞等待的线程。
+    """
+    stream_limit.acquire()
+    try:
+        future = stream_executor.submit(chat_with_openapi, session_id, user_input, on_token)
+    except Exception:
+        stream_limit.release()
+        raise
+    future.add_done_callback(lambda _: stream_limit.release())
+    return future
+
+def sse(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def create_app():
+    """创建聊天HTTP服务"""
+    app = Flask(__name__)
+    # GET /metrics 导出 Prometheus 指标（见 metrics.py）
+    metrics.instrument_app(app, "chat")
+
+    @app.before_request
+    def check_api_key():
+        # 会话ID即可读取完整的聊天记录，用量报表还会列出会话ID，接口必须鉴权；/metrics 不含会话数据，不需要密钥
+        if request.endpoint == "metrics":
+            return None
+        api_key = settings.get().chat.api_key
+        if not api_key:
+            # 未配置密钥时只接受本机请求
+            if request.remote_addr in ("127.0.0.1", "::1"):
+                return None
+            return jsonify({"message": "Unauthorized"}), 401
+        request_api_key = request.headers.get("X-API-KEY") or ""
+        if not hmac.compare_digest(request_api_key.encode(), api_key.encode()):
+            return jsonify({"message": "Unauthorized"}), 401
+        return None
+
+    @app.route("/api/sessions", methods=["POST"])
+    def create_session():
+        return jsonify({"session_id": generate_session_id()}), 201
+
+    @app.route("/api/sessions/<session_id>/messages", methods=["GET"])
+    def list_messages(session_id):
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            return jsonify({"message": "Invalid session_id"}), 400
+        limit = min(request.args.get("limit", 50, type=int), 500)
+        before_id = request.args.get("before_id", type=int)
+        with get_db_connection() as conn:
+            messages = get_session_messages(conn.cursor(), session_id, limit, before_id)
+        return jsonify({"session_id": session_id, "messages": messages})
+
+    @app.route("/api/usage", methods=["GET"])
+    def usage_report():
+        group_by = request.args.get("by", "day")
+        if group_by not in USAGE_GROUPS:
+            return jsonify({"message": f"by must be one of {', '.join(USAGE_GROUPS)}"}), 400
+        days = request.args.get("days", type=int)
+        limit = min(request.args.get("limit", 50, type=int), 1000)
+        with get_db_connection() as conn:
+            rows = get_usage_report(conn.cursor(), group_by, days, limit)
+        return jsonify({"by": group_by, "rows": rows})
+
+    @app.route("/api/cache", methods=["GET"])
+    def cache_stats():
+        cache = get_response_cache("chat")
+        return jsonify(cache.stats() if cache is not None else {"enabled": False})
+
+    @app.route("/api/sessions/<session_id>/messages", methods=["POST"])
+    def post_message(session_id):
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            return jsonify({"message": "Invalid session_id"}), 400
+        data = request.get_json(silent=True) or {}
+        user_input = (data.get("content") or "").strip()
+        if not user_input:
+            return jsonify({"message": "Empty content"}), 400
+
+        tokens = queue.Queue()
+        # 模型请求在线程池中执行，内容通过队列逐段传给响应；客户端断开后本轮仍会完成并保存
+        future = submit_chat(session_id, user_input, tokens.put)
+        future.add_done_callback(lambda _: tokens.put(None))
+
+        if not data.get("stream", True):
+            try:
+                response, model, usage = future.result()
+            except Exception as e:
+                return jsonify({"message": f"对话出错: {str(e)}"}), 500
+            return jsonify({"session_id": session_id, "content": response, "model": model, "token_usage": usage})
+
+        def generate():
+            while True:
+                content = tokens.get()
+                if content is None:
+                    break
+                yield sse({"content": content})
+            try:
+                response, model, usage = future.result()
+                yield sse({"done": True, "model": model, "token_usage": usage})
+            except Exception as e:
+                yield sse({"error": str(e)})
+
+        return Response(generate(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return app
+
+def serve(port=SERVER_PORT):
+    """以HTTP服务方式运行"""
+    init_database()
+    settings.watch()
+    if not settings.get().chat.api_key:
+        print("未配置 chat.api_key（或环境变量 CHAT_API_KEY），只接受本机请求")
+    create_app().run(host=settings.get().chat.host, port=port, threaded=True)
+
 def main():
     """主函数：循环处理用户输入，直到用户按下 Ctrl+C 终止"""
     # 确保数据库和表已创建
@@ -165,4 +758,20 @@ def main():
         print("="*50)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AI聊天")
+    parser.add_argument("--serve", action="store_true", help="以HTTP服务方式运行")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="服务端口")
+    parser.add_argument("--usage-report", choices=list(USAGE_GROUPS), help="按会话/日期/模型汇总token用量")
+    parser.add_argument("--days", type=int, help="用量报表只统计最近几天")
+    parser.add_argument("--archive", action="store_true", help="归档不活跃的会话并回收数据库空间")
+    parser.add_argument("--older-than", type=int, default=ARCHIVE_AFTER_DAYS, help="归档最后一条消息早于几天的会话")
+    parser.add_argument("--dry-run", action="store_true", help="只统计要归档的会话，不做修改")
+    args = parser.parse_args()
+    if args.usage_report:
+        print_usage_report(args.usage_report, args.days)
+    elif args.archive:
+        print(json.dumps(archive_sessions(args.older_than, args.dry_run), ensure_ascii=False, indent=2))
+    elif args.serve:
+        serve(args.port)
+    else:
+        main()
\ No newline at end of file
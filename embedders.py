@@ -0,0 +1,59 @@
+"""文本嵌入工具（个人助手的本地向量索引和模型响应缓存共用）
+
+优先使用Ollama的语义嵌入（nomic-embed-text 等），不可用时使用字符n-gram哈希向量。
+两种向量的相似度分数不可比，调用方按嵌入方式（isinstance 或 kind）分别设置阈值。
+调用方在未安装 numpy 时不应创建嵌入器。
+"""
+import zlib
+
+import requests
+
+try:
+    import numpy as np
+except ImportError:  # 调用方只做精确匹配或按时间返回
+    np = None
+
+def normalize_text(text):
+    """默认的归一化：小写、合并空白"""
+    return " ".join(text.lower().split())
+
+class OllamaEmbedder:
+    """通过Ollama的HTTP接口生成语义嵌入，创建时请求一次以探测服务和向量维度
+
+    kind 用于区分向量文件和条目，默认包含维度（换模型后旧向量不再使用）。
+    """
+    def __init__(self, base_url, model, timeout=5, kind=None):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.dims = len(self._request("ping"))
+        self.kind = kind or f"ollama{self.dims}"
+
+    def _request(self, text):
+        response = requests.post(f"{self.base_url}/api/embeddings",
+                                 json={"model": self.model, "prompt": text}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["embedding"]
+
+    def embed(self, text):
+        return np.asarray(self._request(text), dtype=np.float32)
+
+class HashingEmbedder:
+    """离线嵌入：把字符1-3元组哈希到固定维度，无需模型服务，中文同样适用
+
+    normalize 决定哪些文本视为相同（大小写、空白、标点），修改后已有的向量需要重建。
+    """
+    def __init__(self, dims, normalize=normalize_text, kind=None):
+        self.dims = dims
+        self.normalize = normalize
+        self.kind = kind or f"hash{dims}"
+
+    def embed(self, text):
+        vector = np.zeros(self.dims, dtype=np.float32)
+        text = self.normalize(text)
+        for n, weight in ((1, 0.5), (2, 1.0), (3, 1.0)):
+            for i in range(len(text) - n + 1):
+                # 使用crc32而不是hash()，保证跨进程结果一致
+                h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                vector[h % self.dims] += weight if h & 0x80000000 else -weight
+        return vector
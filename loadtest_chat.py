@@ -0,0 +1,239 @@
+"""聊天服务压测：用模拟的流式模型接口启动 chat.py --serve，并发多个会话发送消息
+
+模拟接口兼容 OpenAI 的 /v1/chat/completions 流式输出，每个token之间固定延迟，
+因此结果只反映 chat.py 本身（HTTP、线程池、数据库读写）的并发能力。
+同时提供 Ollama 的 /api/embeddings 和 /api/embed（确定性的哈希向量），供 benchmark.py 代替嵌入服务。
+模拟接口按 OpenAI 的规则估算前缀缓存：与之前请求相同的整条消息前缀超过 1024 token 时计为命中，
+在 usage.prompt_tokens_details.cached_tokens 中返回。
+输出每个请求首个token延迟和总耗时的 p50/p99、吞吐量和错误数（JSON）。
+
+用法:
+python loadtest_chat.py --sessions 50 --messages 3 --tokens 40 --token-delay 0.02
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from token_counter import count_message_tokens
+
+# 模拟前缀缓存：命中所需的最少token数和缓存粒度
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+# 模拟嵌入接口的向量维度（与 nomic-embed-text 相同）
+EMBED_DIMS = 768
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class PrefixCache:
+    """记录见过的消息前缀，估算一次请求能命中缓存的token数"""
+    def __init__(self):
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, messages):
+        digest = hashlib.sha1()
+        hashes = []
+        for message in messages:
+            digest.update(json.dumps([message.get("role"), message.get("content")], ensure_ascii=False).encode())
+            hashes.append(digest.hexdigest())
+        with self.lock:
+            hit = 0
+            for i, value in enumerate(hashes):
+                if value in self.seen:
+                    hit = i + 1
+            self.seen.update(hashes)
+        cached = count_message_tokens(messages[:hit]) if hit else 0
+        return cached // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS if cached >= CACHE_MIN_TOKENS else 0
+
+def stub_embedding(text):
+    """同一文本总是得到同一个单位向量"""
+    rng = random.Random(hashlib.sha1(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0, 1) for _ in range(EMBED_DIMS)]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+def make_stub_handler(tokens, token_delay, first_token_delay=0.0):
+    cache = PrefixCache()
+
+    class StubLLMHandler(BaseHTTPRequestHandler):
+        """模拟的 OpenAI 兼容接口（流式和非流式的 chat.completions）和 Ollama 嵌入接口"""
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, data):
+            payload = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path.endswith("/api/embeddings"):
+                self.send_json({"embedding": stub_embedding(body.get("prompt", ""))})
+                return
+            if self.path.endswith("/api/embed"):
+                inputs = body.get("input", "")
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                self.send_json({"model": body.get("model"), "embeddings": [stub_embedding(text) for text in inputs]})
+                return
+            messages = body.get("messages") or []
+            prompt_tokens = count_message_tokens(messages)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens,
+                     "prompt_tokens_details": {"cached_tokens": cache.lookup(messages)}}
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": "stub-model"}
+            time.sleep(first_token_delay)
+            if not body.get("stream"):
+                time.sleep(token_delay * tokens)
+                self.send_json({
+                    "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": "stub-model",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "token " * tokens}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(data):
+                line = f"data: {data}\n\n".encode()
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+
+            for i in range(tokens):
+                if i:
+                    time.sleep(token_delay)
+                send(json.dumps(dict(chunk, choices=[{"index": 0, "delta": {"content": f"token{i} "}, "finish_reason": None}])))
+            final = dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send(json.dumps(dict(final, choices=[])))
+                final = dict(chunk, choices=[], usage=usage)
+            send(json.dumps(final))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return StubLLMHandler
+
+def start_stub_llm(tokens, token_delay, first_token_delay=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), make_stub_handler(tokens, token_delay, first_token_delay))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"服务未在 {timeout} 秒内启动")
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+def run_session(base_url, messages, results, lock):
+    session_id = requests.post(f"{base_url}/api/sessions").json()["session_id"]
+    for i in range(messages):
+        started = time.perf_counter()
+        first_token = None
+        error = None
+        try:
+            with requests.post(f"{base_url}/api/sessions/{session_id}/messages",
+                               json={"content": f"第{i}个问题"}, stream=True, timeout=120) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if "content" in event and first_token is None:
+                        first_token = time.perf_counter() - started
+                    if "error" in event:
+                        error = event["error"]
+        except Exception as e:
+            error = str(e)
+        with lock:
+            results.append({"first_token": first_token, "total": time.perf_counter() - started, "error": error})
+    history = requests.get(f"{base_url}/api/sessions/{session_id}/messages").json()["messages"]
+    with lock:
+        results.append({"history_length": len(history), "expected": messages * 2})
+
+def main():
+    parser = argparse.ArgumentParser(description="chat.py 聊天服务压测")
+    parser.add_argument("--sessions", type=int, default=50, help="并发会话数")
+    parser.add_argument("--messages", type=int, default=3, help="每个会话发送的消息数")
+    parser.add_argument("--tokens", type=int, default=40, help="每个回答的token数")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="模拟接口每个token的间隔（秒）")
+    args = parser.parse_args()
+
+    stub = start_stub_llm(args.tokens, args.token_delay)
+    port = free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ,
+                   LLM_BASE_URL=f"http://127.0.0.1:{stub.server_address[1]}/v1",
+                   LLM_API_KEY="stub",
+                   DB_PATH=os.path.join(data_dir, "chat.db"),
+                   CHAT_PORT=str(port))
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat.py"), "--serve"],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            base_url = f"http://127.0.0.1:{port}"
+            results = []
+            lock = threading.Lock()
+            threads = [threading.Thread(target=run_session, args=(base_url, args.messages, results, lock))
+                       for _ in range(args.sessions)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+    stub.shutdown()
+
+    requests_done = [r for r in results if "total" in r]
+    ok = [r for r in requests_done if r["error"] is None]
+    histories = [r for r in results if "history_length" in r]
+    first_tokens = [r["first_token"] * 1000 for r in ok if r["first_token"] is not None]
+    totals = [r["total"] * 1000 for r in ok]
+    print(json.dumps({
+        "sessions": args.sessions,
+        "requests": len(requests_done),
+        "errors": len(requests_done) - len(ok),
+        "error_samples": sorted({r["error"] for r in requests_done if r["error"]})[:3],
+        "incomplete_histories": sum(1 for r in histories if r["history_length"] != r["expected"]),
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(len(ok) / elapsed, 2),
+        "tokens_per_second": round(len(ok) * args.tokens / elapsed, 1),
+        "first_token_p50_ms": round(percentile(first_tokens, 0.5), 1) if first_tokens else None,
+        "first_token_p99_ms": round(percentile(first_tokens, 0.99), 1) if first_tokens else None,
+        "total_p50_ms": round(percentile(totals, 0.5), 1) if totals else None,
+        "total_p99_ms": round(percentile(totals, 0.99), 1) if totals else None,
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Prometheus 指标和可选的 OpenTelemetry 链路追踪
+
+指标以 Prometheus 文本格式导出，不依赖 prometheus_client：
+- Flask 服务（alerts.py、chat.py、ai-assistant.py --serve）通过 instrument_app() 提供 GET /metrics，
+  同时记录每个接口的请求耗时
+- report.py 每轮巡检结束后调用 export()，写入 node_exporter textfile 目录（metrics.textfile）
+  和/或推送到 Pushgateway（metrics.pushgateway）
+
+所有指标集中定义在本文件，名称和标签见下方；排队数等在抓取时才计算的值用 Gauge.set_function 注册。
+config.yaml 中 metrics.tracing: true 且安装了 opentelemetry-api 时，span() 会创建链路追踪的span，
+安装了 opentelemetry-sdk 和 OTLP exporter 时按 OTEL_EXPORTER_OTLP_ENDPOINT 导出，否则交给已有的全局配置。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import settings
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 模型请求和远程命令的耗时分桶（秒）
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+
+_registry = []
+_service = "ops-ai"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 的标签应为 {self.labelnames}: {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """抓取时调用 function() 取值，用于排队数、进行中的请求数等"""
+        self.set(function, **labels)
+
+    def _samples(self):
+        samples = []
+        for name, key, extra, value in super()._samples():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            samples.append((name, key, extra, value))
+        return samples
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 块的耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", key, (("le", _format_value(bound)),), count))
+            samples.append((f"{self.name}_count", key, (), counts[-1]))
+            samples.append((f"{self.name}_sum", key, (), total))
+        return samples
+
+# ---------- 指标定义 ----------
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP接口耗时（流式接口只计到开始返回）",
+    ["service", "endpoint", "method", "status"])
+ALERTS_RECEIVED = Counter("alerts_received_total", "webhook 收到的告警数", ["severity"])
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "llm_first_token_seconds", "模型请求到首个内容片段的耗时（非流式请求为完整耗时）",
+    ["caller", "model"], SLOW_BUCKETS)
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "模型请求总耗时", ["caller", "model", "status"], SLOW_BUCKETS)
+LLM_TOKENS = Counter("llm_tokens_total", "模型请求的token数，type 为 prompt / completion / cached", ["caller", "type"])
+LLM_RESPONSE_CACHE = Counter("llm_response_cache_total", "响应缓存查找结果", ["caller", "result"])
+SSH_CONNECT_SECONDS = Histogram("ssh_connect_duration_seconds", "巡检SSH连接耗时", ["status"])
+SSH_COMMAND_SECONDS = Histogram("ssh_command_duration_seconds", "巡检远程命令耗时", ["status"], SLOW_BUCKETS)
+INSPECTION_HOSTS = Counter("inspection_hosts_total", "巡检的主机数", ["status"])
+INSPECTION_RUN_SECONDS = Gauge("inspection_last_run_duration_seconds", "最近一轮巡检的耗时")
+INSPECTION_RUN_TIMESTAMP = Gauge("inspection_last_run_timestamp_seconds", "最近一轮巡检结束的时间")
+DB_WRITE_SECONDS = Histogram("db_write_duration_seconds", "数据库写事务耗时（含等待锁）", ["db", "op"])
+QUEUE_WAITING = Gauge("queue_waiting", "排队等待执行的任务数", ["queue"])
+QUEUE_ACTIVE = Gauge("queue_active", "正在执行的任务数", ["queue"])
+
+class TrackedExecutor(ThreadPoolExecutor):
+    """自行统计排队数和执行数的线程池：提交时计入 waiting，任务开始时转入 active，结束时减去
+
+    在开始前被取消的任务（如 shutdown(cancel_futures=True)）从 waiting 中减去。
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self.active = 0
+        self._counts_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            with self._counts_lock:
+                self.waiting -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counts_lock:
+                    self.active -= 1
+
+        with self._counts_lock:
+            self.waiting += 1
+        try:
+            future = super().submit(run)
+        except Exception:
+            with self._counts_lock:
+                self.waiting -= 1
+            raise
+        future.add_done_callback(self._forget_cancelled)
+        return future
+
+    def _forget_cancelled(self, future):
+        if future.cancelled():
+            with self._counts_lock:
+                self.waiting -= 1
+
+def track_limit(queue, limit):
+    """导出 settings.ConcurrencyLimit 或 TrackedExecutor 的排队数和执行数"""
+    QUEUE_WAITING.set_function(lambda: limit.waiting, queue=queue)
+    QUEUE_ACTIVE.set_function(lambda: limit.active, queue=queue)
+
+def observe_llm(caller, model, started, first_token_at=None, status="ok"):
+    """记录一次模型请求的首个内容耗时和总耗时，started/first_token_at 为 time.perf_counter() 的值"""
+    now = time.perf_counter()
+    if status == "ok":
+        LLM_FIRST_TOKEN_SECONDS.observe((first_token_at or now) - started, caller=caller, model=model)
+    LLM_REQUEST_SECONDS.observe(now - started, caller=caller, model=model, status=status)
+
+def render():
+    """所有指标的 Prometheus 文本格式"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+# ---------- 导出 ----------
+
+def instrument_app(app, service):
+    """为 Flask 应用添加 /metrics 接口并记录每个接口的耗时"""
+    global _service
+    _service = service
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None and request.endpoint != "metrics":
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, service=service,
+                                         endpoint=request.endpoint or "unknown",
+                                         method=request.method, status=response.status_code)
+        return response
+
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", metrics)
+    return app
+
+def export(job):
+    """按 metrics 配置写入 textfile 和/或推送到 Pushgateway（用于 report.py 这类非常驻任务）"""
+    global _service
+    _service = job
+    config = settings.get().metrics
+    text = render()
+    if config.textfile:
+        # 先写临时文件再替换，node_exporter 不会读到写了一半的文件
+        tmp = f"{config.textfile}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(config.textfile)), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, config.textfile)
+        except OSError as e:
+            print(f"写入指标文件失败: {str(e)}")
+    if config.pushgateway:
+        import requests
+        try:
+            response = requests.put(f"{config.pushgateway.rstrip('/')}/metrics/job/{job}", data=text.encode("utf-8"),
+                                    headers={"Content-Type": "text/plain; version=0.0.4"}, timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"推送指标失败: {str(e)}")
+
+# ---------- 链路追踪 ----------
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def _get_tracer():
+    """OpenTelemetry tracer，未开启或未安装时返回None"""
+    global _tracer
+    if not settings.get().metrics.tracing:
+        return None
+    with _tracer_lock:
+        if _tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                print("未安装 opentelemetry-api，不记录链路追踪")
+                _tracer = False
+                return None
+            try:
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                provider = TracerProvider(resource=Resource.create({"service.name": _service}))
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                trace.set_tracer_provider(provider)
+            except ImportError:
+                # 只安装了API时使用全局配置（如通过 opentelemetry-instrument 启动）
+                pass
+            _tracer = trace.get_tracer("ops-ai")
+        return _tracer or None
+
+@contextmanager
+def span(name, **attributes):
+    """链路追踪的span，未开启时不做任何事"""
+    tracer = _get_tracer()
+    if tracer is None:
+        yield None
+        return
+    attributes = {key: value for key, value in attributes.items() if value is not None}
+    with tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
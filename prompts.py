@@ -0,0 +1,114 @@
+"""提示词组装与前缀缓存统计
+
+模型服务（OpenAI、xAI、DeepSeek 等）会缓存请求开头相同的部分，命中时首个token更快、
+提示token更便宜，但只有逐字节相同的前缀才能命中。因此所有请求按同一顺序组装：
+固定的系统提示和模板在最前且不含任何每次变化的内容（IP、时间、检索结果等），
+对话历史按时间顺序只在末尾追加，本轮才有的内容放在最后一条用户消息。
+
+接口在 usage 中返回命中缓存的token数时（OpenAI/xAI 的 prompt_tokens_details.cached_tokens，
+DeepSeek 的 prompt_cache_hit_tokens）按调用方累计命中率；同时记录开头系统消息的指纹，
+同一调用方的指纹数持续增长说明固定前缀里混入了可变内容。
+每次请求的提示、输出和命中缓存的token数同时计入 Prometheus 指标 llm_tokens_total（见 metrics.py）。
+"""
+import hashlib
+import threading
+
+from metrics import LLM_TOKENS
+
+# 每个调用方最多记录的前缀指纹数
+MAX_FINGERPRINTS = 1000
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _system_message(message):
+    return message if isinstance(message, dict) else {"role": "system", "content": message}
+
+def build_messages(system, user, history=()):
+    """按缓存友好的顺序组装请求消息
+
+    system: 固定的系统提示，字符串、消息或它们的列表，不得包含每次请求都变化的内容
+    user: 本轮的用户消息内容，检索结果、巡检数据等可变内容都放在这里
+    history: 按时间顺序的对话历史，只在末尾追加
+    """
+    if system is None:
+        system = []
+    elif isinstance(system, (str, dict)):
+        system = [system]
+    return [_system_message(message) for message in system] + list(history) + [{"role": "user", "content": user}]
+
+def prefix_fingerprint(messages):
+    """开头连续系统消息的摘要"""
+    digest = hashlib.sha1()
+    for message in messages:
+        if message.get("role") != "system":
+            break
+        digest.update(message["content"].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+def _field(obj, name):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+def cached_tokens(usage):
+    """从接口返回的 usage 中取命中前缀缓存的token数，接口未返回时为None"""
+    value = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if value is None:
+        value = _field(usage, "prompt_cache_hit_tokens")
+    return value
+
+def record_usage(caller, messages, usage):
+    """累计一次请求的提示token和命中缓存的token，返回本次命中的token数（接口未返回时为None）"""
+    prompt_tokens = _field(usage, "prompt_tokens")
+    cached = cached_tokens(usage)
+    fingerprint = prefix_fingerprint(messages)
+    LLM_TOKENS.inc(prompt_tokens or 0, caller=caller, type="prompt")
+    LLM_TOKENS.inc(_field(usage, "completion_tokens") or 0, caller=caller, type="completion")
+    LLM_TOKENS.inc(cached or 0, caller=caller, type="cached")
+    with _stats_lock:
+        stats = _stats.setdefault(caller, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "reported_requests": 0,
+            "reported_prompt_tokens": 0,
+            "cached_tokens": 0,
+            "fingerprints": set(),
+        })
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens or 0
+        if cached is not None:
+            stats["reported_requests"] += 1
+            stats["reported_prompt_tokens"] += prompt_tokens or 0
+            stats["cached_tokens"] += cached
+        if len(stats["fingerprints"]) < MAX_FINGERPRINTS:
+            stats["fingerprints"].add(fingerprint)
+    return cached
+
+def cache_stats():
+    """各调用方的前缀缓存统计，命中率只按返回了缓存信息的请求计算"""
+    with _stats_lock:
+        return {
+            caller: {
+                "requests": stats["requests"],
+                "prompt_tokens": stats["prompt_tokens"],
+                "reported_requests": stats["reported_requests"],
+                "cached_tokens": stats["cached_tokens"],
+                "cached_rate": (stats["cached_tokens"] / stats["reported_prompt_tokens"]
+                                if stats["reported_prompt_tokens"] else None),
+                "prefixes": len(stats["fingerprints"]),
+            }
+            for caller, stats in _stats.items()
+        }
+
+def format_cache_stats():
+    """前缀缓存统计的单行摘要，用于命令行输出"""
+    parts = []
+    for caller, stats in cache_stats().items():
+        rate = f"{stats['cached_rate']:.0%}" if stats["cached_rate"] is not None else "接口未返回"
+        parts.append(f"{caller}: {stats['requests']} 次请求, 缓存命中 {rate} "
+                     f"({stats['cached_tokens']}/{stats['prompt_tokens']} tokens), 固定前缀 {stats['prefixes']} 种")
+    return "; ".join(parts) or "暂无模型请求"
@@ -4,99 +4,116 @@ import time
 import os
 import socket
 import paramiko
-import yaml
 from ollama import Client
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import subprocess
+import threading
+import argparse
+import json
+from prompts import build_messages, record_usage, format_cache_stats
+from response_cache import get_response_cache, format_cache_stats as format_response_cache_stats
+import settings
+import metrics
+
+# 巡检级别，低级别的命令会包含在高级别巡检中
+TIERS = ["quick", "standard", "deep"]
+
+# 系统巡检命令目录，每轮巡检开始时从配置的 commands 段加载
+commands = []
+
+# 巡检分级配置，每轮巡检开始时从配置的 inspection 段加载
+inspection_config = settings.InspectionConfig()
+
+# 巡检状态（记录每台主机上次深度巡检时间）
+_state_lock = threading.Lock()
+
+def load_commands(config):
+    """从配置中加载巡检命令目录"""
+    default_timeout = config.inspection.default_timeout
+    catalog = []
+    for item in config.commands:
+        if isinstance(item, str):
+            item = {'cmd': item}
+        tier = item.get('tier', 'standard')
+        if tier not in TIERS:
+            raise ValueError(f"未知的巡检级别: {tier} ({item.get('cmd')})")
+        catalog.append({
+            'cmd': item['cmd'],
+            'tier': tier,
+            'timeout': item.get('timeout', default_timeout),
+            'requires': item.get('requires'),
+            'roles': item.get('roles') or [],
+        })
+    return catalog
+
+def select_commands(tier, roles=None):
+    """按巡检级别和主机角色筛选命令，低级别命令排在前面"""
+    level = TIERS.index(tier)
+    selected = [c for c in commands if TIERS.index(c['tier']) <= level]
+    if roles:
+        selected = [c for c in selected if not c['roles'] or set(c['roles']) & set(roles)]
+    return sorted(selected, key=lambda c: TIERS.index(c['tier']))
+
+def _state_file():
+    return os.path.join(dir_url, ".inspection_state.json")
+
+def load_state():
+    """读取巡检状态文件"""
+    try:
+        with open(_state_file(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def record_deep_run(ip_address):
+    """记录主机完成深度巡检的时间"""
+    with _state_lock:
+        state = load_state()
+        state.setdefault(ip_address, {})['last_deep'] = time.time()
+        with open(_state_file(), 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+
+def resolve_tier(ip_address, tier):
+    """确定主机本次巡检级别，standard 巡检到达深度巡检间隔时自动升级为 deep"""
+    interval = inspection_config.deep_interval
+    # quick 巡检始终只执行快速检查
+    if tier != "standard" or not interval:
+        return tier
+    last_deep = load_state().get(ip_address, {}).get('last_deep', 0)
+    if time.time() - last_deep >= interval:
+        return "deep"
+    return tier
+
+def probe_binaries(client, catalog):
+    """一次性探测主机上存在的可执行文件，用于跳过不适用的命令"""
+    binaries = sorted({c['requires'] for c in catalog if c['requires']})
+    if not binaries:
+        return set()
+    probe = "for b in " + " ".join(binaries) + "; do command -v $b >/dev/null 2>&1 && echo $b; done"
+    try:
+        _, output, _ = exec_remote(client, probe, timeout=10)
+        return set(output.split())
+    except (paramiko.SSHException, socket.timeout):
+        # 探测失败时不做过滤
+        return set(binaries)
+
+def exec_remote(client, cmd, timeout):
+    """执行远程命令，返回(退出码, 标准输出, 标准错误)"""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+        # 先读取输出再获取退出码，读取受 timeout 约束，避免命令挂起时无限等待
+        output = stdout.read().decode('utf-8', errors='replace').strip()
+        error = stderr.read().decode('utf-8', errors='replace').strip()
+        exit_code = stdout.channel.recv_exit_status()
+        status = "ok" if exit_code == 0 else "failed"
+        return exit_code, output, error
+    finally:
+        metrics.SSH_COMMAND_SECONDS.observe(time.perf_counter() - started, status=status)
 
-# 系统巡检命令列表，新增了硬件监控、日志审计等检查项
-commands = [
-    # 系统基本信息
-    "uname -a",                                     # 显示完整的系统信息（内核版本、主机名、架构等）
-    "hostname",                                     # 显示当前主机名
-    "cat /etc/os-release",                          # 显示Linux发行版信息
-    "uptime",                                       # 显示系统运行时间、用户数和平均负载
-    
-    # 硬件信息
-    "lspci",                                        # 列出所有PCI总线设备
-    "lsusb",                                        # 列出所有USB设备
-    "lsblk",                                        # 以树状结构显示块设备信息
-    "df -Th",                                       # 显示文件系统使用情况，包括文件系统类型(-T)和可读格式(-h)
-    "df -i",                                        # 检查inode使用情况
-    "mount",                                        # 显示当前挂载的文件系统
-    "sudo lshw -short",                             # 显示系统硬件概要信息
-    "cat /proc/cpuinfo | grep 'model name' | uniq", # 显示CPU型号信息（去除重复）
-    "cat /proc/meminfo | grep -E 'MemTotal|MemFree|MemAvailable'", # 显示内存总量和可用量
-    "free -m",                                      # 显示系统内存使用情况（MB为单位）
-    
-    # 网络信息
-    "ip addr",                                      # 显示所有网络接口信息
-    "ss -tunlp",                                    # 显示所有TCP(-t)和UDP(-u)监听(-l)端口，显示进程(-p)和数字端口(-n)
-    "route -n",                                     # 显示内核路由表（以数字形式）
-    "netstat -s | head -40",                        # 显示网络统计信息（仅显示前40行重要信息）
-    "cat /etc/resolv.conf",                         # 显示系统DNS解析配置
-    "sudo cat /etc/hosts.allow /etc/hosts.deny 2>/dev/null",    # 检查TCP Wrapper配置
-    "ping -c 3 8.8.8.8",                            # 测试网络连通性（ping谷歌DNS服务器3次）
-    
-    # 进程与性能
-    "ps aux --sort=-%cpu | head -10",               # 显示CPU占用率最高的10个进程
-    "ps aux --sort=-%mem | head -10",               # 显示内存占用率最高的10个进程
-    "top -bc -n 1 -o %CPU | head -20",              # 显示CPU使用率最高的进程（批处理模式，只运行一次）
-    "vmstat 1 3",                                   # 每隔1秒报告系统内存、进程、CPU等统计信息，共3次
-    "mpstat -P ALL 1 2",                            # 显示所有CPU核心的详细统计信息，每秒一次，共2次
-    "iostat -x 2 2",                                # 显示详细的IO统计信息，每2秒一次，共2次
-    "cat /proc/loadavg",                            # 显示系统平均负载
-    "nvidia-smi",                                   # 显示NVIDIA GPU状态信息
-    
-    # 用户与安全信息
-    "who",                                          # 显示当前登录的用户
-    "last | head -20",                              # 显示最近20条登录记录
-    "sudo lastb | head -10",                        # 查看最近10条失败的登录尝试
-    "cat /etc/passwd",                              # 显示系统用户账户信息
-    "ls -la --time-style=full-iso /etc/passwd /etc/shadow /etc/group",  # 显示用户和组文件的详细时间信息
-    "awk -F: '{print $1, $3, $4, $6}' /etc/passwd | sort -n -k2",  # 按照UID排序显示用户列表
-    "cat /etc/sudoers 2>/dev/null && ls -l /etc/sudoers.d/ 2>/dev/null",  # 显示sudo权限配置
-    "sudo ausearch -m USER_AUTH -m USER_ACCT -m ADD_USER -ts today 2>/dev/null || sudo journalctl _COMM=useradd _COMM=adduser -n 10 2>/dev/null",  # 检查用户添加和认证
-    
-    # 系统安全性检查
-    "sudo find / -perm -4000 -ls 2>/dev/null | head -20",      # 查找具有SUID权限的文件（仅显示前20个）
-    "sudo grep -v '^#' /etc/ssh/sshd_config | grep -v '^$'",  # 只显示SSH有效配置行
-    "ls -la /root/.ssh/ 2>/dev/null",                           # 检查root的SSH密钥文件
-    "sudo find /home -name 'authorized_keys' -o -name 'id_rsa*' 2>/dev/null | head -10",  # 查找所有用户SSH密钥
-    "sudo iptables -nvL || sudo firewall-cmd --list-all",     # 检查防火墙规则（二选一）
-    
-    # 服务与计划任务
-    "systemctl list-units --state=running --type=service --no-pager", # 显示正在运行的系统服务单元
-    "systemctl list-units --failed --no-pager",            # 列出所有启动失败的服务单元
-    "crontab -l 2>/dev/null && ls -l /etc/cron.*",         # 显示计划任务和系统cron目录
-    "sudo ls -la /etc/cron.d/ /etc/crontab /var/spool/cron/ 2>/dev/null", # 查看所有crontab文件
-    
-    # 系统日志分析
-    "sudo journalctl -p 3 -n 30 --no-pager 2>/dev/null",   # 查看最近30条错误级别的系统日志
-    "sudo dmesg | tail -n 20",                      # 显示最近20条内核缓冲区信息
-    "sudo grep -Ei 'error|fail|critical' /var/log/syslog 2>/dev/null || sudo grep -Ei 'error|fail|critical' /var/log/messages 2>/dev/null | tail -20",  # 查找系统日志中的错误
-    "sudo find /var/log -type f -size +100M -exec du -h {} \\; 2>/dev/null | sort -rh",  # 查找大于100MB的日志文件
-    
-    # 存储与文件系统
-    "sudo fdisk -l 2>/dev/null || lsblk -f",        # 磁盘分区信息
-    "cat /etc/fstab",                               # 显示系统启动时自动挂载的文件系统配置
-    # "sudo du -sh /* 2>/dev/null | sort -rh | head -10", # 显示根目录下占用空间最大的10个目录
-    
-    # 系统限制与配置
-    "ulimit -a",                                    # 显示当前用户的资源限制
-    "cat /etc/security/limits.conf | grep -v '^#' | grep -v '^$'", # 显示系统资源限制配置（非注释行）
-    "sudo sysctl -a 2>/dev/null | grep -E 'vm.swappiness|fs.file-max|net.ipv4.tcp_fin_timeout|net.core.somaxconn'", # 显示关键内核参数
-    
-    # 容器与云原生
-    "sudo docker ps -a 2>/dev/null",                # 显示所有Docker容器
-    "kubectl get pods --all-namespaces 2>/dev/null",# 显示所有命名空间中的Kubernetes Pod
-    "kubectl get nodes 2>/dev/null",                # 显示Kubernetes集群中的所有节点
-    
-    # 时间同步
-    "date && timedatectl"                           # 显示系统日期、时间和NTP同步状态
-]
-
-# AI分析系统提示模板
+# AI分析系统提示模板，作为每次请求的固定前缀原样发送；{{ip}} 是报告中的占位符，
+# 服务器IP放在用户消息中，生成后再替换（见 analysis_input 和 fill_report_ip）
 AI_PROMPT = """你是一名拥有 RHCE/CCIE/HCIE/H3CSE 认证的高级工程师，请根据以下服务器配置信息进行专业分析：
 
 要求：
@@ -317,6 +334,14 @@ AI_PROMPT = """你是一名拥有 RHCE/CCIE/HCIE/H3CSE 认证的高级工程师
 现在开始分析以下配置信息：
 """
 
+def analysis_input(ipadd, data):
+    """用户消息：本次巡检的服务器IP和巡检数据，每台主机不同，放在固定的系统提示之后"""
+    return f"服务器IP: {ipadd}（报告中的 {{{{ip}}}} 替换为该IP）\n\n{data}"
+
+def fill_report_ip(content, ipadd):
+    """模型照抄了模板占位符时补上服务器IP"""
+    return content.replace("{{ip}}", ipadd)
+
 # 新增的命令和功能检查
 def run_command_with_sudo(command):
     """执行命令并以超级用户权限运行"""
@@ -327,8 +352,12 @@ def run_command_with_sudo(command):
     except Exception as e:
         return None, str(e)
 
-def AI_V3(log_file, ipadd, api_key, base_url, model):
-    """Deepseek 引擎AI分析"""
+def AI_V3(log_file, ipadd, api_key, base_url, model, first_token=None, cancel=None, echo=True):
+    """Deepseek 引擎AI分析
+
+    first_token: 收到首个内容片段时设置的事件，用于对冲请求判断远程引擎是否已开始响应
+    cancel: 设置后中止流式读取并放弃结果（在片段到达时检查）
+    """
     # 从日志文件名中提取时间戳
     log_filename = os.path.basename(log_file)
     timestamp = log_filename.split('_')[-1].replace('.log', '')
@@ -341,74 +370,175 @@ def AI_V3(log_file, ipadd, api_key, base_url, model):
         client = OpenAI(
             base_url=base_url,
             api_key=api_key,
+            timeout=settings.get().ai.timeout,
         )
 
-        # 使用字符串替换而不是格式化字符串
-        formatted_prompt = AI_PROMPT.replace("{{ip}}", ipadd)
-
-        stream = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": formatted_prompt},
-                {"role": "user", "content": data},
-            ],
-            stream=True,
-            temperature=0.3,
-            max_tokens=30000
-        )
+        # 系统提示不随主机变化，所有主机的请求共用同一段可缓存前缀
+        messages = build_messages(AI_PROMPT, analysis_input(ipadd, data))
+
+        # 开启响应缓存时，同一份巡检数据（如重新分析同一日志）直接使用上次的报告
+        cache = get_response_cache("report")
+        lookup = cache.lookup(model, messages) if cache is not None else None
+        if lookup is not None and lookup.response is not None:
+            if first_token is not None:
+                first_token.set()
+            content_buffer = lookup.response
+        else:
+            content_buffer = _stream_analysis(client, model, messages, first_token, cancel, echo)
+            if content_buffer is None:
+                return None
+            if lookup is not None:
+                cache.store(lookup, content_buffer)
+
+        # 处理内容，去除 Markdown 代码块标记
+        processed_content = fill_report_ip(content_buffer, ipadd)
+        if processed_content.startswith("```html"):
+            processed_content = processed_content[7:]
+        if processed_content.endswith("```"):
+            processed_content = processed_content[:-3]
 
         filename = os.path.join(dir_url, f"{ipadd}_analysis_{timestamp}.html")
         with open(filename, 'w', encoding='utf-8') as f:
-            content_buffer = ""
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    print(content, end="", flush=True)
-                    content_buffer += content
-            
-            # 处理内容，去除 Markdown 代码块标记
-            processed_content = content_buffer
-            if processed_content.startswith("```html"):
-                processed_content = processed_content[7:]
-            if processed_content.endswith("```"):
-                processed_content = processed_content[:-3]
-            
             f.write(processed_content)
         return filename
     except Exception as e:
         print(f"AI分析失败: {str(e)}")
         return None
 
-def local_ollama(data, ipadd):
+def _stream_analysis(client, model, messages, first_token=None, cancel=None, echo=True):
+    """流式请求远程引擎，返回完整内容，被取消时返回None"""
+    request = dict(model=model, messages=messages, stream=True, temperature=0.3, max_tokens=30000)
+    started = time.perf_counter()
+    first_token_at = None
+    try:
+        try:
+            # 请求接口在流的最后一个chunk中返回token用量（含命中缓存的token数）
+            stream = client.chat.completions.create(stream_options={"include_usage": True}, **request)
+        except Exception as e:
+            if "stream_options" not in str(e):
+                raise
+            stream = client.chat.completions.create(**request)
+
+        content_buffer = ""
+        usage = None
+        # 取消后在下一个片段到达时关闭流；等待首个片段期间无法中断，最长为 ai.timeout，
+        # 对冲分析不等待被放弃的请求，因此不影响巡检耗时
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                stream.close()
+                metrics.observe_llm("report", model, started, status="cancelled")
+                return None
+            usage = getattr(chunk, 'usage', None) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                content = chunk.choices[0].delta.content
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                if first_token is not None:
+                    first_token.set()
+                if echo:
+                    print(content, end="", flush=True)
+                content_buffer += content
+    except Exception:
+        metrics.observe_llm("report", model, started, status="error")
+        raise
+    metrics.observe_llm("report", model, started, first_token_at)
+
+    if usage is not None:
+        record_usage("report", messages, usage)
+    return content_buffer
+
+def local_ollama(data, ipadd, cancel=None, echo=True):
     """本地大模型分析"""
     client = Client(host='http://localhost:11434')
+    filename = os.path.join(dir_url, f"{ipadd}_local_analysis.html")
+    started = time.perf_counter()
+    first_token_at = None
 
     try:
-        # 使用字符串替换而不是格式化
-        formatted_prompt = AI_PROMPT.replace("{{ip}}", ipadd)
-        
+        # 系统提示保持不变，本地模型可复用已计算的前缀
         response = client.generate(
             model='qwen:1.8b',
-            system=formatted_prompt,
-            prompt=data,
+            system=AI_PROMPT,
+            prompt=analysis_input(ipadd, data),
             options={'temperature': 0.5},
             stream=True
         )
 
-        filename = os.path.join(dir_url, f"{ipadd}_local_analysis.html")
         with open(filename, 'w', encoding='utf-8') as f:
             for chunk in response:
+                if cancel is not None and cancel.is_set():
+                    break
                 if chunk['response']:
                     content = chunk['response']
-                    print(content, end='', flush=True)
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
                     f.write(content)
-                    time.sleep(0.02)
+                    if echo:
+                        print(content, end='', flush=True)
+                        time.sleep(0.02)
+
+        if cancel is not None and cancel.is_set():
+            metrics.observe_llm("report_local", "qwen:1.8b", started, status="cancelled")
+            os.remove(filename)
+            return None
+        metrics.observe_llm("report_local", "qwen:1.8b", started, first_token_at)
+        with open(filename, 'r', encoding='utf-8') as f:
+            content = f.read()
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(fill_report_ip(content, ipadd))
         return filename
     except Exception as e:
+        metrics.observe_llm("report_local", "qwen:1.8b", started, status="error")
         print(f"本地模型异常: {str(e)}")
         return None
 
-def inspect_server(ip_address, user, passwd, sudo_pass, port, max_retries=3):
+def hedged_analysis(log_file, raw_data, ipadd, api_key, base_url, model, hedge_delay):
+    """对冲分析：远程引擎在 hedge_delay 秒内没有返回首个内容时并行启动本地模型，采用先完成的结果"""
+    first_token = threading.Event()
+    cancel_remote = threading.Event()
+    cancel_local = threading.Event()
+    # 不等待被放弃的任务结束，避免远程请求阻塞时拖慢整体耗时
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        remote = executor.submit(AI_V3, log_file, ipadd, api_key, base_url, model,
+                                 first_token=first_token, cancel=cancel_remote, echo=False)
+
+        deadline = time.time() + hedge_delay
+        while not first_token.is_set() and not remote.done() and time.time() < deadline:
+            first_token.wait(0.1)
+
+        if first_token.is_set():
+            # 远程引擎已开始输出，等待其完成，失败时再使用本地模型
+            result = remote.result()
+            if result:
+                return result
+            print(f"[{ipadd}] 远程分析中断，使用本地模型分析...")
+            return local_ollama(raw_data, ipadd, echo=False)
+
+        if remote.done() and remote.result():
+            return remote.result()
+
+        print(f"[{ipadd}] 远程引擎 {hedge_delay} 秒内未响应，并行启动本地模型分析...")
+        local = executor.submit(local_ollama, raw_data, ipadd, cancel=cancel_local, echo=False)
+        pending = {remote, local}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result:
+                    # 取消另一个仍在运行的分析
+                    if future is remote:
+                        cancel_local.set()
+                        print(f"[{ipadd}] 远程引擎先完成分析")
+                    else:
+                        cancel_remote.set()
+                        print(f"[{ipadd}] 本地模型先完成分析")
+                    return result
+        return None
+    finally:
+        executor.shutdown(wait=False)
+
+def inspect_server(ip_address, user, passwd, sudo_pass, port, max_retries=3, tier="standard", roles=None):
     """执行服务器巡检"""
     for attempt in range(max_retries):
         try:
@@ -416,51 +546,80 @@ def inspect_server(ip_address, user, passwd, sudo_pass, port, max_retries=3):
             # 验证IP有效性
             socket.inet_aton(ip_address)
 
-            # SSH连接配置
+            # SSH连接配置（超时可热加载）
+            ssh_config = settings.get().ssh
             client = paramiko.SSHClient()
             client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                hostname=ip_address,
-                port=port,
-                username=user,
-                password=passwd,
-                timeout=15,
-                banner_timeout=20,
-                allow_agent=False,
-                look_for_keys=False
-            )
+            connect_started = time.perf_counter()
+            try:
+                client.connect(
+                    hostname=ip_address,
+                    port=port,
+                    username=user,
+                    password=passwd,
+                    timeout=ssh_config.connect_timeout,
+                    banner_timeout=ssh_config.banner_timeout,
+                    allow_agent=False,
+                    look_for_keys=False
+                )
+            except Exception:
+                metrics.SSH_CONNECT_SECONDS.observe(time.perf_counter() - connect_started, status="error")
+                raise
+            metrics.SSH_CONNECT_SECONDS.observe(time.perf_counter() - connect_started, status="ok")
             print(f"[{ip_address}] 连接成功")
 
+            # 确定本次巡检级别和命令列表；时间预算从依赖探测开始计算
+            started = time.time()
+            run_tier = resolve_tier(ip_address, tier)
+            budget = inspection_config.budgets.get(run_tier)
+
+            def within_budget(timeout):
+                """剩余预算是否还够执行一次超时为 timeout 的命令（含重试，每次执行前检查）"""
+                return not budget or time.time() - started + timeout <= budget
+
+            selected = select_commands(run_tier, roles)
+            available = probe_binaries(client, selected)
+            selected = [c for c in selected if not c['requires'] or c['requires'] in available]
+            print(f"[{ip_address}] 巡检级别: {run_tier}，命令数: {len(selected)}，时间预算: {budget or '不限'}秒")
+
             # 生成报告文件
             timestamp = time.strftime("%Y%m%d-%H%M%S")
             filename = os.path.join(dir_url, f"inspection_{ip_address}_{timestamp}.log")
 
+            deferred = []
+            executed = 0
             with open(filename, 'w', encoding='utf-8') as report:
                 # 写入报告头
                 report.write(f"=== Server Inspection Report ===\n")
                 report.write(f"IP Address: {ip_address}\n")
                 report.write(f"Date: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-                report.write(f"Inspector: {user}\n\n")
+                report.write(f"Inspector: {user}\n")
+                report.write(f"Tier: {run_tier}\n\n")
+
+                # 执行筛选后的检查命令，进度编号只计实际执行的命令
+                for entry in selected:
+                    cmd = entry['cmd']
+                    timeout = entry['timeout']
+
+                    # 剩余预算不足以执行该命令时推迟到下次深度巡检
+                    if not within_budget(timeout):
+                        deferred.append(cmd)
+                        continue
 
-                # 执行所有检查命令
-                for idx, cmd in enumerate(commands, 1):
                     try:
-                        report.write(f"[{idx}/{len(commands)}] Executing: {cmd}\n")
+                        executed += 1
+                        report.write(f"[{executed}] Executing: {cmd}\n")
 
                         # 先尝试普通权限执行命令
-                        stdin, stdout, stderr = client.exec_command(cmd, timeout=10)
-                        exit_code = stdout.channel.recv_exit_status()
-                        output = stdout.read().decode('utf-8').strip()
-                        error = stderr.read().decode('utf-8').strip()
+                        exit_code, output, error = exec_remote(client, cmd, timeout)
 
-                        # 如果命令执行失败且提供了sudo密码，尝试使用sudo重试
-                        if exit_code != 0 and sudo_pass:
+                        # 如果命令执行失败且提供了sudo密码，尝试使用sudo重试（预算不足时不再重试）
+                        if exit_code != 0 and sudo_pass and not within_budget(timeout):
+                            report.write(f"\nCommand failed with exit code {exit_code}, sudo retry skipped (time budget {budget}s)\n")
+                        elif exit_code != 0 and sudo_pass:
                             report.write(f"\nCommand failed with exit code {exit_code}, retrying with sudo...\n")
                             sudo_cmd = f'echo "{sudo_pass}" | sudo -S {cmd}'
-                            stdin, stdout, stderr = client.exec_command(sudo_cmd, timeout=10)
-                            exit_code = stdout.channel.recv_exit_status()
-                            output = stdout.read().decode('utf-8').strip()
-                            error = stderr.read().decode('utf-8').strip()
+                            exit_code, output, error = exec_remote(client, sudo_cmd, timeout)
 
                         # 记录结果
                         report.write(f"Exit Code: {exit_code}\n")
@@ -469,12 +628,9 @@ def inspect_server(ip_address, user, passwd, sudo_pass, port, max_retries=3):
                         if error:
                             report.write(f"Error:\n{error}\n")
                             # 如果使用sudo失败，尝试不使用sudo重新执行
-                            if sudo_pass and 'sudo' in error:
+                            if sudo_pass and 'sudo' in error and within_budget(timeout):
                                 report.write(f"\nRetrying without sudo...\n")
-                                stdin, stdout, stderr = client.exec_command(cmd, timeout=10)
-                                exit_code = stdout.channel.recv_exit_status()
-                                output = stdout.read().decode('utf-8').strip()
-                                error = stderr.read().decode('utf-8').strip()
+                                exit_code, output, error = exec_remote(client, cmd, timeout)
                                 report.write(f"Exit Code: {exit_code}\n")
                                 if output:
                                     report.write(f"Output:\n{output}\n")
@@ -487,6 +643,18 @@ def inspect_server(ip_address, user, passwd, sudo_pass, port, max_retries=3):
                     except socket.timeout:
                         report.write("Command timeout\n\n")
 
+                report.write(f"Executed {executed}/{len(selected)} commands\n")
+                if deferred:
+                    report.write(f"Deferred (time budget {budget}s exceeded):\n")
+                    for cmd in deferred:
+                        report.write(f"  {cmd}\n")
+
+            elapsed = time.time() - started
+            print(f"[{ip_address}] 巡检完成，耗时 {elapsed:.1f} 秒，推迟 {len(deferred)} 项")
+            # 深度巡检全部完成才记录，否则下次继续尝试
+            if run_tier == "deep" and not deferred:
+                record_deep_run(ip_address)
+
             client.close()
             return filename
 
@@ -513,16 +681,19 @@ def validate_config(ssh_user, ssh_pass, volc_key):
     if not volc_key:
         print("警告: 未配置Deepseek API密钥，将使用本地模型进行分析")
 
-def process_server(ip, ssh_user, ssh_pass, ssh_port, volc_key, base_url, model):
+def process_server(ip, ssh_user, ssh_pass, ssh_port, volc_key, base_url, model, tier="standard", roles=None, hedge_delay=0):
     """处理单个服务器的巡检任务"""
     print(f"\n{'='*40}")
     print(f"开始处理服务器: {ip}")
+    status = "error"
 
     try:
         # 第一步：执行巡检 - 使用ssh_pass作为sudo密码
-        log_file = inspect_server(ip, ssh_user, ssh_pass, ssh_pass, ssh_port)
+        with metrics.span("inspection.host", ip=ip, tier=tier):
+            log_file = inspect_server(ip, ssh_user, ssh_pass, ssh_pass, ssh_port, tier=tier, roles=roles)
         if not log_file:
             print(f"服务器 {ip} 巡检失败")
+            status = "ssh_failed"
             return
 
         # 第二步：AI分析
@@ -530,12 +701,14 @@ def process_server(ip, ssh_user, ssh_pass, ssh_port, volc_key, base_url, model):
             raw_data = f.read()
 
         analysis_file = None
-        if volc_key:  # 优先使用Deepseek引擎
+        if volc_key and hedge_delay:  # 远程引擎与本地模型对冲
+            print(f"\n使用Deepseek引擎分析（{hedge_delay}秒未响应时并行启动本地模型）...")
+            analysis_file = hedged_analysis(log_file, raw_data, ip, volc_key, base_url, model, hedge_delay)
+        elif volc_key:  # 优先使用Deepseek引擎
             print("\n使用Deepseek引擎分析...")
-            try:
-                analysis_file = AI_V3(log_file, ip, volc_key, base_url, model)
-            except Exception as e:
-                print(f"Deepseek分析失败: {str(e)}")
+            # AI_V3 失败时返回 None
+            analysis_file = AI_V3(log_file, ip, volc_key, base_url, model)
+            if not analysis_file:
                 print("尝试使用本地模型分析...")
                 analysis_file = local_ollama(raw_data, ip)
         else:  # 备用本地模型
@@ -546,62 +719,73 @@ def process_server(ip, ssh_user, ssh_pass, ssh_port, volc_key, base_url, model):
         if analysis_file and os.path.exists(analysis_file):
             # os.remove(log_file)
             print(f"\n分析报告保存至: {analysis_file}")
+            status = "ok"
         else:
             print("分析失败，保留原始日志")
+            status = "analysis_failed"
 
     except Exception as e:
         print(f"处理异常: {str(e)}")
     finally:
+        metrics.INSPECTION_HOSTS.inc(status=status)
         print(f"{'='*40}\n")
 
 def load_config():
-    """加载配置文件"""
-    config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
+    """加载配置（config.yaml + 环境变量覆盖，见 settings.py）"""
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
+        return settings.get()
     except Exception as e:
         print(f"配置文件加载失败: {str(e)}")
         return None
 
-def main():
-    global dir_url
-    
-    # 加载配置文件
-    config = load_config()
-    if not config:
-        return
+def run_inspection(config, tier=None):
+    """按给定配置巡检所有服务器，结束后按 metrics 配置导出指标"""
+    global dir_url, commands, inspection_config
+    started = time.time()
 
     # 初始化输出目录
-    dir_url = os.path.abspath(config['output']['dir'])
+    dir_url = os.path.abspath(config.output.dir)
     os.makedirs(dir_url, exist_ok=True)
 
+    # 加载巡检命令目录和分级配置
+    inspection_config = config.inspection
+    commands = load_commands(config)
+    if not commands:
+        print("配置文件中没有巡检命令 (commands)")
+        return
+    tier = tier or inspection_config.tier
+
     # 获取全局SSH配置
-    global_ssh = config['ssh']
+    global_ssh = config.ssh
     
     # 获取AI配置
-    volc_key = config['ai'].get('volc_key', '')
-    base_url = config['ai'].get('base_url', 'https://api.deepseek.com')
-    model = config['ai'].get('model', 'deepseek-chat')
+    volc_key = config.ai.volc_key
+    base_url = config.ai.base_url
+    model = config.ai.model
+    hedge_delay = config.ai.hedge_delay
 
     # 处理每个服务器
     devices = []
     ssh_configs = {}
     
-    for server in config['servers']:
+    for server in config.servers:
         ip = server['ip']
         devices.append(ip)
         
         # 合并服务器特定的SSH配置和全局配置
-        server_ssh = server.get('ssh', {})
+        server_ssh = server.get('ssh') or {}
         ssh_configs[ip] = {
-            'port': server_ssh.get('port', global_ssh['port']),
-            'user': server_ssh.get('user', global_ssh['user']),
-            'password': server_ssh.get('password', global_ssh['password'])
+            'port': server_ssh.get('port', global_ssh.port),
+            'user': server_ssh.get('user', global_ssh.user),
+            'password': server_ssh.get('password', global_ssh.password),
+            'roles': server.get('roles')
         }
+    if not devices:
+        print("配置文件中没有服务器 (servers)")
+        return
 
     # 使用线程池并发执行巡检任务
-    with ThreadPoolExecutor(max_workers=min(len(devices), 5)) as executor:
+    with ThreadPoolExecutor(max_workers=min(len(devices), inspection_config.max_workers)) as executor:
         futures = []
         for ip in devices:
             ssh_config = ssh_configs[ip]
@@ -613,7 +797,10 @@ def main():
                 ssh_config['port'],
                 volc_key,
                 base_url,
-                model
+                model,
+                tier,
+                ssh_config['roles'],
+                hedge_delay
             ))
         
         # 等待所有任务完成
@@ -623,6 +810,37 @@ def main():
             except Exception as e:
                 print(f"任务执行异常: {str(e)}")
 
+    print(f"前缀缓存: {format_cache_stats()}")
+    print(f"响应缓存: {format_response_cache_stats(get_response_cache('report'))}")
+    metrics.INSPECTION_RUN_SECONDS.set(time.time() - started)
+    metrics.INSPECTION_RUN_TIMESTAMP.set(time.time())
+    metrics.export("report")
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='服务器巡检')
+    parser.add_argument('-t', '--tier', choices=TIERS, help='巡检级别（默认使用配置文件中的 inspection.tier）')
+    parser.add_argument('--interval', type=int,
+                        help='常驻模式：每隔多少秒巡检一轮（默认使用配置文件中的 inspection.interval，0 表示只执行一轮）')
+    args = parser.parse_args()
+    
+    # 加载配置文件
+    config = load_config()
+    if not config:
+        return
+    interval = args.interval if args.interval is not None else config.inspection.interval
+    if interval:
+        # 常驻模式下修改配置文件无需重启，服务器列表、命令、并发数、超时等从下一轮开始生效
+        settings.watch()
+
+    while True:
+        started = time.time()
+        run_inspection(settings.get(), args.tier)
+        interval = args.interval if args.interval is not None else settings.get().inspection.interval
+        if not interval:
+            break
+        time.sleep(max(0, interval - (time.time() - started)))
+
 def test_AI():
     global dir_url
     config = load_config()
@@ -630,13 +848,13 @@ def test_AI():
         return
 
     # 初始化输出目录
-    dir_url = os.path.abspath(config['output']['dir'])
+    dir_url = os.path.abspath(config.output.dir)
     os.makedirs(dir_url, exist_ok=True)
     
     # 获取AI配置
-    volc_key = config['ai'].get('volc_key', '')
-    base_url = config['ai'].get('base_url', 'https://api.deepseek.com')
-    model = config['ai'].get('model', 'deepseek-chat')
+    volc_key = config.ai.volc_key
+    base_url = config.ai.base_url
+    model = config.ai.model
 
     # 使用 dir_url 构建日志文件路径
     ip_address = "47.57.186.97"
@@ -0,0 +1,297 @@
+"""本地模型响应缓存（默认关闭，config.yaml 中 cache.enabled: true 或设置 LLM_CACHE=1 开启）
+
+同样的问题、相同的告警摘要会被反复发给模型。缓存放在模型客户端前面：
+- 精确匹配：模型 + 完整请求消息相同则直接返回上次的回答
+- 相似匹配：最后一条用户消息之前的内容（系统提示、历史）完全相同，且最后一条用户消息的
+  嵌入向量余弦相似度不低于阈值时返回，用于措辞略有不同的重复问题
+条目超过 TTL 后失效，超过条数上限时淘汰最久未使用的条目。
+
+配置在 config.yaml 的 cache 段（见 settings.py），有效期、条数上限、阈值和相似匹配的命名空间可以热加载。
+相似匹配只对 cache.similar_namespaces 中的命名空间开启（默认只有 chat）：告警和巡检报告里
+主机名、数值略有不同时向量仍然很接近，复用回答会把别的主机的分析发出去，因此只做精确匹配。
+
+每个调用方（chat、alerts、report）一个命名空间，存放在 cache.dir 下：
+<namespace>.db 保存条目（SQLite），<namespace>_<嵌入方式>.f32 是内存映射的向量文件，
+第 row 行对应 row 列相同的条目。同一命名空间只应由一个进程写入。
+
+嵌入优先使用Ollama（nomic-embed-text），不可用时使用字符n-gram哈希向量；未安装 numpy 时只做精确匹配。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import settings
+from embedders import HashingEmbedder, OllamaEmbedder
+from metrics import LLM_RESPONSE_CACHE
+
+# 清理过期条目的最小间隔（秒）
+CACHE_PURGE_INTERVAL = 60
+
+EMBED_TIMEOUT = 5
+HASH_DIMS = 256
+
+np = None
+
+def _threshold(embedder):
+    """相似匹配的阈值：语义嵌入和哈希向量的分数不可比，分开配置"""
+    config = settings.get().cache
+    return config.hash_similarity if isinstance(embedder, HashingEmbedder) else config.similarity
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """进程内共享的嵌入器：Ollama可用时用语义嵌入，否则用哈希向量；未安装 numpy 时返回None"""
+    global _embedder, np
+    with _embedder_lock:
+        if _embedder is None:
+            try:
+                import numpy
+            except ImportError:
+                print("未安装 numpy，模型响应缓存只做精确匹配")
+                _embedder = False
+                return None
+            np = numpy
+            config = settings.get().cache
+            try:
+                # 地址和模型在首次使用时确定，修改后需要重启；向量文件和条目按 kind（含维度）区分，
+                # 换模型（维度不同）后旧条目只做精确匹配
+                _embedder = OllamaEmbedder(config.ollama_base_url, config.embed_model, EMBED_TIMEOUT)
+            except Exception:
+                _embedder = HashingEmbedder(HASH_DIMS)
+        return _embedder or None
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class Lookup:
+    """一次查找的结果；未命中时把它和模型回答一起交给 ResponseCache.store"""
+    def __init__(self, key, context_key, query, model):
+        self.key = key
+        self.context_key = context_key
+        self.query = query
+        self.model = model
+        self.vector = None
+        self.matched_key = None
+        self.response = None
+        self.match = None  # "exact" / "similar" / None
+        self.score = None
+
+class ResponseCache:
+    """一个命名空间的响应缓存"""
+    def __init__(self, namespace, directory=None, ttl=None, max_entries=None, similarity=True):
+        config = settings.get().cache
+        directory = directory or config.dir
+        ttl = config.ttl if ttl is None else ttl
+        max_entries = config.max_entries if max_entries is None else max_entries
+        os.makedirs(directory, exist_ok=True)
+        self.namespace = namespace
+        self.directory = directory
+        self.path = os.path.join(directory, f"{namespace}.db")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.free_rows = None
+        self.last_purge = 0
+        self.metrics = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0,
+                        "evictions": 0, "expired": 0, "lookup_ms": 0.0}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    context_key TEXT NOT NULL,
+                    model TEXT,
+                    query TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    vector_kind TEXT,
+                    row INTEGER,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_context ON cache_entries (context_key, vector_kind)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache_entries (last_used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _open_vectors(self, embedder):
+        """打开向量文件并找出空闲行，行数不少于条数上限"""
+        if self.vectors is not None:
+            return
+        path = os.path.join(self.directory, f"{self.namespace}_{embedder.kind}.f32")
+        with self._connect() as conn:
+            used = {row for (row,) in conn.execute(
+                "SELECT row FROM cache_entries WHERE vector_kind=? AND row IS NOT NULL", (embedder.kind,))}
+        capacity = max(self.max_entries, max(used, default=-1) + 1)
+        size = capacity * embedder.dims * 4
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        capacity = os.path.getsize(path) // (embedder.dims * 4)
+        self.vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, embedder.dims))
+        self.free_rows = sorted(set(range(capacity)) - used, reverse=True)
+
+    def _grow_vectors(self):
+        """条数上限调大后扩充向量文件，新增的行加入空闲行"""
+        capacity, dims = self.vectors.shape
+        if capacity >= self.max_entries:
+            return
+        path = self.vectors.filename
+        self.vectors.flush()
+        with open(path, "ab") as f:
+            f.truncate(self.max_entries * dims * 4)
+        self.vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(self.max_entries, dims))
+        self.free_rows = list(range(self.max_entries - 1, capacity - 1, -1)) + self.free_rows
+
+    def lookup(self, model, messages):
+        """按精确匹配、再按相似匹配查找回答，命中时 lookup.response 不为None"""
+        started = time.perf_counter()
+        query = messages[-1]["content"] if messages else ""
+        lookup = Lookup(_digest([model, messages]), _digest([model, messages[:-1]]), query, model)
+        now = time.time()
+        with self.lock, self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM cache_entries WHERE key=?", (lookup.key,)).fetchone()
+            if row is not None and now - row[1] <= self.ttl:
+                lookup.response, lookup.match, lookup.matched_key = row[0], "exact", lookup.key
+        # 嵌入在锁外计算，Ollama请求不阻塞其他线程的查找
+        embedder = get_embedder() if lookup.response is None and self.similarity else None
+        if embedder is not None:
+            try:
+                vector = embedder.embed(query)
+                norm = np.linalg.norm(vector)
+                lookup.vector = vector / norm if norm else None
+            except Exception:
+                pass
+        with self.lock, self._connect() as conn:
+            if lookup.vector is not None:
+                self._similar(conn, embedder, lookup, now)
+            if lookup.response is not None:
+                conn.execute("UPDATE cache_entries SET hits=hits+1, last_used=? WHERE key=?", (now, lookup.matched_key))
+                self.metrics["exact_hits" if lookup.match == "exact" else "similar_hits"] += 1
+            else:
+                self.metrics["misses"] += 1
+            self.metrics["lookup_ms"] += (time.perf_counter() - started) * 1000
+        LLM_RESPONSE_CACHE.inc(caller=self.namespace, result=lookup.match or "miss")
+        return lookup
+
+    def _similar(self, conn, embedder, lookup, now):
+        """在上下文相同的条目中找最后一条用户消息最相似的一条"""
+        candidates = conn.execute(
+            "SELECT key, response, row FROM cache_entries WHERE context_key=? AND vector_kind=? AND created_at>=?",
+            (lookup.context_key, embedder.kind, now - self.ttl)
+        ).fetchall()
+        if not candidates:
+            return
+        self._open_vectors(embedder)
+        scores = self.vectors[[row for _, _, row in candidates]] @ lookup.vector
+        best = int(np.argmax(scores))
+        if scores[best] >= _threshold(embedder):
+            lookup.matched_key, lookup.response, _ = candidates[best]
+            lookup.match = "similar"
+            lookup.score = float(scores[best])
+
+    def store(self, lookup, response):
+        """保存未命中请求的回答"""
+        if lookup.response is not None or not response:
+            return
+        now = time.time()
+        embedder = get_embedder() if self.similarity and lookup.vector is not None else None
+        with self.lock, self._connect() as conn:
+            old = conn.execute("SELECT row, vector_kind FROM cache_entries WHERE key=?", (lookup.key,)).fetchone()
+            if old is not None:
+                self._release(old)
+                conn.execute("DELETE FROM cache_entries WHERE key=?", (lookup.key,))
+            self._evict(conn, now)
+            row = None
+            if embedder is not None:
+                self._open_vectors(embedder)
+                if not self.free_rows:
+                    self._grow_vectors()
+                if self.free_rows:
+                    row = self.free_rows.pop()
+                    self.vectors[row] = lookup.vector
+            conn.execute(
+                "INSERT INTO cache_entries (key, context_key, model, query, response, vector_kind, row, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (lookup.key, lookup.context_key, lookup.model, lookup.query, response,
+                 embedder.kind if row is not None else None, row, now, now)
+            )
+            self.metrics["stores"] += 1
+
+    def _release(self, entry):
+        """归还条目占用的向量行"""
+        row, kind = entry
+        if row is not None and self.vectors is not None and _embedder and kind == _embedder.kind:
+            self.vectors[row] = 0
+            self.free_rows.append(row)
+
+    def _evict(self, conn, now):
+        """删除过期条目，并在达到条数上限时淘汰最久未使用的条目"""
+        if now - self.last_purge >= CACHE_PURGE_INTERVAL:
+            self.last_purge = now
+            expired = conn.execute("SELECT row, vector_kind FROM cache_entries WHERE created_at<?", (now - self.ttl,)).fetchall()
+            for entry in expired:
+                self._release(entry)
+            conn.execute("DELETE FROM cache_entries WHERE created_at<?", (now - self.ttl,))
+            self.metrics["expired"] += len(expired)
+        count = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        if count >= self.max_entries:
+            victims = conn.execute(
+                "SELECT key, row, vector_kind FROM cache_entries ORDER BY last_used LIMIT ?",
+                (count - self.max_entries + 1,)
+            ).fetchall()
+            for key, row, kind in victims:
+                self._release((row, kind))
+                conn.execute("DELETE FROM cache_entries WHERE key=?", (key,))
+            self.metrics["evictions"] += len(victims)
+
+    def stats(self):
+        """命中率等统计"""
+        with self.lock, self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+            metrics = dict(self.metrics)
+        lookups = metrics["exact_hits"] + metrics["similar_hits"] + metrics["misses"]
+        metrics.update({
+            "namespace": self.namespace,
+            "entries": entries,
+            "lookups": lookups,
+            "hit_rate": (metrics["exact_hits"] + metrics["similar_hits"]) / lookups if lookups else 0.0,
+            "avg_lookup_ms": round(metrics.pop("lookup_ms") / lookups, 3) if lookups else None,
+            "embedder": _embedder.kind if self.similarity and _embedder else None,
+        })
+        return metrics
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache(namespace):
+    """获取命名空间的缓存，未开启缓存时返回None；每次按当前配置更新有效期、条数上限和是否相似匹配"""
+    config = settings.get().cache
+    if not config.enabled:
+        return None
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = ResponseCache(namespace)
+        cache = _caches[namespace]
+    with cache.lock:
+        cache.ttl = config.ttl
+        cache.max_entries = config.max_entries
+        cache.similarity = namespace in config.similar_namespaces
+    return cache
+
+def format_cache_stats(cache):
+    """响应缓存统计的单行摘要，用于命令行输出"""
+    if cache is None:
+        return "未开启"
+    stats = cache.stats()
+    return (f"{stats['lookups']} 次查找, 命中率 {stats['hit_rate']:.0%} "
+            f"(精确 {stats['exact_hits']}, 相似 {stats['similar_hits']}), {stats['entries']} 条, "
+            f"平均查找 {stats['avg_lookup_ms']}ms")
@@ -0,0 +1,381 @@
+"""统一配置：配置文件 + 环境变量覆盖，alerts.py、chat.py、report.py、ai-assistant.py 共用
+
+优先级：环境变量 > 配置文件 > 默认值。配置文件由环境变量 CONFIG_FILE 指定，默认是本目录下的 config.yaml，
+环境变量与配置项的对应关系见 ENV_OVERRIDES。
+
+各模块每次使用时通过 get() 读取当前配置。服务启动时调用 watch()，在后台按修改时间检测配置文件，
+变化后重新加载（热加载），加载或校验失败时保留旧配置；连接池、并发上限等需要调整的对象通过
+on_reload() 注册回调。可以热加载的有：模型、接口地址和密钥、超时、并发上限、服务器列表、巡检命令和预算；
+端口、数据库路径等启动时使用的配置修改后需要重启。
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass, field, fields, asdict
+from typing import List
+
+import yaml
+
+CONFIG_FILE = os.environ.get("CONFIG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml"))
+# 检测配置文件变化的间隔（秒）
+WATCH_INTERVAL = 2.0
+
+@dataclass
+class LLMConfig:
+    """模型接口（所有服务共用，各服务可单独指定模型）"""
+    api_key: str = ""
+    base_url: str = "https://api.x.ai/v1"
+    model: str = "grok-2-latest"
+    timeout: float = 120.0      # 单次请求超时（秒），流式请求为两次读取之间的最长间隔
+    max_retries: int = 2
+
+@dataclass
+class AlertsConfig:
+    """告警 webhook（alerts.py）"""
+    host: str = "0.0.0.0"
+    port: int = 6000
+    db_path: str = "alerts.db"
+    webhook_key: str = ""       # Alertmanager 请求头 X-API-KEY 的值，未配置时拒绝所有请求
+    model: str = ""             # 为空时使用 llm.model
+    max_concurrency: int = 4    # 同时进行的告警分析请求数
+
+@dataclass
+class ChatConfig:
+    """聊天服务（chat.py）"""
+    host: str = "127.0.0.1"
+    port: int = 6001
+    api_key: str = ""           # 接口密钥（请求头 X-API-KEY），未配置时只接受本机请求
+    db_path: str = "chat.db"
+    model: str = ""
+    max_streams: int = 64       # 同时进行的模型请求数，超出的请求排队等待
+    archive_dir: str = "chat_archive"
+    archive_after_days: int = 30
+
+@dataclass
+class AssistantConfig:
+    """个人助手服务模式（ai-assistant.py --serve）"""
+    host: str = "127.0.0.1"
+    port: int = 6002
+    api_key: str = ""           # 接口密钥（请求头 X-API-KEY），未配置时只接受本机请求
+    model: str = ""
+    max_assistants: int = 200   # 同时缓存的用户实例数
+    idle_timeout: int = 1800    # 实例空闲多久后被淘汰（秒）
+
+@dataclass
+class CacheConfig:
+    """模型响应缓存（response_cache.py）"""
+    enabled: bool = False
+    dir: str = "llm_cache"
+    ttl: int = 24 * 3600
+    max_entries: int = 10000
+    similarity: float = 0.95
+    hash_similarity: float = 0.9
+    similar_namespaces: List[str] = field(default_factory=lambda: ["chat"])
+    ollama_base_url: str = "http://localhost:11434"
+    embed_model: str = "nomic-embed-text:latest"
+
+@dataclass
+class MetricsConfig:
+    """指标导出和链路追踪（metrics.py）"""
+    textfile: str = ""          # report.py 每轮巡检后写入的 node_exporter textfile 路径（*.prom）
+    pushgateway: str = ""       # report.py 每轮巡检后推送的 Pushgateway 地址
+    tracing: bool = False       # 记录 OpenTelemetry 链路追踪（需安装 opentelemetry-api）
+
+@dataclass
+class OutputConfig:
+    dir: str = "./server_inspection"
+
+@dataclass
+class SSHConfig:
+    """巡检的全局SSH配置，servers 中可按主机覆盖 port/user/password"""
+    port: int = 22
+    user: str = ""
+    password: str = ""
+    connect_timeout: float = 15.0
+    banner_timeout: float = 20.0
+
+@dataclass
+class ReportAIConfig:
+    """巡检报告使用的远程引擎，volc_key 为空时只使用本地模型"""
+    volc_key: str = ""
+    base_url: str = "https://api.deepseek.com"
+    model: str = "deepseek-chat"
+    hedge_delay: float = 0
+    timeout: float = 300.0      # 单次请求超时（秒）
+
+@dataclass
+class InspectionConfig:
+    tier: str = "standard"
+    budgets: dict = field(default_factory=dict)
+    deep_interval: int = 0
+    default_timeout: int = 10
+    max_workers: int = 5        # 同时巡检的主机数
+    interval: int = 0           # 常驻模式下两轮巡检的间隔（秒），0 表示只执行一轮
+
+@dataclass
+class Settings:
+    llm: LLMConfig = field(default_factory=LLMConfig)
+    alerts: AlertsConfig = field(default_factory=AlertsConfig)
+    chat: ChatConfig = field(default_factory=ChatConfig)
+    assistant: AssistantConfig = field(default_factory=AssistantConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    output: OutputConfig = field(default_factory=OutputConfig)
+    ssh: SSHConfig = field(default_factory=SSHConfig)
+    ai: ReportAIConfig = field(default_factory=ReportAIConfig)
+    inspection: InspectionConfig = field(default_factory=InspectionConfig)
+    servers: list = field(default_factory=list)
+    commands: list = field(default_factory=list)
+
+    def model_for(self, service):
+        """服务使用的模型：服务单独配置的模型，未配置时为 llm.model"""
+        return getattr(self, service).model or self.llm.model
+
+# 环境变量 -> 配置项
+ENV_OVERRIDES = {
+    "LLM_API_KEY": "llm.api_key",
+    "LLM_BASE_URL": "llm.base_url",
+    "LLM_MODEL": "llm.model",
+    "LLM_TIMEOUT": "llm.timeout",
+    "ALERTS_API_KEY": "alerts.webhook_key",
+    "ALERTS_DB_PATH": "alerts.db_path",
+    "ALERTS_PORT": "alerts.port",
+    "ALERTS_MAX_CONCURRENCY": "alerts.max_concurrency",
+    "DB_PATH": "chat.db_path",
+    "CHAT_HOST": "chat.host",
+    "CHAT_PORT": "chat.port",
+    "CHAT_API_KEY": "chat.api_key",
+    "CHAT_MAX_STREAMS": "chat.max_streams",
+    "CHAT_ARCHIVE_DIR": "chat.archive_dir",
+    "CHAT_ARCHIVE_AFTER_DAYS": "chat.archive_after_days",
+    "ASSISTANT_HOST": "assistant.host",
+    "ASSISTANT_PORT": "assistant.port",
+    "ASSISTANT_API_KEY": "assistant.api_key",
+    "LLM_CACHE": "cache.enabled",
+    "LLM_CACHE_DIR": "cache.dir",
+    "LLM_CACHE_TTL": "cache.ttl",
+    "LLM_CACHE_MAX_ENTRIES": "cache.max_entries",
+    "LLM_CACHE_SIMILARITY": "cache.similarity",
+    "LLM_CACHE_HASH_SIMILARITY": "cache.hash_similarity",
+    "LLM_CACHE_SIMILAR_NAMESPACES": "cache.similar_namespaces",
+    "OLLAMA_BASE_URL": "cache.ollama_base_url",
+    "LLM_CACHE_EMBED_MODEL": "cache.embed_model",
+    "METRICS_TEXTFILE": "metrics.textfile",
+    "METRICS_PUSHGATEWAY": "metrics.pushgateway",
+    "METRICS_TRACING": "metrics.tracing",
+    "REPORT_API_KEY": "ai.volc_key",
+    "SSH_USER": "ssh.user",
+    "SSH_PASSWORD": "ssh.password",
+}
+
+def _convert(value, target, name):
+    """把配置文件或环境变量中的值转换为字段类型"""
+    if target is bool:
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return bool(value)
+    if target in (int, float):
+        try:
+            return target(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"配置项 {name} 应为数字: {value!r}")
+    if target is str:
+        return "" if value is None else str(value)
+    if target in (list, List[str]):
+        if isinstance(value, str):
+            return [item.strip() for item in value.split(",") if item.strip()]
+        if not isinstance(value, list):
+            raise ValueError(f"配置项 {name} 应为列表: {value!r}")
+        return value
+    if target is dict:
+        if not isinstance(value, dict):
+            raise ValueError(f"配置项 {name} 应为字典: {value!r}")
+        return value
+    return value
+
+def _build_section(cls, data, name):
+    section = cls()
+    if data is None:
+        return section
+    if not isinstance(data, dict):
+        raise ValueError(f"配置段 {name} 应为字典")
+    known = {f.name: f for f in fields(cls)}
+    for key, value in data.items():
+        if key not in known:
+            print(f"忽略未知的配置项: {name}.{key}")
+            continue
+        setattr(section, key, _convert(value, known[key].type, f"{name}.{key}"))
+    return section
+
+def _validate(settings):
+    for name in ("alerts", "chat", "assistant"):
+        port = getattr(settings, name).port
+        if not 0 < port < 65536:
+            raise ValueError(f"{name}.port 无效: {port}")
+    for name, value in (("alerts.max_concurrency", settings.alerts.max_concurrency),
+                        ("chat.max_streams", settings.chat.max_streams),
+                        ("assistant.max_assistants", settings.assistant.max_assistants),
+                        ("inspection.max_workers", settings.inspection.max_workers)):
+        if value < 1:
+            raise ValueError(f"{name} 必须大于0: {value}")
+    if settings.inspection.tier not in ("quick", "standard", "deep"):
+        raise ValueError(f"inspection.tier 无效: {settings.inspection.tier}")
+    for server in settings.servers:
+        if not isinstance(server, dict) or not server.get("ip"):
+            raise ValueError(f"servers 中的每一项都需要 ip: {server!r}")
+
+def load(path=None):
+    """读取配置文件并应用环境变量覆盖，文件不存在时使用默认值"""
+    path = path or CONFIG_FILE
+    data = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = yaml.safe_load(f) or {}
+        if not isinstance(data, dict):
+            raise ValueError(f"配置文件格式错误: {path}")
+    settings = Settings()
+    for f in fields(Settings):
+        value = data.get(f.name)
+        if f.type is list:
+            setattr(settings, f.name, _convert(value if value is not None else [], list, f.name))
+        else:
+            setattr(settings, f.name, _build_section(f.type, value, f.name))
+    for env, target in ENV_OVERRIDES.items():
+        # 空值视为未设置（如 docker-compose 中引用了未设置的变量）
+        if os.environ.get(env):
+            section_name, key = target.split(".")
+            section = getattr(settings, section_name)
+            field_type = next(f.type for f in fields(section) if f.name == key)
+            setattr(section, key, _convert(os.environ[env], field_type, env))
+    _validate(settings)
+    return settings
+
+_current = None
+_current_lock = threading.Lock()
+_callbacks = []
+_watcher = None
+_file_state = None
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+def get():
+    """当前配置，首次调用时加载"""
+    global _current, _file_state
+    if _current is None:
+        with _current_lock:
+            if _current is None:
+                _file_state = _stat(CONFIG_FILE)
+                _current = load()
+    return _current
+
+def on_reload(callback):
+    """注册热加载回调 callback(旧配置, 新配置)"""
+    _callbacks.append(callback)
+
+def _changes(old, new):
+    """两份配置中不同的配置项名称（不输出值，避免日志中出现密钥）"""
+    old, new = asdict(old), asdict(new)
+    changed = []
+    for section, values in new.items():
+        if isinstance(values, dict):
+            changed.extend(f"{section}.{key}" for key in values if values[key] != old[section].get(key))
+        elif values != old[section]:
+            changed.append(section)
+    return changed
+
+def reload():
+    """重新加载配置文件，成功且有变化时通知回调，返回是否有变化"""
+    global _current
+    old = get()
+    try:
+        new = load()
+    except Exception as e:
+        print(f"重新加载配置失败，继续使用旧配置: {str(e)}")
+        return False
+    with _current_lock:
+        old, _current = _current, new
+    changed = _changes(old, new)
+    if not changed:
+        return False
+    print(f"配置已重新加载，变化: {', '.join(changed)}")
+    for callback in list(_callbacks):
+        try:
+            callback(old, new)
+        except Exception as e:
+            print(f"应用新配置失败: {str(e)}")
+    return True
+
+def _watch(interval):
+    global _file_state
+    while True:
+        time.sleep(interval)
+        state = _stat(CONFIG_FILE)
+        if state != _file_state:
+            _file_state = state
+            reload()
+
+def watch(interval=WATCH_INTERVAL):
+    """启动后台线程检测配置文件变化并热加载（重复调用只启动一次）"""
+    global _watcher
+    get()
+    with _current_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch, args=(interval,), name="settings-watch", daemon=True)
+            _watcher.start()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_openai_client(llm=None):
+    """按模型接口配置复用的OpenAI客户端，地址、密钥或超时变化后创建新客户端"""
+    llm = llm or get().llm
+    key = (llm.api_key, llm.base_url, llm.timeout, llm.max_retries)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=llm.api_key or "missing", base_url=llm.base_url,
+                            timeout=llm.timeout, max_retries=llm.max_retries)
+            # 只保留当前配置对应的客户端
+            _clients.clear()
+            _clients[key] = client
+        return client
+
+class ConcurrencyLimit:
+    """可调整上限的并发限制，配置热加载后调用 resize 生效，已在执行的任务不受影响"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def acquire(self):
+        """等待直到有空闲名额；可以在另一个线程中 release"""
+        with self.condition:
+            self.waiting += 1
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.waiting -= 1
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
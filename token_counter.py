@@ -0,0 +1,52 @@
+"""Token计数工具
+
+优先使用 tiktoken 在本地分词；未安装 tiktoken 或词表无法加载（如离线环境）时，
+按字符类别估算：中日韩字符约1个token，其余字符约4个一个token。
+"""
+import os
+import re
+
+# 使用的分词词表，可通过环境变量覆盖
+ENCODING_NAME = os.environ.get("TOKEN_ENCODING", "cl100k_base")
+
+# 每条消息的格式开销（角色、分隔符）和回复的起始开销
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿가-힯＀-￯]")
+
+_encoding = None
+_encoding_failed = False
+
+def _get_encoding():
+    """加载分词词表，失败后不再重试"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken  # 首次计数时再导入，不拖慢启动
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+        except Exception:
+            _encoding_failed = True
+    return _encoding
+
+def estimate_tokens(text):
+    """按字符类别估算token数"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def count_tokens(text):
+    """计算文本的token数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+def count_message_tokens(messages):
+    """计算一组对话消息的token数（含每条消息的格式开销）"""
+    return sum(count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD for message in messages) + REPLY_OVERHEAD
+
+def tokenizer_name():
+    """当前使用的计数方式，用于调试输出"""
+    return f"tiktoken/{ENCODING_NAME}" if _get_encoding() is not None else "estimate"